@@ -0,0 +1,31 @@
+import os
+import sys
+import types
+
+import mongomock
+import pytest
+
+# importing the app package connects to MongoDB and sets up the whole webapp, the unit tests only need the modules
+# inside it, so the package is registered without running app/__init__.py
+_package = types.ModuleType("app")
+_package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")]
+sys.modules.setdefault("app", _package)
+
+
+
+class MockMongo:
+    """
+    Stands in for flask_pymongo's PyMongo, with an in-memory database
+    """
+
+    def __init__(self):
+        self.cx = mongomock.MongoClient()
+        self.db = self.cx.db
+
+
+@pytest.fixture
+def mongo() -> MockMongo:
+    """
+    A new empty database for each test, the per database caches are keyed on it so they start empty too
+    """
+    return MockMongo()
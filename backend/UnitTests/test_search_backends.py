@@ -0,0 +1,354 @@
+import random
+
+import pytest
+
+from app.database_impl.attrib_options import AttributeOption, AttributeTypes, SingleLineStringAttribute, \
+    SingleLineIntegerAttribute
+from app.database_impl.generations import get_generations
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.items_instances import Item, Instance
+from app.database_impl.migrations import MIGRATIONS
+from app.database_impl.tag_matrix import TagMatrix
+from app.database_impl.tags import Tag, TagReference, TagCache
+from app.search_parser import search_string_to_mongodb_query, search_string_to_facets, SearchStringParseError
+
+NAMES = ["bob", "Bobby", "alice", "Alicia", "carol"]
+
+
+@pytest.fixture
+def library(mongo):
+    """
+    A few hundred random items, with tags that imply each other, names and player counts
+    """
+    rng = random.Random(7)
+    tags = []
+    for name in "abcdefgh":
+        # each tag may imply some of the tags made before it, so the implications form a DAG
+        tag = Tag(name, [TagReference(t) for t in rng.sample(tags, min(len(tags), rng.randint(0, 2)))])
+        tag.write_to_db(mongo)
+        tags.append(tag)
+
+    name = AttributeOption("name", AttributeTypes.SingleLineString)
+    name.write_to_db(mongo)
+    players = AttributeOption("players", AttributeTypes.SingleLineInteger)
+    players.write_to_db(mongo)
+
+    for i in range(200):
+        item = Item([SingleLineStringAttribute(name, rng.choice(NAMES)), SingleLineIntegerAttribute(players, rng.randint(1, 8))],
+                    [TagReference(t) for t in rng.sample(tags, rng.randint(0, 3))],
+                    [Instance([], [TagReference(t) for t in rng.sample(tags, rng.randint(0, 2))], rng.random() < 0.2)
+                     for _ in range(rng.randint(0, 2))],
+                    rng.random() < 0.1)
+        item.write_to_db(mongo)
+        item.recalculate_implied_tags(mongo, True)
+    return mongo
+
+
+def random_search(rng, depth, attributes=True):
+    if depth == 0 or rng.random() < 0.3:
+        return rng.choice([
+            rng.choice("abcdefgh"),
+            "::instance::" + rng.choice("abcdefgh"),
+            "::under::" + rng.choice("abcdefgh"),
+            "::instance::under::" + rng.choice("abcdefgh"),
+        ] + ([
+            "::has::name",
+            "::name::equals::" + rng.choice(NAMES),
+            "::name::iequals::" + rng.choice(NAMES).upper(),
+            "::name::startswith::" + rng.choice(["b", "al", "ca"]),
+            "::name::endswith::" + rng.choice(["B", "ia", "ol"]),
+            "::name::contains::" + rng.choice(["ob", "lic", "bby"]),
+            "::players::gt::" + str(rng.randint(1, 8)),
+            "::players::between::" + str(rng.randint(1, 4)) + ".." + str(rng.randint(4, 8)),
+        ] if attributes else []))
+    if rng.random() < 0.2:
+        return "::not (" + random_search(rng, depth - 1, attributes) + ")"
+    return "(" + random_search(rng, depth - 1, attributes) + rng.choice([", ", " ::or "]) + \
+           random_search(rng, depth - 1, attributes) + ")"
+
+
+def facets_with(mongo, search, in_memory, matrix):
+    index = ItemIndex.for_mongo(mongo)
+    index.enabled = in_memory
+    index.generation = None
+    TagMatrix.for_mongo(mongo).enabled = matrix
+    try:
+        return search_string_to_facets(mongo, search)
+    finally:
+        index.enabled = False
+        TagMatrix.for_mongo(mongo).enabled = False
+
+
+def test_item_index_matches_mongo(library):
+    rng = random.Random(3)
+    for i in range(150):
+        search = random_search(rng, 4)
+        query = search_string_to_mongodb_query(library, search)
+        assert not isinstance(query, list), (search, query)
+
+        expected = sorted(d["_id"] for d in library.db.items.find(query))
+        facets = facets_with(library, search, False, False)
+        assert facets["items"] == expected, search
+        assert facets_with(library, search, True, False) == facets, search
+
+
+@pytest.mark.skipif(not TagMatrix.available, reason="the tag matrix needs numpy")
+def test_tag_matrix_matches_mongo(library):
+    rng = random.Random(4)
+    for i in range(150):
+        search = random_search(rng, 4, attributes=False)
+        assert facets_with(library, search, True, True) == facets_with(library, search, False, False), search
+
+
+def test_errors_match(library):
+    for search in ["zz", "a, ::nothing::equals::x", "a ::and"]:
+        assert isinstance(facets_with(library, search, False, False)[0], SearchStringParseError)
+        assert isinstance(facets_with(library, search, True, False)[0], SearchStringParseError)
+
+
+def expected_implied(mongo, tags):
+    # walks the implications stored in the database, independently of the TagGraph
+    implies = {t["_id"]: t["implies"] for t in mongo.db.tags.find()}
+    implied, stack = set(), list(tags)
+    while stack:
+        for child in implies[stack.pop()]:
+            if child not in implied:
+                implied.add(child)
+                stack.append(child)
+    return implied - set(tags)
+
+
+def assert_implied_tags_correct(mongo):
+    for item in mongo.db.items.find():
+        assert set(item["implied_tags"]) == expected_implied(mongo, item["tags"])
+        assert set(item["all_tags"]) == set(item["tags"]) | set(item["implied_tags"])
+        for instance in item["instances"]:
+            assert set(instance["implied_tags"]) == expected_implied(mongo, instance["tags"])
+            assert set(instance["all_tags"]) == set(instance["tags"]) | set(instance["implied_tags"])
+
+
+def test_propagate_implication_change(library):
+    assert_implied_tags_correct(library)
+    tags = {t.name: t for t in (Tag.from_dict(d) for d in library.db.tags.find())}
+
+    # a new implication, one being taken away, and every implication of a tag being cleared
+    tags["a"].implies.append(TagReference(tags["h"]))
+    tags["a"].write_to_db(library)
+    assert Item.propagate_implication_change(library, tags["a"].id) > 0
+    assert_implied_tags_correct(library)
+
+    tags["e"].implies = tags["e"].implies[1:]
+    tags["e"].write_to_db(library)
+    Item.propagate_implication_change(library, tags["e"].id)
+    assert_implied_tags_correct(library)
+
+    tags["a"].implies = []
+    tags["a"].write_to_db(library)
+    Item.propagate_implication_change(library, tags["a"].id)
+    assert_implied_tags_correct(library)
+
+
+def test_propagate_implication_change_untouched(library):
+    tags = {t.name: t for t in (Tag.from_dict(d) for d in library.db.tags.find())}
+    before = list(library.db.items.find())
+
+    # writing a tag without changing its implications leaves every item as it was
+    tags["c"].write_to_db(library)
+    assert Item.propagate_implication_change(library, tags["c"].id) == 0
+    assert list(library.db.items.find()) == before
+
+
+def test_under_searches_a_category(mongo):
+    # a two level hierarchy, catan is a strategy game, which is a board game
+    board_game = Tag("board game", [])
+    board_game.write_to_db(mongo)
+    strategy_game = Tag("strategy game", [TagReference(board_game)])
+    strategy_game.write_to_db(mongo)
+    catan = Tag("catan", [TagReference(strategy_game)])
+    catan.write_to_db(mongo)
+    chess = Tag("chess", [])
+    chess.write_to_db(mongo)
+
+    items = {}
+    for name, tags in [("catan", [catan]), ("strategy", [strategy_game]), ("board", [board_game]), ("chess", [chess])]:
+        # the implied tags aren't calculated, so only ::under:: can find these by their category
+        item = Item([], [TagReference(t) for t in tags], [Instance([], [TagReference(t) for t in tags], False)], False)
+        item.write_to_db(mongo)
+        items[name] = item.id
+
+    for search, expected in [("::under::board game", ["catan", "strategy", "board"]),
+                             ("::under::strategy game", ["catan", "strategy"]),
+                             ("::under::catan", ["catan"]),
+                             ("::instance::under::strategy game", ["catan", "strategy"]),
+                             ("::not ::under::strategy game", ["board", "chess"])]:
+        expected = sorted(items[name] for name in expected)
+        assert facets_with(mongo, search, False, False)["items"] == expected, search
+        assert facets_with(mongo, search, True, False)["items"] == expected, search
+        if TagMatrix.available:
+            assert facets_with(mongo, search, True, True)["items"] == expected, search
+
+
+def test_endswith_searches_the_reversed_values(mongo):
+    name = AttributeOption("name", AttributeTypes.SingleLineString)
+    name.write_to_db(mongo)
+    item = Item([SingleLineStringAttribute(name, "Catan")], [], [Instance([SingleLineStringAttribute(name, "Catan")], [], False)])
+    item.write_to_db(mongo)
+
+    assert facets_with(mongo, "::name::endswith::TAN", False, False)["items"] == [item.id]
+    assert facets_with(mongo, "::instance::name::endswith::tan", False, False)["items"] == [item.id]
+    assert facets_with(mongo, "::name::endswith::cat", False, False)["items"] == []
+
+    # items written before the reversed values were stored are found once the migration has added them
+    mongo.db.items.update_one({"_id": item.id}, {"$unset": {"attributes.0.folded_reversed": "",
+                                                            "instances.0.attributes.0.folded_reversed": ""}})
+    assert facets_with(mongo, "::name::endswith::tan", False, False)["items"] == []
+    MIGRATIONS[-1][1](mongo)
+    assert facets_with(mongo, "::name::endswith::tan", False, False)["items"] == [item.id]
+    assert facets_with(mongo, "::instance::name::endswith::tan", False, False)["items"] == [item.id]
+
+
+def test_rebuild_keeps_writes_made_while_running(mongo):
+    a = Tag("a", [])
+    a.write_to_db(mongo)
+    b = Tag("b", [TagReference(a)])
+    b.write_to_db(mongo)
+    c = Tag("c", [])
+    c.write_to_db(mongo)
+
+    # neither has its implied tags calculated
+    edited = Item([], [TagReference(b)], [Instance([], [TagReference(b)], False)], False)
+    edited.write_to_db(mongo)
+    untouched = Item([], [TagReference(b)], [Instance([], [TagReference(b)], False)], False)
+    untouched.write_to_db(mongo)
+
+    # what the aggregation writes for them, it needs $graphLookup so it can't run here
+    rebuild = mongo.db.implied_tags_rebuild_test
+    for item in (edited, untouched):
+        rebuild.insert_one({"_id": item.id, "tags": [b.id], "old_implied_tags": [], "implied_tags": [a.id],
+                            "item_changed": True, "instances": [
+                                {"_id": item.instances[0].id, "tags": [b.id], "old_implied_tags": [], "implied_tags": [a.id]}
+                            ]})
+
+    # then the edited item is changed before the implied tags are written back
+    edited.tags.append(TagReference(c))
+    edited.instances[0].tags = []
+    edited.instances.append(Instance([], [TagReference(c)], False))
+    edited.write_to_db(mongo)
+    edited_dict = mongo.db.items.find_one({"_id": edited.id})
+
+    assert Item._apply_implied_tags_rebuild(mongo, rebuild) == 2
+    assert mongo.db.items.find_one({"_id": edited.id}) == edited_dict
+
+    untouched_dict = mongo.db.items.find_one({"_id": untouched.id})
+    assert untouched_dict["implied_tags"] == [a.id]
+    assert set(untouched_dict["all_tags"]) == {a.id, b.id}
+    assert untouched_dict["instances"][0]["implied_tags"] == [a.id]
+    assert set(untouched_dict["instances"][0]["all_tags"]) == {a.id, b.id}
+
+
+@pytest.mark.skipif(not TagMatrix.available, reason="the tag matrix needs numpy")
+def test_shared_file_falls_back_to_mongo(library, tmp_path):
+    path = str(tmp_path / "search-index")
+    assert TagMatrix.update_file(library, path)
+
+    matrix = TagMatrix.for_mongo(library)
+    matrix.enabled = True
+    matrix.path = path
+    index = ItemIndex.for_mongo(library)
+    try:
+        for search in ["a, b", "::under::c ::or -d", "a, ::name::equals::bob"]:
+            assert search_string_to_facets(library, search) == facets_with(library, search, False, False), search
+
+        # a write makes the file stale until it's rebuilt
+        tags = {t.name: t for t in (Tag.from_dict(d) for d in library.db.tags.find())}
+        item = Item([], [TagReference(tags["a"]), TagReference(tags["b"])], [], False)
+        item.write_to_db(library)
+        generations = get_generations(library, [ItemIndex.GENERATION_NAME, TagCache.GENERATION_NAME])
+        matrix.validate(generations[ItemIndex.GENERATION_NAME], generations[TagCache.GENERATION_NAME])
+
+        facets = search_string_to_facets(library, "a, b")
+        assert item.id in facets["items"]
+        assert facets == facets_with(library, "a, b", False, False)
+        # no process loads every item for itself
+        assert index.generation is None and not index.items
+
+        assert TagMatrix.update_file(library, path)
+        assert search_string_to_facets(library, "a, b") == facets
+    finally:
+        matrix.enabled = False
+        matrix.path = None
+
+
+def index_contents(index):
+    return (index.items, index.hidden, index.item_tags, index.instance_tags, index.item_attributes,
+            index.instance_attributes, index.item_trigrams, index.instance_trigrams)
+
+
+def test_item_index_catches_up_on_other_processes_writes(library, monkeypatch):
+    # another process' index of the same database
+    other = ItemIndex(library)
+    other.enabled = True
+    other.validate()
+
+    loads = []
+    original_load = other._load
+    monkeypatch.setattr(other, "_load", lambda: (loads.append(True), original_load()))
+
+    tags = {t.name: t for t in (Tag.from_dict(d) for d in library.db.tags.find())}
+    items = [Item.from_dict(d) for d in library.db.items.find().limit(3)]
+    items[0].tags.append(TagReference(tags["h"]))
+    items[0].write_to_db(library)
+    items[1].delete_from_db(library)
+    Item([], [TagReference(tags["a"])], [], True).write_to_db(library)
+    tags["b"].implies.append(TagReference(tags["h"]))
+    tags["b"].write_to_db(library)
+    Item.propagate_implication_change(library, tags["b"].id)
+
+    # only the changed items are read again
+    other.validate()
+    assert not loads
+    fresh = ItemIndex(library)
+    fresh.enabled = True
+    fresh.validate()
+    assert index_contents(other) == index_contents(fresh)
+
+    # a change that didn't record its items reloads everything
+    ItemIndex.items_changed(library)
+    other.validate()
+    assert loads
+    assert other.generation == fresh.generation + 1
+
+
+@pytest.mark.skipif(not TagMatrix.available, reason="the tag matrix needs numpy")
+def test_tag_matrix_patches_changed_items(library, monkeypatch):
+    matrix = TagMatrix.for_mongo(library)
+    matrix.build()
+
+    builds = []
+    original_build = matrix.build
+    monkeypatch.setattr(matrix, "build", lambda: (builds.append(True), original_build()))
+
+    # enough new items that the rows need another word
+    tags = {t.name: t for t in (Tag.from_dict(d) for d in library.db.tags.find())}
+    for i in range(70):
+        Item([], [TagReference(tags["abcdefgh"[i % 8]])], [Instance([], [TagReference(tags["a"])], False)],
+             i % 5 == 0).write_to_db(library)
+    items = [Item.from_dict(d) for d in library.db.items.find().limit(3)]
+    items[0].tags = [TagReference(tags["h"])]
+    items[0].write_to_db(library)
+    items[1].delete_from_db(library)
+    items[2].hide(library)
+    new_tag = Tag("i", [TagReference(tags["a"])])
+    new_tag.write_to_db(library)
+    Item([], [TagReference(new_tag)], [], False).write_to_db(library)
+    tags["c"].implies.append(TagReference(tags["h"]))
+    tags["c"].write_to_db(library)
+    Item.propagate_implication_change(library, tags["c"].id)
+
+    generations = get_generations(library, [ItemIndex.GENERATION_NAME, TagCache.GENERATION_NAME])
+    matrix.validate(generations[ItemIndex.GENERATION_NAME], generations[TagCache.GENERATION_NAME])
+
+    rng = random.Random(5)
+    for search in ["i", "::under::a", "-h"] + [random_search(rng, 3, attributes=False) for _ in range(50)]:
+        assert facets_with(library, search, True, True) == facets_with(library, search, False, False), search
+    assert not builds
@@ -0,0 +1,184 @@
+import random
+
+import pytest
+
+from app.search_parser import search_string_parser, Value, UnitaryOperator, BinaryOperator, OperatorTypes, \
+    SearchStringParseError, UnexpectedOperator, UnexpectedTag, UnexpectedCloseBracket, MissingCloseBracket, \
+    EmptySearch, InvalidNumber, SearchTooComplex, SearchLimits, CheckMode, ItemTagValue, InstanceTagValue, \
+    HasItemAttributeValue, CheckItemAttributeValue, CheckInstanceAttributeValue, UnderItemTagValue, optimize_query, \
+    narrow_search
+
+
+def tag(name):
+    return Value.parse(name)
+
+
+def both(left, right):
+    return BinaryOperator(OperatorTypes.And, left, right)
+
+
+def either(left, right):
+    return BinaryOperator(OperatorTypes.Or, left, right)
+
+
+def negate(value):
+    return UnitaryOperator(OperatorTypes.Not, value)
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("a", tag("a")),
+    ("a, b", both(tag("a"), tag("b"))),
+    ("a ::and b ::and c", both(both(tag("a"), tag("b")), tag("c"))),
+    # ::and binds tighter than ::or, on either side
+    ("a ::or b, c", either(tag("a"), both(tag("b"), tag("c")))),
+    ("a, b ::or c", either(both(tag("a"), tag("b")), tag("c"))),
+    # ::not binds tighter than both
+    ("::not a, b", both(negate(tag("a")), tag("b"))),
+    ("-a ::or b", either(negate(tag("a")), tag("b"))),
+    ("::not ::not a", negate(negate(tag("a")))),
+    ("::not (a, b)", negate(both(tag("a"), tag("b")))),
+    ("(a ::or b), c", both(either(tag("a"), tag("b")), tag("c"))),
+    ("((a))", tag("a")),
+])
+def test_precedence(search, expected):
+    assert search_string_parser(search).base_operator == expected
+
+
+def test_names_collected():
+    ast = search_string_parser("a, ::instance::b ::or ::under::c, ::name::equals::x, ::has::author")
+    assert ast.tag_names == {"a", "b", "c"}
+    assert ast.under_names == {"c"}
+    assert ast.attribute_names == {"name", "author"}
+
+
+def test_equal_searches_have_equal_trees():
+    assert search_string_parser("A,  b") == search_string_parser("a ::and B")
+    assert hash(search_string_parser("A,  b")) == hash(search_string_parser("a ::and B"))
+
+
+@pytest.mark.parametrize("search, error", [
+    ("", EmptySearch),
+    ("   ", EmptySearch),
+    ("a ::and ::and b", UnexpectedOperator),
+    ("a ::or", UnexpectedOperator),
+    ("::and a", UnexpectedOperator),
+    ("a ::not b", UnexpectedTag),
+    ("(a, b", MissingCloseBracket),
+    ("a, b)", UnexpectedCloseBracket),
+    (")", UnexpectedCloseBracket),
+])
+def test_syntax_errors(search, error):
+    assert isinstance(search_string_parser(search), error)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("a", ItemTagValue),
+    ("::instance::a", InstanceTagValue),
+    ("::under::a", UnderItemTagValue),
+    ("::has::author", HasItemAttributeValue),
+    ("::name::equals::Bob", CheckItemAttributeValue),
+    ("::name::startswith::b", CheckItemAttributeValue),
+    ("::name::endswith::b", CheckItemAttributeValue),
+    ("::players::between::3..5", CheckItemAttributeValue),
+    ("::instance::players::gt::3", CheckInstanceAttributeValue),
+])
+def test_value_parse(value, expected):
+    assert type(Value.parse(value)) is expected
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("a", True),
+    ("::instance::under::a ::or -(b, c)", True),
+    ("::has::author", False),
+    ("a, (b ::or -::name::equals::x)", False),
+])
+def test_tags_only(search, expected):
+    assert search_string_parser(search).base_operator.tags_only() == expected
+
+
+def test_value_parse_check():
+    value = Value.parse("::players::between:: 3 .. 5")
+    assert value.attribute_name == "players"
+    assert value.check_mode == CheckMode.Between
+
+
+@pytest.mark.parametrize("value", [
+    "::players::gt::three",
+    "::players::lt::",
+    "::players::gt::3.5",
+    "::players::between::3",
+    "::players::between::3..five",
+])
+def test_value_parse_invalid_number(value):
+    assert isinstance(Value.parse(value), InvalidNumber)
+    assert isinstance(search_string_parser(value), InvalidNumber)
+
+
+@pytest.mark.parametrize("search", [
+    "::players::gt::x, a",
+    "a, ::players::gt::x",
+    "::players::gt::x",
+    "(a ::or -::players::gt::x), b",
+])
+def test_invalid_number_in_search(search):
+    # wherever it is in the search, the error is returned rather than put in the tree
+    assert isinstance(search_string_parser(search), InvalidNumber)
+
+
+def test_too_deep():
+    depth = SearchLimits.max_depth
+    assert not isinstance(search_string_parser("(" * (depth - 1) + "a" + ")" * (depth - 1)), SearchStringParseError)
+    assert isinstance(search_string_parser("(" * depth + "a" + ")" * depth), SearchTooComplex)
+    assert isinstance(search_string_parser("::not " * depth + "a"), SearchTooComplex)
+
+
+def test_too_many_terms():
+    terms = SearchLimits.max_terms
+    assert not isinstance(search_string_parser(", ".join(["a"] * terms)), SearchStringParseError)
+    assert isinstance(search_string_parser(", ".join(["a"] * (terms + 1))), SearchTooComplex)
+
+
+@pytest.mark.parametrize("search, term, expected", [
+    ("a", "b", both(tag("a"), tag("b"))),
+    # the search is bracketed so the term narrows all of it
+    ("a ::or b", "c", both(either(tag("a"), tag("b")), tag("c"))),
+    # names with operators and brackets in them stay whole
+    ("a", "x, y", both(tag("a"), tag("x, y"))),
+    ("a", "spider-man (1967) ::or more", both(tag("a"), tag("spider-man (1967) ::or more"))),
+    ("a", "::instance::dune (1984) - remastered", both(tag("a"), tag("::instance::dune (1984) - remastered"))),
+])
+def test_narrow_search(search, term, expected):
+    assert search_string_parser(narrow_search(search, term)).base_operator == expected
+
+
+def _random_query(rng, depth):
+    if depth == 0 or rng.random() < 0.3:
+        field = rng.choice(["all_tags", "instances.all_tags"])
+        value = rng.randrange(6)
+        return {field: {"$ne": value}} if rng.random() < 0.3 else {field: value}
+    terms = [_random_query(rng, depth - 1) for _ in range(rng.randint(1, 4))]
+    return {rng.choice(["$and", "$or"]): terms}
+
+
+def test_optimize_query_equivalent(mongo):
+    rng = random.Random(12)
+    for i in range(200):
+        mongo.db.items.insert_one({"all_tags": rng.sample(range(6), rng.randint(0, 4)),
+                                   "instances": [{"all_tags": rng.sample(range(6), rng.randint(0, 2))}]})
+    tag_counts = {t: mongo.db.items.count_documents({"all_tags": t}) for t in range(6)}
+
+    for i in range(300):
+        query = _random_query(rng, 4)
+        expected = sorted(d["_id"] for d in mongo.db.items.find(query))
+        for optimized in [optimize_query(query), optimize_query(query, tag_counts, 200)]:
+            assert sorted(d["_id"] for d in mongo.db.items.find(optimized)) == expected, (query, optimized)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ({"$and": [{"$and": [{"all_tags": 1}, {"all_tags": 2}]}, {"all_tags": 1}]}, {"all_tags": {"$all": [1, 2]}}),
+    ({"$or": [{"all_tags": 1}, {"$or": [{"all_tags": 2}]}]}, {"all_tags": {"$in": [1, 2]}}),
+    ({"$and": [{"all_tags": {"$ne": 1}}, {"all_tags": {"$ne": 2}}]}, {"all_tags": {"$nin": [1, 2]}}),
+    ({"$and": [{"all_tags": 1}]}, {"all_tags": 1}),
+])
+def test_optimize_query_flattens_and_merges(query, expected):
+    assert optimize_query(query) == expected
@@ -17,11 +17,86 @@ app.config['SECRET_KEY'] = 'this should be a password but whatever'
 
 app.config["MONGO_URI"] = "mongodb://localhost:27017/unigames_webapp_db"
 
+#Whether the database is migrated when the app starts if it's out of date, otherwise run `flask migrate-database`
+app.config["MIGRATE_ON_STARTUP"] = True
+
+#How often (in seconds) implied tags are checked for drift in the background, 0 to disable.
+#Only one process sharing the database checks at a time
+app.config["IMPLIED_TAG_CHECK_INTERVAL"] = 60 * 60
+#Whether the check fixes the drift it finds, otherwise it's logged for `flask rebuild-implied-tags` to fix
+app.config["IMPLIED_TAG_CHECK_REPAIR"] = False
+
+#The default and maximum number of items on each page of the library
+app.config["LIBRARY_PAGE_SIZE"] = 50
+app.config["LIBRARY_MAX_PAGE_SIZE"] = 500
+
+#How long (in seconds) a loaded user is cached for, changes to the users are picked up straight away
+app.config["USER_CACHE_TTL"] = 30
+
+#Whether to explain the important queries on startup, and warn about the ones that aren't using an index
+app.config["INDEX_AUDIT_ON_STARTUP"] = True
+
+#How many compiled searches are cached, and for how long (in seconds)
+app.config["SEARCH_CACHE_SIZE"] = 256
+app.config["SEARCH_CACHE_TTL"] = 5 * 60
+
+#The limits on a single search: how deeply it can be nested, how many terms it can have,
+#how big (in bytes) its MongoDB filter can be, and how long (in milliseconds) MongoDB can spend on it
+app.config["SEARCH_MAX_DEPTH"] = 32
+app.config["SEARCH_MAX_TERMS"] = 256
+app.config["SEARCH_MAX_FILTER_BYTES"] = 64 * 1024
+app.config["SEARCH_MAX_TIME_MS"] = 2000
+
+#Whether searches are evaluated against an in-memory index of every item instead of by MongoDB
+app.config["IN_MEMORY_SEARCH"] = False
+
+#Where the shared search index file is kept, None to build it in every process, and how often (in seconds) it's rebuilt
+app.config["SEARCH_INDEX_PATH"] = None
+app.config["SEARCH_INDEX_BUILD_INTERVAL"] = 10
+
 db_manager = DatabaseManager(app)
 db_manager.test()
 
+from app.search_parser import CompiledQueryCache
+search_cache = CompiledQueryCache.for_mongo(db_manager.mongo)
+search_cache.max_size = app.config["SEARCH_CACHE_SIZE"]
+search_cache.ttl = app.config["SEARCH_CACHE_TTL"]
+
+from app.search_parser import SearchLimits
+SearchLimits.max_depth = app.config["SEARCH_MAX_DEPTH"]
+SearchLimits.max_terms = app.config["SEARCH_MAX_TERMS"]
+SearchLimits.max_filter_bytes = app.config["SEARCH_MAX_FILTER_BYTES"]
+SearchLimits.max_time_ms = app.config["SEARCH_MAX_TIME_MS"]
+
+#searches for only tags use a bit matrix instead, when numpy is installed
+from app.database_impl.tag_matrix import TagMatrix
+tag_matrix = TagMatrix.for_mongo(db_manager.mongo)
+tag_matrix.enabled = app.config["IN_MEMORY_SEARCH"] and TagMatrix.available
+
+#the bit matrix can instead be built into a file that every process maps, so it's only kept in memory once.
+#then no process keeps an index of every item, searches the file can't answer (such as ones for attributes,
+#or any while the file is waiting to be rebuilt) are run by MongoDB
+if tag_matrix.enabled and app.config["SEARCH_INDEX_PATH"]:
+    tag_matrix.path = app.config["SEARCH_INDEX_PATH"]
+
+from app.database_impl.item_index import ItemIndex
+ItemIndex.for_mongo(db_manager.mongo).enabled = app.config["IN_MEMORY_SEARCH"] and tag_matrix.path is None
+
+if app.config["INDEX_AUDIT_ON_STARTUP"]:
+    from app.index_audit import log_index_audit
+    log_index_audit(app, db_manager.mongo)
+
+#background threads are only started by processes serving requests, not by flask CLI commands
+@app.before_first_request
+def start_background_threads():
+    if app.config["IMPLIED_TAG_CHECK_INTERVAL"]:
+        db_manager.start_implied_tag_checker(app, app.config["IMPLIED_TAG_CHECK_INTERVAL"],
+                                             app.config["IMPLIED_TAG_CHECK_REPAIR"])
+    if tag_matrix.path:
+        db_manager.start_search_index_builder(app, tag_matrix.path, app.config["SEARCH_INDEX_BUILD_INTERVAL"])
+
 #create Bootstrap object for easy form implementation
 bootstrap = Bootstrap(app)
 
-from app import routes
+from app import routes, commands
 
@@ -0,0 +1,75 @@
+import timeit
+
+import click
+
+from app import app, db_manager
+from app.database_impl.items_instances import Item
+from app.database_impl.migrations import migrate, schema_version
+from app.database_impl.tag_matrix import TagMatrix
+from app.index_audit import audit_indices
+from app.search_parser import search_string_lexer
+
+
+@app.cli.command("rebuild-implied-tags")
+def rebuild_implied_tags():
+    """
+    Recalculates the implied tags of every item and instance inside MongoDB,
+    for use after bulk imports or repairs to the tags
+    """
+    changed, elapsed = Item.rebuild_all_implied_tags(db_manager.mongo)
+    click.echo("Implied tags rebuilt in {:.2f}s, {} items and instances changed".format(elapsed, changed))
+
+
+@app.cli.command("migrate-database")
+def migrate_database():
+    """
+    Brings the data in the database up to date with how it's stored now, such as after an upgrade
+    """
+    if migrate(db_manager.mongo, click.echo):
+        click.echo("The database is up to date, at version {}".format(schema_version(db_manager.mongo)))
+    else:
+        click.echo("Another process is migrating the database")
+
+
+@app.cli.command("audit-indices")
+def audit_indices_command():
+    """
+    Explains every query the webapp relies on being indexed, and lists the ones doing a collection scan
+    """
+    scans = audit_indices(db_manager.mongo)
+    for description, collection, query in scans:
+        click.echo("COLLSCAN: {} on {}, query: {}".format(description, collection, query))
+    click.echo("{} queries not using an index".format(len(scans)))
+
+
+@app.cli.command("build-search-index")
+@click.argument("path", required=False)
+def build_search_index(path):
+    """
+    Builds the shared search index file, by default at SEARCH_INDEX_PATH
+    """
+    path = path or app.config["SEARCH_INDEX_PATH"]
+    if not path:
+        raise click.UsageError("no path given and SEARCH_INDEX_PATH is not set")
+    if not TagMatrix.available:
+        raise click.ClickException("numpy is needed to build the search index")
+
+    matrix = TagMatrix(db_manager.mongo)
+    elapsed = timeit.timeit(matrix.build, number=1)
+    matrix.write_file(path)
+    click.echo("Search index of {} items built in {:.2f}s".format(len(matrix.item_ids), elapsed))
+
+
+@app.cli.command("benchmark-lexer")
+@click.option("--max-kb", default=64, help="The length of the longest search string, in KB")
+def benchmark_lexer(max_kb):
+    """
+    Times the search string lexer on doubling lengths of pasted queries, the time per KB should stay flat
+    """
+    unit = "board game, players ::or {two: player} ::and -war, (card ::or dice), "
+    kb = 1
+    while kb <= max_kb:
+        search_string = (unit * (kb * 1024 // len(unit) + 1))[:kb * 1024]
+        elapsed = min(timeit.repeat(lambda: search_string_lexer(search_string), number=5, repeat=3)) / 5
+        click.echo("{:>5} KB: {:8.2f}ms, {:6.1f}us per KB".format(kb, elapsed * 1000, elapsed * 1e6 / kb))
+        kb *= 2
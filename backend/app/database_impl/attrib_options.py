@@ -6,6 +6,8 @@ import pymongo
 from bson import ObjectId
 from flask_pymongo import PyMongo
 
+from app.database_impl.generations import bump_generation
+
 
 class AttributeTypes(IntEnum):
     """
@@ -19,6 +21,68 @@ class AttributeTypes(IntEnum):
     # TODO: Add more supported types, such as pictures, UUID and some other stuff
 
 
+def fold_value(value: Union[str, List[str], None]) -> Union[str, List[str], None]:
+    """
+    Gets the lowercase form of a string attribute value, stored alongside the value as "folded" so
+    case-insensitive and prefix searches can use an index
+
+    Parameters
+    ----------
+        value
+            The value of the attribute, a string or a list of lines
+
+    Returns
+    -------
+        The value in lowercase, or None if it isn't a string or a list of strings
+    """
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return [v.lower() for v in value]
+    return None
+
+
+def reverse_fold_value(value: Union[str, List[str], None]) -> Union[str, List[str], None]:
+    """
+    Gets the lowercase form of a string attribute value written backwards, stored alongside the value as
+    "folded_reversed" so suffix searches can be made into prefix searches, which can use an index
+
+    Parameters
+    ----------
+        value
+            The value of the attribute, a string or a list of lines
+
+    Returns
+    -------
+        The value in lowercase with every line reversed, or None if it isn't a string or a list of strings
+    """
+    folded = fold_value(value)
+    if isinstance(folded, list):
+        return [line[::-1] for line in folded]
+    if folded is None:
+        return None
+    return folded[::-1]
+
+
+def trigrams(value: Union[str, List[str], None]) -> List[str]:
+    """
+    Gets every three character substring of the lowercase form of a string attribute value, stored alongside
+    the value as "trigrams" so substring searches only have to check the values that have all of the search's
+
+    Parameters
+    ----------
+        value
+            The value of the attribute, a string or a list of lines
+
+    Returns
+    -------
+        The trigrams in sorted order, without repeats, empty if the value isn't a string or a list of strings
+    """
+    folded = fold_value(value)
+    lines = folded if isinstance(folded, list) else [] if folded is None else [folded]
+    return sorted({line[i:i + 3] for line in lines for i in range(len(line) - 2)})
+
+
 class Attribute(metaclass=abc.ABCMeta):
     """
     A class for item attibutes
@@ -106,7 +170,8 @@ class SingleLineStringAttribute(Attribute):
         -------
             The MongoDB compliant data structure
         """
-        return {**super().to_dict(), "value": self.value}
+        return {**super().to_dict(), "value": self.value, "folded": fold_value(self.value),
+                "folded_reversed": reverse_fold_value(self.value), "trigrams": trigrams(self.value)}
 
 
 class MultiLineStringAttribute(Attribute):
@@ -126,7 +191,8 @@ class MultiLineStringAttribute(Attribute):
         -------
             The MongoDB compliant data structure
         """
-        return {**super().to_dict(), "value": self.value}
+        return {**super().to_dict(), "value": self.value, "folded": fold_value(self.value),
+                "folded_reversed": reverse_fold_value(self.value), "trigrams": trigrams(self.value)}
 
 
 class SingleLineIntegerAttribute(Attribute):
@@ -170,6 +236,8 @@ class PictureAttribute(Attribute):
 
 
 class AttributeOption:
+    GENERATION_NAME = "attrib_options"
+
     id: ObjectId = None
     """
     The attribute id
@@ -264,6 +332,8 @@ class AttributeOption:
             self.id = mongo.db.attrib_options.insert_one(self.to_dict()).inserted_id
         else:
             mongo.db.attrib_options.find_one_and_replace({"_id": self.id}, self.to_dict())
+            # searches that were compiled against the old version are now stale
+            bump_generation(mongo, AttributeOption.GENERATION_NAME)
 
     # Returns True if the update worked, else False, usually meaning it's no longer there
     def update_from_db(self, mongo: PyMongo) -> bool:
@@ -311,7 +381,10 @@ class AttributeOption:
         if self.id is None:
             return False
 
-        return mongo.db.attrib_options.delete_one({"_id": self.id}).deleted_count == 1
+        deleted = mongo.db.attrib_options.delete_one({"_id": self.id}).deleted_count == 1
+        if deleted:
+            bump_generation(mongo, AttributeOption.GENERATION_NAME)
+        return deleted
 
     @staticmethod
     def search_for_by_name(mongo: PyMongo, attribute_name: str) -> Optional['AttributeOption']:
@@ -0,0 +1,66 @@
+from typing import Dict, List
+
+from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
+
+
+def get_generation(mongo: PyMongo, name: str) -> int:
+    """
+    Reads the generation counter of a cached collection, used by every process to tell if its cache is stale
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        name
+            The name of the counter
+
+    Returns
+    -------
+        The current generation, 0 if the counter has never been bumped
+    """
+    result = mongo.db.generations.find_one({"_id": name}, {"generation": 1})
+    if result is None:
+        return 0
+    return result["generation"]
+
+
+def get_generations(mongo: PyMongo, names: List[str]) -> Dict[str, int]:
+    """
+    Reads several generation counters with a single query
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        names
+            The names of the counters
+
+    Returns
+    -------
+        A dictionary from name to the current generation of every counter
+    """
+    result = {name: 0 for name in names}
+    for counter in mongo.db.generations.find({"_id": {"$in": names}}, {"generation": 1}):
+        result[counter["_id"]] = counter["generation"]
+    return result
+
+
+def bump_generation(mongo: PyMongo, name: str) -> int:
+    """
+    Increments the generation counter of a cached collection, making every process' cache of it stale
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        name
+            The name of the counter
+
+    Returns
+    -------
+        The new generation
+    """
+    result = mongo.db.generations.find_one_and_update({"_id": name}, {"$inc": {"generation": 1}},
+                                                      upsert=True, return_document=ReturnDocument.AFTER)
+    return result["generation"]
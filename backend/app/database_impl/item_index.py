@@ -0,0 +1,441 @@
+from threading import RLock
+from typing import Dict, Set, List, Optional, Any, Iterable, Tuple
+
+from bson import ObjectId
+from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
+
+from app.database_impl.attrib_options import trigrams
+from app.database_impl.generations import get_generation
+
+# the fields of the items that are indexed
+_INDEXED_FIELDS = {"hidden": 1, "all_tags": 1, "attributes": 1, "instances.all_tags": 1, "instances.attributes": 1}
+
+
+class ItemIndex:
+    """
+    An optional in-memory inverted index of every item, with a posting list (set of item ids) for each tag
+    and attribute option, so searches can be evaluated with set algebra instead of a MongoDB query.
+    Every write to the items bumps a generation counter in the database along with the ids of the items it changed,
+    other processes notice the counter has changed in `validate` and re-read only those items
+    """
+
+    GENERATION_NAME = "items"
+
+    CHANGES_KEPT = 1000
+    """
+    How many of the latest generations' changed items are kept, a process further behind than this reloads every item
+    """
+
+    MAX_CHANGED_IDS = 1000
+    """
+    The most item ids recorded for a single generation, a bigger change makes every process reload every item
+    """
+
+    _indices: Dict[int, 'ItemIndex'] = {}
+
+    mongo: PyMongo
+    """
+    The mongo database the items are loaded from
+    """
+
+    enabled: bool = False
+    """
+    Whether the index is in use, when False it is never loaded and writes don't touch it
+    """
+
+    generation: Optional[int] = None
+    """
+    The generation of the items that have been loaded, None if they have not been loaded yet
+    """
+
+    items: Set[ObjectId] = set()
+    """
+    The id of every item
+    """
+
+    hidden: Set[ObjectId] = set()
+    """
+    The id of every hidden item
+    """
+
+    item_tags: Dict[ObjectId, Set[ObjectId]] = {}
+    """
+    The items with each tag, explicit or implied, by tag id
+    """
+
+    instance_tags: Dict[ObjectId, Set[ObjectId]] = {}
+    """
+    The items with an instance with each tag, explicit or implied, by tag id
+    """
+
+    item_attributes: Dict[ObjectId, Dict[ObjectId, List[Any]]] = {}
+    """
+    The values of each attribute option, by option id then by the id of the item they belong to
+    """
+
+    instance_attributes: Dict[ObjectId, Dict[ObjectId, List[Any]]] = {}
+    """
+    The values of each instance attribute option, by option id then by the id of the item the instance belongs to
+    """
+
+    item_trigrams: Dict[ObjectId, Dict[str, Set[ObjectId]]] = {}
+    """
+    The items with a value of each attribute option containing each trigram, by option id then by trigram
+    """
+
+    instance_trigrams: Dict[ObjectId, Dict[str, Set[ObjectId]]] = {}
+    """
+    The items with an instance with a value of each attribute option containing each trigram, by option id then by trigram
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.enabled = False
+        self.generation = None
+        self._clear()
+        self.lock = RLock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'ItemIndex':
+        """
+        Gets the index for a database, creating an (unloaded) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The index for the database
+        """
+        index = ItemIndex._indices.get(id(mongo))
+        if index is None:
+            index = ItemIndex._indices.setdefault(id(mongo), ItemIndex(mongo))
+        return index
+
+    def _clear(self):
+        self.items = set()
+        self.hidden = set()
+        self.item_tags = {}
+        self.instance_tags = {}
+        self.item_attributes = {}
+        self.instance_attributes = {}
+        self.item_trigrams = {}
+        self.instance_trigrams = {}
+        self._entries: Dict[ObjectId, Dict] = {}
+
+    def _add(self, item_dict: Dict):
+        item_id = item_dict["_id"]
+        instances = item_dict.get("instances") or []
+
+        # remember what was indexed, so it can be taken out again without the old document
+        entry = {
+            "hidden": bool(item_dict.get("hidden")),
+            "item_tags": set(item_dict.get("all_tags") or []),
+            "instance_tags": {t for inst in instances for t in inst.get("all_tags") or []},
+            "item_attributes": {},
+            "instance_attributes": {},
+            "item_trigrams": {},
+            "instance_trigrams": {},
+        }
+        for a in item_dict.get("attributes") or []:
+            entry["item_attributes"].setdefault(a["option_id"], []).append(a.get("value"))
+            entry["item_trigrams"].setdefault(a["option_id"], set()).update(trigrams(a.get("value")))
+        for inst in instances:
+            for a in inst.get("attributes") or []:
+                entry["instance_attributes"].setdefault(a["option_id"], []).append(a.get("value"))
+                entry["instance_trigrams"].setdefault(a["option_id"], set()).update(trigrams(a.get("value")))
+
+        self._entries[item_id] = entry
+        self.items.add(item_id)
+        if entry["hidden"]:
+            self.hidden.add(item_id)
+        for field in ["item_tags", "instance_tags"]:
+            postings = getattr(self, field)
+            for tag_id in entry[field]:
+                postings.setdefault(tag_id, set()).add(item_id)
+        for field in ["item_attributes", "instance_attributes"]:
+            postings = getattr(self, field)
+            for option_id, values in entry[field].items():
+                postings.setdefault(option_id, {})[item_id] = values
+        for field in ["item_trigrams", "instance_trigrams"]:
+            postings = getattr(self, field)
+            for option_id, grams in entry[field].items():
+                if not grams:
+                    # values without trigrams, such as numbers
+                    continue
+                option_postings = postings.setdefault(option_id, {})
+                for gram in grams:
+                    option_postings.setdefault(gram, set()).add(item_id)
+
+    def _remove(self, item_id: ObjectId):
+        entry = self._entries.pop(item_id, None)
+        if entry is None:
+            return
+
+        self.items.discard(item_id)
+        self.hidden.discard(item_id)
+        for field in ["item_tags", "instance_tags"]:
+            postings = getattr(self, field)
+            for tag_id in entry[field]:
+                postings[tag_id].discard(item_id)
+                if not postings[tag_id]:
+                    del postings[tag_id]
+        for field in ["item_attributes", "instance_attributes"]:
+            postings = getattr(self, field)
+            for option_id in entry[field]:
+                postings[option_id].pop(item_id, None)
+                if not postings[option_id]:
+                    del postings[option_id]
+        for field in ["item_trigrams", "instance_trigrams"]:
+            postings = getattr(self, field)
+            for option_id, grams in entry[field].items():
+                if not grams:
+                    continue
+                for gram in grams:
+                    postings[option_id][gram].discard(item_id)
+                    if not postings[option_id][gram]:
+                        del postings[option_id][gram]
+                if not postings[option_id]:
+                    del postings[option_id]
+
+    def validate(self, generation: Optional[int] = None):
+        """
+        Checks the generation counter in the database, re-reading the items other processes have changed since.
+        This costs a single read of the counter if nothing has changed, and nothing if the index isn't enabled
+
+        Parameters
+        ----------
+            generation
+                The current generation, if it has already been read from the database
+        """
+        if not self.enabled:
+            return
+        if generation is None:
+            generation = get_generation(self.mongo, ItemIndex.GENERATION_NAME)
+        with self.lock:
+            if generation == self.generation:
+                return
+            if self.generation is None or not self._catch_up(generation):
+                self._load()
+
+    def _load(self):
+        # the generation is read first, so anything written while loading is caught up on afterwards
+        generation = get_generation(self.mongo, ItemIndex.GENERATION_NAME)
+        self._clear()
+        for item_dict in self.mongo.db.items.find({}, _INDEXED_FIELDS):
+            self._add(item_dict)
+        self.generation = generation
+
+    def _catch_up(self, generation: int) -> bool:
+        """
+        Re-reads only the items changed since the index was loaded, using the ids recorded with each generation
+
+        Parameters
+        ----------
+            generation
+                The current generation, more recent changes may be caught up on too
+
+        Returns
+        -------
+            True if the index is up to date, False if the changes it is missing are no longer recorded
+        """
+        changes = ItemIndex.changed_since(self.mongo, self.generation, generation)
+        if changes is None:
+            return False
+        generation, changed = changes
+
+        for item_id in changed:
+            self._remove(item_id)
+        for item_dict in self.mongo.db.items.find({"_id": {"$in": list(changed)}}, _INDEXED_FIELDS):
+            self._add(item_dict)
+        self.generation = generation
+        return True
+
+    @staticmethod
+    def changed_since(mongo: PyMongo, since: int, generation: int) -> Optional[Tuple[int, Set[ObjectId]]]:
+        """
+        Finds the items changed since a generation of the items, from the ids recorded with each generation
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            since
+                The generation to find the changes since
+            generation
+                The current generation, more recent changes may be found too
+
+        Returns
+        -------
+            The generation the changes go up to and the ids of the changed items, which may no longer exist,
+            or None if some of the changes are no longer recorded
+        """
+        behind = generation - since
+        if behind < 0 or behind > ItemIndex.CHANGES_KEPT:
+            return None
+
+        # a few extra in case more have been written since the counter was read
+        counter = mongo.db.generations.find_one({"_id": ItemIndex.GENERATION_NAME},
+                                                {"generation": 1, "changes": {"$slice": -(behind + 16)}})
+        if counter is None:
+            return None
+        behind = counter["generation"] - since
+        changes = counter.get("changes") or []
+        if behind > len(changes):
+            return None
+
+        changed = set()
+        for item_ids in changes[len(changes) - behind:]:
+            if item_ids is None:
+                # a change to too many items to record
+                return None
+            changed.update(item_ids)
+        return counter["generation"], changed
+
+    @staticmethod
+    def bump_generation(mongo: PyMongo, item_ids: Optional[Iterable[ObjectId]] = None) -> int:
+        """
+        Increments the generation counter of the items after a write, recording which items it changed
+        so other processes only have to re-read them
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            item_ids
+                The items that were written or deleted, None if it could have been any of them
+
+        Returns
+        -------
+            The new generation
+        """
+        if item_ids is not None:
+            item_ids = list(item_ids)
+            if len(item_ids) > ItemIndex.MAX_CHANGED_IDS:
+                item_ids = None
+        result = mongo.db.generations.find_one_and_update(
+            {"_id": ItemIndex.GENERATION_NAME},
+            {"$inc": {"generation": 1},
+             "$push": {"changes": {"$each": [item_ids], "$slice": -ItemIndex.CHANGES_KEPT}}},
+            {"generation": 1}, upsert=True, return_document=ReturnDocument.AFTER)
+        return result["generation"]
+
+    @staticmethod
+    def items_changed(mongo: PyMongo, item_ids: Optional[Iterable[ObjectId]] = None):
+        """
+        Marks items as changed, after a bulk write to the items, so every process re-reads them
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            item_ids
+                The items that were changed, None if it could have been any of them
+        """
+        generation = ItemIndex.bump_generation(mongo, item_ids)
+        ItemIndex.for_mongo(mongo).validate(generation)
+
+    def written(self, item_dict: Dict, generation: int):
+        """
+        Patches the index after this process has written an item to the database
+
+        Parameters
+        ----------
+            item_dict
+                The item that was written, as stored in the database
+            generation
+                The generation the write bumped the counter to
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.generation is None:
+                return
+            if generation != self.generation + 1:
+                # someone else has written in the meantime, so there is more to catch up on than this item
+                self.validate(generation)
+                return
+
+            self._remove(item_dict["_id"])
+            self._add(item_dict)
+            self.generation = generation
+
+    def removed(self, item_id: ObjectId, generation: int):
+        """
+        Patches the index after this process has deleted an item from the database
+
+        Parameters
+        ----------
+            item_id
+                The item that was deleted
+            generation
+                The generation the delete bumped the counter to
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.generation is None:
+                return
+            if generation != self.generation + 1:
+                self.validate(generation)
+                return
+
+            self._remove(item_id)
+            self.generation = generation
+
+    def substring_candidates(self, option_id: ObjectId, value: str, instance: bool = False) -> Optional[Set[ObjectId]]:
+        """
+        Finds the items that might have a value of an attribute option containing a string, by intersecting
+        the items with each of the string's trigrams. The candidates still have to be checked, the index must be locked
+
+        Parameters
+        ----------
+            option_id
+                The attribute option
+            value
+                The string that must be in the value
+            instance
+                True to find the items with an instance with such a value, instead of the items themselves
+
+        Returns
+        -------
+            The candidate items, or None if the string is too short to have any trigrams
+        """
+        grams = trigrams(value)
+        if not grams:
+            return None
+        postings = (self.instance_trigrams if instance else self.item_trigrams).get(option_id, {})
+        sets = sorted((postings.get(gram, set()) for gram in grams), key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def count_tags(self, item_ids: Set[ObjectId], instance: bool = False) -> Dict[ObjectId, int]:
+        """
+        Counts how many of some items have each tag, the index must be locked
+
+        Parameters
+        ----------
+            item_ids
+                The items to count
+            instance
+                True to count the items with an instance with each tag, instead of the items themselves
+
+        Returns
+        -------
+            A dictionary from tag id to the number of the items with it, for every tag at least one of them has
+        """
+        result = {}
+        for tag_id, postings in (self.instance_tags if instance else self.item_tags).items():
+            count = len(postings & item_ids)
+            if count:
+                result[tag_id] = count
+        return result
+
+    def ensure_loaded(self):
+        """
+        Loads the index if it hasn't been loaded yet, or was thrown away by a write
+        """
+        if self.generation is None:
+            self.validate()
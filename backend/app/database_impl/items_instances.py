@@ -1,14 +1,45 @@
-from typing import Dict, List, Union, Optional
+import time
+from typing import Dict, List, Union, Optional, Tuple
 
 import pymongo
 from bson import ObjectId
 from flask_pymongo import PyMongo
 
 from app.database_impl.attrib_options import AttributeOption, Attribute
-from app.database_impl.relations import Relation, RelationOption
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.relations import Relation, RelationOption, RelationType
+from app.database_impl.tag_graph import TagGraph
 from app.database_impl.tags import Tag, TagReference
 
 
+def all_tags(tags: List[ObjectId], implied_tags: List[ObjectId]) -> List[ObjectId]:
+    """
+    Combines the explicit and implied tags of an item or instance into the denormalized `all_tags` field,
+    which lets a tag search use a single index instead of an $or over both fields
+
+    Parameters
+    ----------
+        tags
+            The ids of the explicit tags
+        implied_tags
+            The ids of the implied tags
+
+    Returns
+    -------
+        The ids of every tag, without duplicates
+    """
+    result = list(tags)
+    result.extend(t for t in implied_tags if t not in result)
+    return result
+
+
+def all_tags_expression(tags: Union[str, Dict], implied_tags: Union[str, Dict]) -> Dict:
+    """
+    The aggregation expression equivalent to `all_tags`, for calculating the field inside MongoDB
+    """
+    return {"$setUnion": [{"$ifNull": [tags, []]}, {"$ifNull": [implied_tags, []]}]}
+
+
 class Item:
     """
     A class to represent an item in the library
@@ -46,10 +77,17 @@ class Item:
 
     @staticmethod
     def init_indices(mongo: PyMongo):
+        # existing items are brought up to date by the migrations in migrations.py
         mongo.db.items.create_index([("hidden", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("tags.tag_id", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("implied_tags.tag_id", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("attributes.option_id", pymongo.ASCENDING)], unique=False, sparse=True)
+        mongo.db.items.create_index([("all_tags", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("attributes.option_id", pymongo.ASCENDING), ("attributes.value", pymongo.ASCENDING)],
+                                    unique=False, sparse=False)
+        mongo.db.items.create_index([("attributes.option_id", pymongo.ASCENDING), ("attributes.folded", pymongo.ASCENDING)],
+                                    unique=False, sparse=False)
+        mongo.db.items.create_index([("attributes.option_id", pymongo.ASCENDING),
+                                     ("attributes.folded_reversed", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("attributes.option_id", pymongo.ASCENDING), ("attributes.trigrams", pymongo.ASCENDING)],
+                                    unique=False, sparse=False)
 
     # NOTE: attributes must conform an ItemAttributeOption, however that is not checked here
     def __init__(self, attributes: List[Attribute], tags: List[TagReference], instances: List['Instance'], hidden: bool = False):
@@ -80,6 +118,7 @@ class Item:
             "implied_tags": [i.tag_id for i in self.implied_tags],
             "instances": [inst.to_dict() for inst in self.instances]
         }
+        result["all_tags"] = all_tags(result["tags"], result["implied_tags"])
         if self.hidden:
             result["hidden"] = True
 
@@ -152,10 +191,12 @@ class Item:
             mongo
                 The mongo database
         """
+        item_dict = self.to_dict()
         if self.id is None:
-            self.id = mongo.db.items.insert_one(self.to_dict()).inserted_id
+            self.id = item_dict["_id"] = mongo.db.items.insert_one(item_dict).inserted_id
         else:
-            mongo.db.items.find_one_and_replace({"_id": self.id}, self.to_dict())
+            mongo.db.items.find_one_and_replace({"_id": self.id}, item_dict)
+        ItemIndex.for_mongo(mongo).written(item_dict, ItemIndex.bump_generation(mongo, [self.id]))
 
     # Returns True if the update worked, else False, usually meaning it's no longer there
     def update_from_db(self, mongo: PyMongo) -> bool:
@@ -224,24 +265,10 @@ class Item:
 
         self.implied_tags = [implied for option in relation_options for implied in option.implies]
 
-        # traverse implication DAG
-        to_search = set(t.tag_id for t in self.tags).union(t.tag_id for t in self.implied_tags)
-        searched = set(to_search)
-
-        while to_search:
-            top_level = mongo.db.tags.find({"_id": {"$in": list(to_search)}})
-            to_search = set()
-            if top_level is None:
-                break
-
-            tags = [Tag.from_dict(tag) for tag in top_level]
-
-            for tag in tags:
-                for implied in tag.implies:
-                    if implied.tag_id not in searched:
-                        searched.add(implied.tag_id)
-                        to_search.add(implied.tag_id)
-                        self.implied_tags.append(implied)
+        # get implied from the implication DAG's closure
+        implied = TagGraph.for_mongo(mongo).implied_tags(
+            [t.tag_id for t in self.tags] + [t.tag_id for t in self.implied_tags])
+        self.implied_tags.extend(TagReference(t) for t in implied)
 
         if inherit:
             possibilities = set()
@@ -279,6 +306,8 @@ class Item:
         else:
             to_visit = index
 
+        graph = TagGraph.for_mongo(mongo)
+
         for i in to_visit:
             inst = self.instances[i]
 
@@ -291,27 +320,255 @@ class Item:
 
             inst.implied_tags = [implied for option in relation_options for implied in option.implies]
 
-            # traverse implication DAG
-            to_search = set(t.tag_id for t in inst.tags).union(t.tag_id for t in inst.implied_tags)
-            searched = set(to_search)
+            # get implied from the implication DAG's closure
+            implied = graph.implied_tags([t.tag_id for t in inst.tags] + [t.tag_id for t in inst.implied_tags])
+            inst.implied_tags.extend(TagReference(t) for t in implied)
+
+        self.write_to_db(mongo)
+        return True
 
-            while to_search:
-                top_level = mongo.db.tags.find({"_id": {"$in": list(to_search)}})
-                to_search = set()
-                if top_level is None:
-                    break
+    @staticmethod
+    def propagate_implication_change(mongo: PyMongo, tag_ids: Union[ObjectId, List[ObjectId]]) -> int:
+        """
+        Recalculates the implied tags of only the items and instances affected by a change to the
+        implications of some tags, and writes every change in a single bulk write.
+        The tags must already have been written with `Tag.write_to_db`
 
-                tags = [Tag.from_dict(tag) for tag in top_level]
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            tag_ids
+                The tags whose implications were added or removed
+
+        Returns
+        -------
+            The number of items that were modified
+        """
+        if isinstance(tag_ids, ObjectId):
+            tag_ids = [tag_ids]
 
-                for tag in tags:
-                    for implied in tag.implies:
-                        if implied.tag_id not in searched:
-                            searched.add(implied.tag_id)
-                            to_search.add(implied.tag_id)
-                            inst.implied_tags.append(implied)
+        graph = TagGraph.for_mongo(mongo)
 
-            self.write_to_db(mongo)
-            return True
+        # anything carrying one of the changed tags, or a tag implying one of them, may be affected
+        affected_tags = set(tag_ids)
+        for tag_id in tag_ids:
+            affected_tags.update(graph.ancestors(tag_id))
+        affected_tags = list(affected_tags)
+
+        docs = list(mongo.db.items.find(
+            {"$or": [{"all_tags": {"$in": affected_tags}}, {"instances.all_tags": {"$in": affected_tags}}]},
+            {"tags": 1, "implied_tags": 1, "instances._id": 1, "instances.tags": 1, "instances.implied_tags": 1}))
+        if not docs:
+            return 0
+
+        # get implied from relations, for every affected item and instance at once
+        item_ids = [d["_id"] for d in docs]
+        instance_ids = [inst["_id"] for d in docs for inst in d.get("instances") or []]
+
+        relations = mongo.db.relations.find({"$or": [{"item_id": {"$in": item_ids}},
+                                                     {"instance_id": {"$in": instance_ids}}]})
+        relations = [Relation.from_dict(r) for r in relations]
+
+        relation_options = mongo.db.relation_options.find({"_id": {"$in": list({r.option_id for r in relations})}})
+        relation_options = {o.id: o for o in [RelationOption.from_dict(r) for r in relation_options]}
+
+        options_by_target: Dict[ObjectId, List[ObjectId]] = {}
+        for r in relations:
+            target = r.item_id if r.relation_type == RelationType.Item else r.instance_id
+            if r.option_id in relation_options and r.option_id not in options_by_target.get(target, []):
+                options_by_target.setdefault(target, []).append(r.option_id)
+
+        def calculate(target: ObjectId, tags: List[ObjectId]) -> List[ObjectId]:
+            implied = [i.tag_id for o in options_by_target.get(target, []) for i in relation_options[o].implies]
+            return implied + graph.implied_tags(tags + implied)
+
+        updates = []
+        item_ids = []
+        for doc in docs:
+            changes = {}
+
+            implied = calculate(doc["_id"], doc.get("tags") or [])
+            if set(implied) != set(doc.get("implied_tags") or []):
+                changes["implied_tags"] = implied
+                changes["all_tags"] = all_tags(doc.get("tags") or [], implied)
+
+            for i, inst in enumerate(doc.get("instances") or []):
+                implied = calculate(inst["_id"], inst.get("tags") or [])
+                if set(implied) != set(inst.get("implied_tags") or []):
+                    changes["instances." + str(i) + ".implied_tags"] = implied
+                    changes["instances." + str(i) + ".all_tags"] = all_tags(inst.get("tags") or [], implied)
+
+            if changes:
+                updates.append(pymongo.UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+                item_ids.append(doc["_id"])
+
+        if not updates:
+            return 0
+
+        modified = mongo.db.items.bulk_write(updates, ordered=False).modified_count
+        if modified:
+            ItemIndex.items_changed(mongo, item_ids)
+        return modified
+
+    @staticmethod
+    def rebuild_all_implied_tags(mongo: PyMongo, repair: bool = True) -> Tuple[int, float]:
+        """
+        Recalculates the implied tags of every item and instance inside MongoDB, using an aggregation
+        pipeline that walks the implication DAG with $graphLookup, then writes back only the implied tags that changed
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            repair
+                If false, the items and instances whose implied tags are out of date are only counted
+
+        Returns
+        -------
+            The number of items and instances that were changed (or are out of date), and the time taken in seconds
+        """
+        start = time.perf_counter()
+        # every run has its own collection for the changed items, so runs at the same time can't clobber each other
+        rebuild = mongo.db["implied_tags_rebuild_" + str(ObjectId())]
+
+        def relation_implied(relations: str, options: str, implied: str) -> List[Dict]:
+            # the tags implied by the relation options of the relations found by the previous $lookup
+            return [
+                {"$lookup": {"from": "relation_options", "localField": relations + ".option_id",
+                             "foreignField": "_id", "as": options}},
+                {"$addFields": {implied: {"$reduce": {"input": "$" + options + ".implies", "initialValue": [],
+                                                      "in": {"$concatArrays": ["$$value", "$$this"]}}}}},
+            ]
+
+        def dag_implied(tags: Dict, relation_implied_field: str, reached: str, implied: str) -> List[Dict]:
+            # the closure of the tags and relation implied tags, without the tags they started from
+            start_with = {"$concatArrays": [tags, "$" + relation_implied_field]}
+            return [
+                {"$graphLookup": {"from": "tags", "startWith": start_with, "connectFromField": "implies",
+                                  "connectToField": "_id", "as": reached}},
+                {"$addFields": {implied: {"$setUnion": [
+                    "$" + relation_implied_field,
+                    {"$setDifference": [{"$reduce": {"input": "$" + reached + ".implies", "initialValue": [],
+                                                     "in": {"$concatArrays": ["$$value", "$$this"]}}},
+                                        start_with]}
+                ]}}},
+            ]
+
+        def changed(tags: str, implied_tags: str, all_tags_field: str, implied: str) -> Dict:
+            return {"$or": [
+                {"$not": [{"$setEquals": [{"$ifNull": [implied_tags, []]}, implied]}]},
+                {"$not": [{"$setEquals": [{"$ifNull": [all_tags_field, []]}, all_tags_expression(tags, implied)]}]}
+            ]}
+
+        has_instance = {"$ne": [{"$ifNull": ["$instances._id", None]}, None]}
+        item_changed = changed("$tags", "$implied_tags", "$all_tags", "$_implied")
+
+        pipeline = [
+            {"$project": {"tags": 1, "implied_tags": 1, "all_tags": 1, "instances": 1}},
+
+            # instances, one at a time
+            {"$unwind": {"path": "$instances", "preserveNullAndEmptyArrays": True}},
+            {"$lookup": {"from": "relations", "localField": "instances._id", "foreignField": "instance_id",
+                         "as": "_instance_relations"}},
+            # items without instances would otherwise pick up every relation without an instance_id
+            {"$addFields": {"_instance_relations": {"$cond": [has_instance, "$_instance_relations", []]}}},
+            *relation_implied("_instance_relations", "_instance_options", "_instance_relation_implied"),
+            *dag_implied({"$ifNull": ["$instances.tags", []]}, "_instance_relation_implied",
+                         "_instance_reached", "_instance_implied"),
+            {"$group": {
+                "_id": "$_id",
+                "tags": {"$first": "$tags"},
+                "implied_tags": {"$first": "$implied_tags"},
+                "all_tags": {"$first": "$all_tags"},
+                # only the instances that changed, with the tags they were calculated from
+                "instances": {"$push": {"$cond": [
+                    {"$and": [has_instance, changed("$instances.tags", "$instances.implied_tags",
+                                                    "$instances.all_tags", "$_instance_implied")]},
+                    {"_id": "$instances._id", "tags": "$instances.tags",
+                     "old_implied_tags": "$instances.implied_tags", "implied_tags": "$_instance_implied"},
+                    None
+                ]}},
+            }},
+            {"$addFields": {"instances": {"$filter": {"input": "$instances", "cond": {"$ne": ["$$this", None]}}}}},
+
+            # then the items themselves
+            {"$lookup": {"from": "relations", "localField": "_id", "foreignField": "item_id", "as": "_relations"}},
+            *relation_implied("_relations", "_options", "_relation_implied"),
+            *dag_implied({"$ifNull": ["$tags", []]}, "_relation_implied", "_reached", "_implied"),
+
+            # only keep what has changed
+            {"$match": {"$expr": {"$or": [{"$gt": [{"$size": "$instances"}, 0]}, item_changed]}}},
+            {"$project": {"tags": 1, "old_implied_tags": "$implied_tags", "implied_tags": "$_implied",
+                          "item_changed": item_changed, "instances": 1}},
+        ]
+
+        if not repair:
+            counts = list(mongo.db.items.aggregate(pipeline + [
+                {"$group": {"_id": None, "count": {"$sum": {"$add": [{"$cond": ["$item_changed", 1, 0]},
+                                                                    {"$size": "$instances"}]}}}}
+            ], allowDiskUse=True))
+            return (counts[0]["count"] if counts else 0), time.perf_counter() - start
+
+        pipeline.append({"$out": rebuild.name})
+        try:
+            mongo.db.items.aggregate(pipeline, allowDiskUse=True)
+            modified = Item._apply_implied_tags_rebuild(mongo, rebuild)
+        finally:
+            rebuild.drop()
+
+        return modified, time.perf_counter() - start
+
+    @staticmethod
+    def _apply_implied_tags_rebuild(mongo: PyMongo, rebuild) -> int:
+        """
+        Writes the implied tags calculated by `rebuild_all_implied_tags` back into the items. Only the implied tags
+        are written, and only while the tags and implied tags they were calculated from haven't been changed since,
+        so edits made while the rebuild was running are never reverted
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            rebuild
+                The collection holding the changed items
+
+        Returns
+        -------
+            The number of items and instances that were changed
+        """
+        modified = 0
+        updates = []
+        item_ids = []
+
+        def flush():
+            nonlocal modified, updates
+            if updates:
+                modified += mongo.db.items.bulk_write(updates, ordered=False).modified_count
+                updates = []
+
+        for doc in rebuild.find():
+            item_ids.append(doc["_id"])
+            if doc["item_changed"]:
+                updates.append(pymongo.UpdateOne(
+                    {"_id": doc["_id"], "tags": doc.get("tags"), "implied_tags": doc.get("old_implied_tags")},
+                    {"$set": {"implied_tags": doc["implied_tags"],
+                              "all_tags": all_tags(doc.get("tags") or [], doc["implied_tags"])}}))
+
+            for inst in doc["instances"]:
+                updates.append(pymongo.UpdateOne(
+                    {"_id": doc["_id"], "instances": {"$elemMatch": {
+                        "_id": inst["_id"], "tags": inst.get("tags"), "implied_tags": inst.get("old_implied_tags")}}},
+                    {"$set": {"instances.$.implied_tags": inst["implied_tags"],
+                              "instances.$.all_tags": all_tags(inst.get("tags") or [], inst["implied_tags"])}}))
+
+            if len(updates) >= 1000:
+                flush()
+        flush()
+
+        if modified:
+            ItemIndex.items_changed(mongo, item_ids)
+        return modified
 
     def delete_from_db(self, mongo: PyMongo) -> bool:
         """
@@ -330,7 +587,11 @@ class Item:
         if self.id is None:
             return False
 
-        return mongo.db.items.delete_one({"_id": self.id}).deleted_count == 1
+        if mongo.db.items.delete_one({"_id": self.id}).deleted_count != 1:
+            return False
+
+        ItemIndex.for_mongo(mongo).removed(self.id, ItemIndex.bump_generation(mongo, [self.id]))
+        return True
     
     def hide(self, mongo: PyMongo) -> bool:
         """
@@ -366,13 +627,131 @@ class Item:
         if isinstance(tag_ref, Tag):
             tag_ref = TagReference(tag_ref)
 
-        result = mongo.db.items.find({"$or": [{"tags": {"$elemMatch": {"$eq": tag_ref.tag_id}}},
-                                              {"implied_tags": {"$elemMatch": {"$eq": tag_ref.tag_id}}}]})
+        result = mongo.db.items.find({"all_tags": tag_ref.tag_id})
         if result is None:
             return []
 
         return [Item.from_dict(i) for i in result]
 
+    @staticmethod
+    def search_facets(mongo: PyMongo, query: Dict, counts: bool = True, max_time_ms: Optional[int] = None) -> Dict:
+        """
+        Finds the items matching a query, and counts how many of them have each tag, in a single aggregation
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            query
+                The query the items must match
+            counts
+                False to only find the items
+            max_time_ms
+                How long (in milliseconds) MongoDB can take before raising ExecutionTimeout, None for no limit
+
+        Returns
+        -------
+            A dictionary with the ids of the matching items in order of id as "items", the number of them as "total",
+            the number with each tag by tag id as "tags", and the number with an instance with each tag by tag id
+            as "instance_tags"
+        """
+        facets = {"items": [{"$sort": {"_id": 1}}, {"$project": {"_id": 1}}]}
+        if counts:
+            facets["tags"] = [
+                {"$unwind": "$all_tags"},
+                {"$group": {"_id": "$all_tags", "count": {"$sum": 1}}},
+            ]
+            # an item is only counted once per tag, however many of its instances have it
+            facets["instance_tags"] = [
+                {"$unwind": "$instances"},
+                {"$unwind": "$instances.all_tags"},
+                {"$group": {"_id": {"item": "$_id", "tag": "$instances.all_tags"}}},
+                {"$group": {"_id": "$_id.tag", "count": {"$sum": 1}}},
+            ]
+
+        options = {"maxTimeMS": max_time_ms} if max_time_ms is not None else {}
+        result = next(mongo.db.items.aggregate([{"$match": query}, {"$facet": facets}], **options))
+        items = [i["_id"] for i in result["items"]]
+        return {"items": items, "total": len(items),
+                "tags": {t["_id"]: t["count"] for t in result.get("tags", [])},
+                "instance_tags": {t["_id"]: t["count"] for t in result.get("instance_tags", [])}}
+
+    @staticmethod
+    def count_per_tag(mongo: PyMongo) -> Tuple[Dict[ObjectId, int], int]:
+        """
+        Counts the items with each tag, either explicitly or implied
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            A dictionary from tag id to the number of items with it, and the total number of items
+        """
+        result = mongo.db.items.aggregate([
+            {"$project": {"all_tags": 1}},
+            {"$unwind": "$all_tags"},
+            {"$group": {"_id": "$all_tags", "count": {"$sum": 1}}},
+        ])
+        return {r["_id"]: r["count"] for r in result}, mongo.db.items.count_documents({})
+
+    @staticmethod
+    def search_for_page(mongo: PyMongo, query: Dict, attribute_options: List[Union[AttributeOption, ObjectId]],
+                        page_size: int, after: Optional[ObjectId] = None,
+                        before: Optional[ObjectId] = None) -> Tuple[List['Item'], bool]:
+        """
+        Finds a single page of items, ordered by id, using keyset pagination so the cost of a page doesn't grow
+        with the size of the library. Only the tags and the specified attributes of each item are loaded
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            query
+                The query the items must match
+            attribute_options
+                The attributes to load for each item
+            page_size
+                The maximum number of items on the page
+            after
+                If set, the page starts after the item with this id
+            before
+                If set, the page ends before the item with this id
+
+        Returns
+        -------
+            The items on the page in order of id, and True if there is another page
+            in the direction being paged
+        """
+        attribute_options = [a.id if isinstance(a, AttributeOption) else a for a in attribute_options]
+
+        if before is not None:
+            query = {"$and": [query, {"_id": {"$lt": before}}]}
+            order = pymongo.DESCENDING
+        else:
+            if after is not None:
+                query = {"$and": [query, {"_id": {"$gt": after}}]}
+            order = pymongo.ASCENDING
+
+        result = mongo.db.items.aggregate([
+            {"$match": query},
+            {"$sort": {"_id": order}},
+            {"$limit": page_size + 1},
+            {"$project": {"hidden": 1, "tags": 1, "implied_tags": 1, "attributes": {"$filter": {
+                "input": "$attributes", "cond": {"$in": ["$$this.option_id", attribute_options]}
+            }}}},
+        ])
+        items = [Item.from_dict(i) for i in result]
+
+        more = len(items) > page_size
+        items = items[:page_size]
+        if before is not None:
+            items.reverse()
+
+        return items, more
+
     @staticmethod
     def search_for_by_attribute(mongo: PyMongo, attrib_option: AttributeOption, value) -> List['Item']:
         """
@@ -431,9 +810,15 @@ class Instance:
     @staticmethod
     def init_indices(mongo: PyMongo):
         mongo.db.items.create_index([("instances.hidden", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("instances.tags.tag_id", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("instances.implied_tags.tag_id", pymongo.ASCENDING)], unique=False, sparse=True)
-        mongo.db.items.create_index([("instances.attributes.option_id", pymongo.ASCENDING)], unique=False, sparse=True)
+        mongo.db.items.create_index([("instances.all_tags", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("instances.attributes.option_id", pymongo.ASCENDING),
+                                     ("instances.attributes.value", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("instances.attributes.option_id", pymongo.ASCENDING),
+                                     ("instances.attributes.folded", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("instances.attributes.option_id", pymongo.ASCENDING),
+                                     ("instances.attributes.folded_reversed", pymongo.ASCENDING)], unique=False, sparse=False)
+        mongo.db.items.create_index([("instances.attributes.option_id", pymongo.ASCENDING),
+                                     ("instances.attributes.trigrams", pymongo.ASCENDING)], unique=False, sparse=False)
 
     def __init__(self, attributes: List[Attribute], tags: List[TagReference], hidden: bool = False):
         self.id = ObjectId()
@@ -455,6 +840,7 @@ class Instance:
             "tags": [t.tag_id for t in self.tags],
             "implied_tags": [t.tag_id for t in self.implied_tags]
         }
+        result["all_tags"] = all_tags(result["tags"], result["implied_tags"])
 
         if self.hidden:
             result["hidden"] = True
@@ -0,0 +1,55 @@
+import datetime
+import os
+import socket
+
+from flask_pymongo import PyMongo
+from pymongo.errors import DuplicateKeyError
+
+LEASE_HOLDER = "{}:{}".format(socket.gethostname(), os.getpid())
+"""
+The name this process holds leases under
+"""
+
+
+def acquire_lease(mongo: PyMongo, name: str, duration: float) -> bool:
+    """
+    Takes or renews a lease in the database, so only one of the processes sharing it does a job,
+    such as a background check. If the process holding it stops renewing it, another can take over once it expires
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        name
+            The name of the lease
+        duration
+            The number of seconds the lease is held for, it must be renewed before then
+
+    Returns
+    -------
+        True if this process now holds the lease, False if another process does
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        # if someone else holds an unexpired lease nothing matches, and the upsert collides with their lease
+        mongo.db.leases.update_one({"_id": name, "$or": [{"holder": LEASE_HOLDER}, {"expires": {"$lt": now}}]},
+                                   {"$set": {"holder": LEASE_HOLDER,
+                                             "expires": now + datetime.timedelta(seconds=duration)}},
+                                   upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def release_lease(mongo: PyMongo, name: str):
+    """
+    Gives up a lease this process holds, so another process can take it straight away
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        name
+            The name of the lease
+    """
+    mongo.db.leases.delete_one({"_id": name, "holder": LEASE_HOLDER})
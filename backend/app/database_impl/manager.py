@@ -4,15 +4,23 @@
 #
 # collection.insert_one({"test": "test"})
 
+import threading
+import time
+
 from flask import Flask
 from flask_pymongo import PyMongo
 from gridfs import GridFS
+from pymongo.errors import PyMongoError
 
 from app.database_impl.attrib_options import AttributeOption, AttributeTypes, SingleLineStringAttribute, \
     MultiLineStringAttribute, PictureAttribute
 from app.database_impl.items_instances import Item, Instance
+from app.database_impl.leases import acquire_lease
+from app.database_impl.migrations import migrate, schema_version, MIGRATIONS
 from app.database_impl.relations import RelationOption, Relation
 from app.database_impl.roles import Role, Permissions
+from app.database_impl.tag_graph import TagGraph
+from app.database_impl.tag_matrix import TagMatrix
 from app.database_impl.tags import Tag, TagReference
 from app.database_impl.users import User
 from werkzeug.security import generate_password_hash
@@ -26,6 +34,7 @@ class DatabaseManager:
 
     mongo: PyMongo
     fs: GridFS
+    tag_graph: TagGraph
 
     def __init__(self, app: Flask):
         app.config["MONGO_URI"] = "mongodb://localhost:27017/unigames_webapp_db"
@@ -42,6 +51,17 @@ class DatabaseManager:
         Relation.init_indices(self.mongo)
         User.init_indices(self.mongo)
 
+        # existing data is only brought up to date once, by whichever process gets to it first
+        if app.config["MIGRATE_ON_STARTUP"]:
+            if not migrate(self.mongo, app.logger.warning):
+                app.logger.warning("Another process is migrating the database, searches may be incomplete until it's done")
+        elif schema_version(self.mongo) < len(MIGRATIONS):
+            app.logger.warning("The database is out of date, run `flask migrate-database`")
+
+        # load the implication DAG once, Tag.write_to_db/delete_from_db keep it up to date from here on
+        self.tag_graph = TagGraph.for_mongo(self.mongo)
+        self.tag_graph.load()
+
         # For actual production, to ensure certain attributes exist
 
         # create an attribute for a name
@@ -86,6 +106,70 @@ class DatabaseManager:
                                                 Permissions.CanViewHidden: True})
             self.test_role.write_to_db(self.mongo)
 
+    def start_implied_tag_checker(self, app: Flask, interval: float, repair: bool = False):
+        """
+        Starts a background thread that periodically checks the implied tags of every item for drift from changes
+        that don't recalculate them, such as new relations or direct database edits, and logs it or fixes it.
+        Every process sharing the database starts one, but only the one holding the checker's lease does the check
+
+        Parameters
+        ----------
+            app
+                The flask app, used for logging
+            interval
+                The number of seconds between each check
+            repair
+                If true the drift is fixed by rebuilding the implied tags, otherwise it's only logged
+        """
+        def check():
+            while True:
+                time.sleep(interval)
+                try:
+                    # held for a few intervals, so a slow rebuild doesn't let another process take over midway
+                    if not acquire_lease(self.mongo, "implied-tag-checker", interval * 3):
+                        continue
+                    changed, elapsed = Item.rebuild_all_implied_tags(self.mongo, repair)
+                except PyMongoError as e:
+                    app.logger.error("Implied tag check failed: %s", e)
+                    continue
+
+                if changed and repair:
+                    app.logger.warning("Implied tag check fixed %d items and instances in %.2fs", changed, elapsed)
+                elif changed:
+                    app.logger.warning("Implied tag check found %d items and instances with outdated implied tags "
+                                       "in %.2fs, run `flask rebuild-implied-tags` to fix them", changed, elapsed)
+
+        threading.Thread(target=check, name="implied-tag-checker", daemon=True).start()
+
+    def start_search_index_builder(self, app: Flask, path: str, interval: float):
+        """
+        Starts a background thread that periodically rebuilds the shared search index file
+        if the items or tags have changed, for every process to map. Every process starts one, but only the one
+        holding the file's builder lock builds it, the rest only map it
+
+        Parameters
+        ----------
+            app
+                The flask app, used for logging
+            path
+                The search index file
+            interval
+                The number of seconds between each check
+        """
+        def check():
+            while True:
+                try:
+                    # checked every time, so another process takes over if the builder exits
+                    if TagMatrix.lock_file_builder(path):
+                        start = time.perf_counter()
+                        if TagMatrix.update_file(self.mongo, path):
+                            app.logger.info("Search index rebuilt in %.2fs", time.perf_counter() - start)
+                except (PyMongoError, OSError) as e:
+                    app.logger.error("Search index build failed: %s", e)
+                time.sleep(interval)
+
+        threading.Thread(target=check, name="search-index-builder", daemon=True).start()
+
     # To only be called for the sake of testing
     def test(self):
         # create a book tag
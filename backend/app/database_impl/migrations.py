@@ -0,0 +1,137 @@
+from typing import Callable, List, Tuple
+
+from flask_pymongo import PyMongo
+
+from app.database_impl.attrib_options import Attribute, AttributeTypes
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.items_instances import all_tags_expression
+from app.database_impl.leases import acquire_lease, release_lease
+from app.database_impl.tags import Tag
+
+
+def drop_indices(mongo: PyMongo, names: List[str]):
+    """
+    Drops old indices from the items collection, if they exist
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        names
+            The names of the indices to drop
+    """
+    existing = mongo.db.items.index_information()
+    for name in names:
+        if name in existing:
+            mongo.db.items.drop_index(name)
+
+
+# matches the string attributes written before they had folded copies and trigrams
+OUTDATED_ATTRIBUTE = {"attrib_type": {"$in": [AttributeTypes.SingleLineString, AttributeTypes.MultiLineString]},
+                      "$or": [{"folded": {"$exists": False}}, {"folded_reversed": {"$exists": False}},
+                              {"trigrams": {"$exists": False}}]}
+
+
+def _drop_unused_indices(mongo: PyMongo):
+    # tags are stored as bare ids, these never matched a query, and the option_id ones are a prefix of the compound
+    # indices, and tag searches only look at all_tags now
+    drop_indices(mongo, ["tags.tag_id_1", "implied_tags.tag_id_1", "attributes.option_id_1", "tags_1", "implied_tags_1",
+                         "instances.tags.tag_id_1", "instances.implied_tags.tag_id_1", "instances.attributes.option_id_1",
+                         "instances.tags_1", "instances.implied_tags_1"])
+
+
+def _add_all_tags(mongo: PyMongo):
+    # items and instances written before all_tags existed
+    mongo.db.items.update_many({"all_tags": {"$exists": False}}, [
+        {"$set": {"all_tags": all_tags_expression("$tags", "$implied_tags")}}
+    ])
+    mongo.db.items.update_many({"instances": {"$elemMatch": {"all_tags": {"$exists": False}}}}, [
+        {"$set": {"instances": {"$map": {"input": "$instances", "in": {"$mergeObjects": [
+            "$$this", {"all_tags": all_tags_expression("$$this.tags", "$$this.implied_tags")}
+        ]}}}}}
+    ])
+
+
+def _add_tag_ordinals(mongo: PyMongo):
+    # tags written before ordinals existed
+    for tag in mongo.db.tags.find({"ordinal": {"$exists": False}}, {"_id": 1}):
+        mongo.db.tags.update_one({"_id": tag["_id"]}, {"$set": {"ordinal": Tag.next_ordinal(mongo)}})
+
+
+def _add_folded_attributes(mongo: PyMongo):
+    # string attributes written before they had folded copies and trigrams, rewritten the same way they're written now
+    for item_dict in mongo.db.items.find({"attributes": {"$elemMatch": OUTDATED_ATTRIBUTE}}, {"attributes": 1}):
+        mongo.db.items.update_one({"_id": item_dict["_id"]}, {"$set": {
+            "attributes": [Attribute.from_dict(a).to_dict() for a in item_dict["attributes"]]}})
+    for item_dict in mongo.db.items.find({"instances.attributes": {"$elemMatch": OUTDATED_ATTRIBUTE}}, {"instances": 1}):
+        for instance_dict in item_dict["instances"]:
+            instance_dict["attributes"] = [Attribute.from_dict(a).to_dict() for a in instance_dict.get("attributes") or []]
+        mongo.db.items.update_one({"_id": item_dict["_id"]}, {"$set": {"instances": item_dict["instances"]}})
+
+
+MIGRATIONS: List[Tuple[str, Callable[[PyMongo], None]]] = [
+    ("drop unused item indices", _drop_unused_indices),
+    ("add all_tags to items and instances", _add_all_tags),
+    ("give tags ordinals", _add_tag_ordinals),
+    ("add folded values and trigrams to string attributes", _add_folded_attributes),
+    ("add reversed folded values to string attributes", _add_folded_attributes),
+]
+"""
+Every change to how existing data is stored, in the order they were made, the schema version is how many have been run.
+New migrations must only ever be added to the end
+"""
+
+
+def schema_version(mongo: PyMongo) -> int:
+    """
+    Reads how many of the migrations have been run on the database
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+
+    Returns
+    -------
+        The schema version, 0 if no migrations have ever been run
+    """
+    result = mongo.db.migrations.find_one({"_id": "schema"})
+    if result is None:
+        return 0
+    return result["version"]
+
+
+def migrate(mongo: PyMongo, log: Callable[[str], None]) -> bool:
+    """
+    Runs the migrations that haven't been run on the database yet. This costs a single read if there are none,
+    otherwise only the process holding the migration lease runs them, so they're only ever run once
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+        log
+            Called with a description of each migration as it's run
+
+    Returns
+    -------
+        True if the database is up to date, False if another process is migrating it
+    """
+    version = schema_version(mongo)
+    if version >= len(MIGRATIONS):
+        return True
+
+    # long enough for the slowest migration on a large library
+    if not acquire_lease(mongo, "migrations", 60 * 60):
+        return False
+
+    # another process may have finished them before the lease was taken
+    for version in range(schema_version(mongo), len(MIGRATIONS)):
+        description, migration = MIGRATIONS[version]
+        log("Migrating the database to version {}: {}".format(version + 1, description))
+        migration(mongo)
+        mongo.db.migrations.update_one({"_id": "schema"}, {"$set": {"version": version + 1}}, upsert=True)
+
+    ItemIndex.items_changed(mongo)
+    release_lease(mongo, "migrations")
+    return True
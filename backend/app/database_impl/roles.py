@@ -1,10 +1,13 @@
 from enum import Enum
-from typing import Dict, Optional
+from threading import RLock
+from typing import Dict, Optional, Iterable
 
 import pymongo
 from bson import ObjectId
 from flask_pymongo import PyMongo
 
+from app.database_impl.generations import get_generation, bump_generation
+
 
 class Permissions(Enum):
     """
@@ -30,6 +33,33 @@ class Permissions(Enum):
     def __str__(self):
         return self.value
 
+    @property
+    def bit(self) -> int:
+        """
+        The bit of this permission in a permission bitmask
+        """
+        return 1 << list(Permissions).index(self)
+
+    @staticmethod
+    def mask_of(permissions: Dict) -> int:
+        """
+        Packs the permissions of a role into a bitmask
+
+        Parameters
+        ----------
+            permissions
+                The permissions of a role, keyed by either `Permissions` or their string value
+
+        Returns
+        -------
+            A bitmask with the bit of every granted permission set
+        """
+        mask = 0
+        for p in Permissions:
+            if permissions.get(p, permissions.get(str(p), False)):
+                mask |= p.bit
+        return mask
+
 
 class Role:
     """
@@ -132,6 +162,8 @@ class Role:
         else:
             mongo.db.roles.find_one_and_replace({"_id": self.id}, self.to_dict())
 
+        Role.roles_changed(mongo)
+
     # Returns True if the update worked, else False, usually meaning it's no longer there
     def update_from_db(self, mongo: PyMongo) -> bool:
         """
@@ -178,7 +210,24 @@ class Role:
         if self.id is None:
             return False
 
-        return mongo.db.roles.delete_one({"_id": self.id}).deleted_count == 1
+        deleted = mongo.db.roles.delete_one({"_id": self.id}).deleted_count == 1
+        if deleted:
+            Role.roles_changed(mongo)
+        return deleted
+
+    @staticmethod
+    def roles_changed(mongo: PyMongo):
+        """
+        Makes every process throw away its cached role permissions, must be called after
+        changing the roles collection without going through `write_to_db` or `delete_from_db`
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+        """
+        bump_generation(mongo, RoleCache.GENERATION_NAME)
+        RoleCache.for_mongo(mongo).invalidate()
 
     @staticmethod
     def search_for_by_name(mongo: PyMongo, name: str) -> Optional['Role']:
@@ -235,6 +284,112 @@ class Role:
             permissions['can_edit_items'] = can_edit_items
             new_role = cls(name, priority, permissions)
             new_role.id = mongo.db.roles.insert_one(new_role.to_dict()).inserted_id
+            cls.roles_changed(mongo)
             return True
         else:
             return False
+
+
+class RoleCache:
+    """
+    A per process copy of the permission bitmask of every role, so checking permissions doesn't need to go
+    to the database. Every change to the roles bumps a generation counter in the database, other processes
+    notice the counter has changed in `validate` and reload their copy
+    """
+
+    GENERATION_NAME = "roles"
+
+    _caches: Dict[int, 'RoleCache'] = {}
+
+    mongo: PyMongo
+    """
+    The mongo database the roles are loaded from
+    """
+
+    generation: Optional[int] = None
+    """
+    The generation of the roles that have been loaded, None if they have not been loaded yet
+    """
+
+    masks: Dict[ObjectId, int] = {}
+    """
+    The permission bitmask of every role, by id
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.generation = None
+        self.masks = {}
+        self.lock = RLock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'RoleCache':
+        """
+        Gets the cache for a database, creating an (unloaded) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The cache for the database
+        """
+        cache = RoleCache._caches.get(id(mongo))
+        if cache is None:
+            cache = RoleCache._caches.setdefault(id(mongo), RoleCache(mongo))
+        return cache
+
+    def validate(self, generation: Optional[int] = None):
+        """
+        Checks the generation counter in the database, reloading every role if they have been changed.
+        This costs a single read of the counter if nothing has changed
+
+        Parameters
+        ----------
+            generation
+                The current generation, if it has already been read from the database
+        """
+        if generation is None:
+            generation = get_generation(self.mongo, RoleCache.GENERATION_NAME)
+        with self.lock:
+            if generation == self.generation:
+                return
+
+            masks = {}
+            for r in self.mongo.db.roles.find({}, {"permissions": 1}):
+                masks[r["_id"]] = Permissions.mask_of(r.get("permissions") or {})
+
+            self.masks = masks
+            self.generation = generation
+
+    def invalidate(self):
+        """
+        Throws away everything, so the next lookup will reload the roles from the database
+        """
+        with self.lock:
+            self.generation = None
+
+    def permission_mask(self, role_ids: Iterable[ObjectId]) -> int:
+        """
+        Merges the permissions of a set of roles. Permissions are only ever granted, so a permission
+        granted by any of the roles is granted whatever their priorities
+
+        Parameters
+        ----------
+            role_ids
+                The roles to merge
+
+        Returns
+        -------
+            The bitmask of the effective permissions
+        """
+        if self.generation is None:
+            self.validate()
+
+        masks = self.masks
+        mask = 0
+        for r in role_ids:
+            mask |= masks.get(r, 0)
+        return mask
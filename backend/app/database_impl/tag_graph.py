@@ -0,0 +1,219 @@
+from threading import RLock
+from typing import Dict, Set, FrozenSet, Iterable, Optional, List
+
+from bson import ObjectId
+from flask_pymongo import PyMongo
+
+
+class TagGraph:
+    """
+    An in-memory copy of the tag implication DAG, which keeps the transitive closure of every tag
+    (and the tags that reach it) so implied tags can be calculated without walking the DAG in the database
+    """
+
+    _graphs: Dict[int, 'TagGraph'] = {}
+
+    mongo: PyMongo
+    """
+    The mongo database the graph is loaded from
+    """
+
+    implies: Optional[Dict[ObjectId, Set[ObjectId]]] = None
+    """
+    The implication edges of every tag, None if they have not been loaded yet
+    """
+
+    closures: Dict[ObjectId, FrozenSet[ObjectId]] = {}
+    """
+    The cached set of every tag reachable from a tag
+    """
+
+    implied_by: Optional[Dict[ObjectId, List[ObjectId]]] = None
+    """
+    The implication edges reversed, the tags that directly imply each tag, None until ancestors are needed
+    """
+
+    ancestor_sets: Dict[ObjectId, FrozenSet[ObjectId]] = {}
+    """
+    The cached set of every tag that reaches a tag
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.implies = None
+        self.closures = {}
+        self.implied_by = None
+        self.ancestor_sets = {}
+        self.lock = RLock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'TagGraph':
+        """
+        Gets the graph for a database, creating an (unloaded) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The graph for the database
+        """
+        graph = TagGraph._graphs.get(id(mongo))
+        if graph is None:
+            graph = TagGraph._graphs.setdefault(id(mongo), TagGraph(mongo))
+        return graph
+
+    def load(self):
+        """
+        Loads every implication edge from the database, throwing away any cached closures
+        """
+        with self.lock:
+            self.implies = {t["_id"]: set(t.get("implies") or []) for t in self.mongo.db.tags.find({}, {"implies": 1})}
+            self._edges_changed()
+
+    def _edges_changed(self):
+        # everything cached is worked out from the edges
+        self.closures = {}
+        self.implied_by = None
+        self.ancestor_sets = {}
+
+    def invalidate(self):
+        """
+        Throws away everything, so the next lookup will reload the graph from the database
+        """
+        with self.lock:
+            self.implies = None
+            self._edges_changed()
+
+    def set_implies(self, tag_id: ObjectId, implies: Iterable[ObjectId]):
+        """
+        Patches the edges of a tag after it has been written to the database
+
+        Parameters
+        ----------
+            tag_id
+                The tag that was written
+            implies
+                The ids of the tags it now implies
+        """
+        with self.lock:
+            if self.implies is None:
+                return
+            implies = set(implies)
+            if self.implies.get(tag_id) != implies:
+                self.implies[tag_id] = implies
+                self._edges_changed()
+
+    def remove_tag(self, tag_id: ObjectId):
+        """
+        Patches the graph after a tag has been deleted from the database
+
+        Parameters
+        ----------
+            tag_id
+                The tag that was deleted
+        """
+        with self.lock:
+            if self.implies is None:
+                return
+            if self.implies.pop(tag_id, None) is not None:
+                self._edges_changed()
+
+    def closure(self, tag_id: ObjectId) -> FrozenSet[ObjectId]:
+        """
+        Gets every tag reachable from a tag by following one or more implications
+
+        Parameters
+        ----------
+            tag_id
+                The tag to start from
+
+        Returns
+        -------
+            The ids of all tags transitively implied by the tag
+        """
+        with self.lock:
+            if self.implies is None:
+                self.load()
+
+            result = self.closures.get(tag_id)
+            if result is not None:
+                return result
+
+            reached = set()
+            to_search = list(self.implies.get(tag_id, ()))
+
+            while to_search:
+                current = to_search.pop()
+                if current in reached:
+                    continue
+                reached.add(current)
+                to_search.extend(self.implies.get(current, ()))
+
+            result = frozenset(reached)
+            self.closures[tag_id] = result
+            return result
+
+    def ancestors(self, tag_id: ObjectId) -> FrozenSet[ObjectId]:
+        """
+        Gets every tag that reaches a tag by following one or more implications
+
+        Parameters
+        ----------
+            tag_id
+                The tag to start from
+
+        Returns
+        -------
+            The ids of all tags that transitively imply the tag
+        """
+        with self.lock:
+            if self.implies is None:
+                self.load()
+
+            result = self.ancestor_sets.get(tag_id)
+            if result is not None:
+                return result
+
+            if self.implied_by is None:
+                self.implied_by = {}
+                for parent, children in self.implies.items():
+                    for child in children:
+                        self.implied_by.setdefault(child, []).append(parent)
+
+            reached = set()
+            to_search = list(self.implied_by.get(tag_id, ()))
+
+            while to_search:
+                current = to_search.pop()
+                if current in reached:
+                    continue
+                reached.add(current)
+                to_search.extend(self.implied_by.get(current, ()))
+
+            result = frozenset(reached)
+            self.ancestor_sets[tag_id] = result
+            return result
+
+    def implied_tags(self, tag_ids: Iterable[ObjectId]) -> List[ObjectId]:
+        """
+        Calculates the tags implied by a set of tags, not including the tags themselves
+
+        Parameters
+        ----------
+            tag_ids
+                The tags to find the implications of
+
+        Returns
+        -------
+            The ids of all tags transitively implied by `tag_ids` that are not in `tag_ids`
+        """
+        tag_ids = set(tag_ids)
+        result = set()
+
+        for tag_id in tag_ids:
+            result.update(self.closure(tag_id))
+
+        return list(result.difference(tag_ids))
@@ -0,0 +1,528 @@
+import mmap
+import os
+import struct
+import tempfile
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from flask_pymongo import PyMongo
+
+from app.database_impl.generations import get_generations
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.tags import TagCache
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, without it searches fall back to the ItemIndex
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+
+# magic, version, number of items, number of tag rows, words per row, item generation, tag generation
+_FILE_HEADER = struct.Struct("<4sIQQQqq")
+_FILE_MAGIC = b"UGTM"
+_FILE_VERSION = 1
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+class TagMatrix:
+    """
+    An optional in-memory bit matrix of which items have which tags, with a row of packed uint64 words
+    per tag ordinal and a bit per item, so searches using only tags can be evaluated with a handful of
+    vectorized numpy operations. When the items or tags change only the columns of the changed items are
+    patched, unless the changes are no longer recorded and it has to be rebuilt from scratch.
+    If `path` is set the matrix is instead memory mapped from a file written by `write_file`, so every
+    process shares the same copy
+    """
+
+    _matrices: Dict[int, 'TagMatrix'] = {}
+
+    _builder_locks: Dict[str, int] = {}
+
+    available: bool = np is not None
+    """
+    Whether numpy is installed, without it the matrix can't be used
+    """
+
+    mongo: PyMongo
+    """
+    The mongo database the matrix is built from
+    """
+
+    enabled: bool = False
+    """
+    Whether the matrix is in use, when False it is never built
+    """
+
+    path: Optional[str] = None
+    """
+    The file the matrix is mapped from, None to build it in this process instead
+    """
+
+    generation: Optional[Tuple[int, int]] = None
+    """
+    The generations of the items and tags the matrix was built from, None if it has not been built yet
+    """
+
+    expected: Optional[Tuple[int, int]] = None
+    """
+    The current generations of the items and tags, as last seen by `validate`
+    """
+
+    item_ids: 'np.ndarray' = None
+    """
+    The 12 byte id of the item of every bit, in order of id
+    """
+
+    tag_ids: Dict[int, ObjectId] = {}
+    """
+    The id of the tag of every row, by ordinal
+    """
+
+    ordinals: Dict[ObjectId, int] = {}
+    """
+    The ordinal of every tag, by id
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.enabled = False
+        self.path = None
+        self.generation = None
+        self.expected = None
+        self.item_ids = None
+        self.tag_ids = {}
+        self.ordinals = {}
+        self.item_bits = None
+        self.instance_bits = None
+        self.visible = None
+        self.all = None
+        self._mapped_file = None
+        self.lock = RLock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'TagMatrix':
+        """
+        Gets the matrix for a database, creating an (unbuilt) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The matrix for the database
+        """
+        matrix = TagMatrix._matrices.get(id(mongo))
+        if matrix is None:
+            matrix = TagMatrix._matrices.setdefault(id(mongo), TagMatrix(mongo))
+        return matrix
+
+    def validate(self, item_generation: int, tag_generation: int):
+        """
+        Notes the current generations of the items and tags, if they have changed since the matrix was built
+        it is patched (or mapped again) on next use
+
+        Parameters
+        ----------
+            item_generation
+                The current generation of the items
+            tag_generation
+                The current generation of the tags
+        """
+        with self.lock:
+            self.expected = (item_generation, tag_generation)
+
+    def build(self):
+        """
+        Builds the matrix from every item and tag in the database
+        """
+        generations = get_generations(self.mongo, [ItemIndex.GENERATION_NAME, TagCache.GENERATION_NAME])
+
+        tags = list(self.mongo.db.tags.find({"ordinal": {"$exists": True}}, {"ordinal": 1}))
+        ordinals = {t["_id"]: t["ordinal"] for t in tags}
+        n_tags = max(ordinals.values(), default=-1) + 1
+
+        item_ids = []
+        hidden = []
+        item_cells: Tuple[List[int], List[int]] = ([], [])
+        instance_cells: Tuple[List[int], List[int]] = ([], [])
+
+        def add_cells(cells: Tuple[List[int], List[int]], tag_ids, column: int):
+            for tag_id in tag_ids:
+                if tag_id in ordinals:
+                    cells[0].append(ordinals[tag_id])
+                    cells[1].append(column)
+
+        for column, item in enumerate(self.mongo.db.items.find({}, {"hidden": 1, "all_tags": 1, "instances.all_tags": 1})
+                                      .sort("_id", 1)):
+            item_ids.append(item["_id"].binary)
+            if item.get("hidden"):
+                hidden.append(column)
+            add_cells(item_cells, item.get("all_tags") or [], column)
+            add_cells(instance_cells, {t for inst in item.get("instances") or [] for t in inst.get("all_tags") or []}, column)
+
+        n_words = (len(item_ids) + 63) // 64
+
+        def pack(rows: List[int], columns: List[int], n_rows: int) -> 'np.ndarray':
+            bits = np.zeros((n_rows, n_words), dtype=np.uint64)
+            columns = np.asarray(columns, dtype=np.uint64)
+            np.bitwise_or.at(bits, (np.asarray(rows, dtype=np.intp), (columns >> np.uint64(6)).astype(np.intp)),
+                             np.left_shift(np.uint64(1), columns & np.uint64(63)))
+            return bits
+
+        every = pack([0] * len(item_ids), list(range(len(item_ids))), 1)[0]
+
+        with self.lock:
+            self.item_ids = np.frombuffer(b"".join(item_ids), dtype=np.uint8).reshape(-1, 12)
+            self.ordinals = ordinals
+            self.tag_ids = {o: t for t, o in ordinals.items()}
+            self.item_bits = pack(*item_cells, n_tags)
+            self.instance_bits = pack(*instance_cells, n_tags)
+            self.all = every
+            self.visible = every & ~pack([0] * len(hidden), hidden, 1)[0]
+            self.generation = (generations[ItemIndex.GENERATION_NAME], generations[TagCache.GENERATION_NAME])
+
+    def _catch_up(self) -> bool:
+        """
+        Patches the columns of the items changed since the matrix was built, and adds rows for any new tags,
+        the matrix must be locked
+
+        Returns
+        -------
+            True if the matrix is up to date, False if it has to be rebuilt
+        """
+        item_generation, tag_generation = self.generation
+        changes = ItemIndex.changed_since(self.mongo, item_generation, self.expected[0])
+        if changes is None:
+            return False
+        item_generation, changed = changes
+
+        if tag_generation != self.expected[1]:
+            tag_generation = get_generations(self.mongo, [TagCache.GENERATION_NAME])[TagCache.GENERATION_NAME]
+            tags = list(self.mongo.db.tags.find({"ordinal": {"$exists": True}}, {"ordinal": 1}))
+            new_tags = [t["_id"] for t in tags if t["_id"] not in self.ordinals]
+            self.ordinals = {t["_id"]: t["ordinal"] for t in tags}
+            self.tag_ids = {o: t for t, o in self.ordinals.items()}
+            if new_tags:
+                # items may have been given a new tag before this process knew about it
+                changed = changed | {d["_id"] for d in self.mongo.db.items.find(
+                    {"$or": [{"all_tags": {"$in": new_tags}}, {"instances.all_tags": {"$in": new_tags}}]}, {"_id": 1})}
+            n_tags = max(self.ordinals.values(), default=-1) + 1
+            if n_tags > len(self.item_bits):
+                padding = ((0, n_tags - len(self.item_bits)), (0, 0))
+                self.item_bits = np.pad(self.item_bits, padding)
+                self.instance_bits = np.pad(self.instance_bits, padding)
+
+        docs = {d["_id"]: d for d in self.mongo.db.items.find({"_id": {"$in": list(changed)}},
+                                                              {"hidden": 1, "all_tags": 1, "instances.all_tags": 1})}
+        # new items are usually newer than every other, so their columns go on the end
+        for item_id in sorted(changed):
+            column = self._column(item_id)
+            if column is None:
+                if item_id not in docs:
+                    continue
+                if len(self.item_ids) and item_id.binary <= self.item_ids[-1].tobytes():
+                    return False
+                column = len(self.item_ids)
+                self.item_ids = np.vstack([self.item_ids, np.frombuffer(item_id.binary, dtype=np.uint8)])
+                if column % 64 == 0:
+                    self.item_bits, self.instance_bits = (np.pad(bits, ((0, 0), (0, 1)))
+                                                          for bits in (self.item_bits, self.instance_bits))
+                    self.all, self.visible = (np.pad(bits, (0, 1)) for bits in (self.all, self.visible))
+            self._set_column(column, docs.get(item_id))
+
+        self.generation = (item_generation, tag_generation)
+        return True
+
+    def _column(self, item_id: ObjectId) -> Optional[int]:
+        # a binary search of the ids, which are in order
+        key = item_id.binary
+        low, high = 0, len(self.item_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.item_ids[middle].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.item_ids) and self.item_ids[low].tobytes() == key:
+            return low
+        return None
+
+    def _set_column(self, column: int, item: Optional[Dict]):
+        # sets the bits of an item to its tags, or clears them if it has been deleted
+        word, bit = column >> 6, np.left_shift(np.uint64(1), np.uint64(column & 63))
+        for bits in (self.item_bits, self.instance_bits):
+            bits[:, word] &= ~bit
+        self.all[word] &= ~bit
+        self.visible[word] &= ~bit
+        if item is None:
+            return
+
+        for bits, tag_ids in ((self.item_bits, item.get("all_tags") or []),
+                              (self.instance_bits, {t for inst in item.get("instances") or []
+                                                    for t in inst.get("all_tags") or []})):
+            rows = [self.ordinals[t] for t in tag_ids if t in self.ordinals]
+            bits[rows, word] |= bit
+        self.all[word] |= bit
+        if not item.get("hidden"):
+            self.visible[word] |= bit
+
+    def write_file(self, path: str):
+        """
+        Writes the built matrix to a file, replacing any old version of it atomically so processes mapping
+        it only ever see a complete file
+
+        Parameters
+        ----------
+            path
+                The file to write
+        """
+        with self.lock:
+            n_tags, n_words = self.item_bits.shape
+            tag_table = bytearray(12 * n_tags)
+            for ordinal, tag_id in self.tag_ids.items():
+                tag_table[12 * ordinal:12 * ordinal + 12] = tag_id.binary
+
+            sections = [self.item_ids.tobytes(), bytes(tag_table), self.item_bits.astype("<u8").tobytes(),
+                        self.instance_bits.astype("<u8").tobytes(), self.visible.astype("<u8").tobytes(),
+                        self.all.astype("<u8").tobytes()]
+            header = _FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, len(self.item_ids), n_tags, n_words, *self.generation)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".search-index-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for section in sections:
+                    f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                    f.write(section)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @staticmethod
+    def update_file(mongo: PyMongo, path: str) -> bool:
+        """
+        Rebuilds a matrix file if the items or tags have changed since it was written
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            path
+                The file to update
+
+        Returns
+        -------
+            True if the file was rebuilt
+        """
+        generations = get_generations(mongo, [ItemIndex.GENERATION_NAME, TagCache.GENERATION_NAME])
+        if TagMatrix.read_file_generation(path) == (generations[ItemIndex.GENERATION_NAME],
+                                                    generations[TagCache.GENERATION_NAME]):
+            return False
+
+        # a separate matrix, so the one this process searches with is left alone
+        matrix = TagMatrix(mongo)
+        matrix.build()
+        matrix.write_file(path)
+        return True
+
+    @staticmethod
+    def lock_file_builder(path: str) -> bool:
+        """
+        Takes the lock on a matrix file's builder, a lock file next to it, so only one process on the machine
+        builds it and the rest only map it. The lock is held until the process exits, then another can take it
+
+        Parameters
+        ----------
+            path
+                The matrix file
+
+        Returns
+        -------
+            True if this process holds the lock, False if another process does
+        """
+        if path in TagMatrix._builder_locks:
+            return True
+
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+
+        TagMatrix._builder_locks[path] = fd
+        return True
+
+    @staticmethod
+    def read_file_generation(path: str) -> Optional[Tuple[int, int]]:
+        """
+        Reads the generations of the items and tags a matrix file was built from
+
+        Parameters
+        ----------
+            path
+                The file to read
+
+        Returns
+        -------
+            The generations, None if there is no valid file
+        """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_FILE_HEADER.size)
+        except OSError:
+            return None
+        if len(header) != _FILE_HEADER.size:
+            return None
+        magic, version, _, _, _, item_generation, tag_generation = _FILE_HEADER.unpack(header)
+        if magic != _FILE_MAGIC or version != _FILE_VERSION:
+            return None
+        return item_generation, tag_generation
+
+    def _map_file(self):
+        """
+        Maps the matrix from `path` read-only, if the file has been replaced since it was last mapped
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._mapped_file == identity:
+            return
+
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_items, n_tags, n_words, item_generation, tag_generation = _FILE_HEADER.unpack_from(data)
+        if magic != _FILE_MAGIC or version != _FILE_VERSION:
+            return
+
+        offset = _FILE_HEADER.size
+
+        def section(dtype: str, count: int) -> 'np.ndarray':
+            nonlocal offset
+            offset = _align(offset)
+            result = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += result.nbytes
+            return result
+
+        # the arrays keep the mapping open for as long as they're in use
+        self.item_ids = section("u1", 12 * n_items).reshape(-1, 12)
+        tag_table = section("u1", 12 * n_tags).reshape(-1, 12)
+        self.item_bits = section("<u8", n_tags * n_words).reshape(n_tags, n_words)
+        self.instance_bits = section("<u8", n_tags * n_words).reshape(n_tags, n_words)
+        self.visible = section("<u8", n_words)
+        self.all = section("<u8", n_words)
+
+        self.tag_ids = {o: ObjectId(row.tobytes()) for o, row in enumerate(tag_table) if row.any()}
+        self.ordinals = {t: o for o, t in self.tag_ids.items()}
+        self.generation = (item_generation, tag_generation)
+        self._mapped_file = identity
+
+    def ensure_loaded(self) -> bool:
+        """
+        Builds the matrix if it hasn't been built yet, or patches it if the items or tags have changed.
+        If it's mapped from a file, maps the newest version of the file instead
+
+        Returns
+        -------
+            True if the matrix is up to date, a mapped file may still be waiting to be rebuilt
+        """
+        with self.lock:
+            if self.path is None:
+                if self.generation is None:
+                    self.build()
+                elif self.expected is not None and self.generation != self.expected and not self._catch_up():
+                    self.build()
+                return True
+
+            if self.expected is None:
+                generations = get_generations(self.mongo, [ItemIndex.GENERATION_NAME, TagCache.GENERATION_NAME])
+                self.expected = (generations[ItemIndex.GENERATION_NAME], generations[TagCache.GENERATION_NAME])
+            if self.generation != self.expected:
+                self._map_file()
+            return self.generation == self.expected
+
+    def tag_bits(self, tag_id: ObjectId, instance: bool = False) -> 'np.ndarray':
+        """
+        Gets the items with a tag, the matrix must be locked
+
+        Parameters
+        ----------
+            tag_id
+                The id of the tag
+            instance
+                True for the items with an instance with the tag, instead of the items themselves
+
+        Returns
+        -------
+            The packed bits of the items with the tag, which must not be modified
+        """
+        ordinal = self.ordinals.get(tag_id)
+        if ordinal is None:
+            return np.zeros_like(self.all)
+        return (self.instance_bits if instance else self.item_bits)[ordinal]
+
+    def complement(self, bits: 'np.ndarray') -> 'np.ndarray':
+        """
+        Gets every item not in some packed bits
+        """
+        return self.all & ~bits
+
+    def ids(self, bits: 'np.ndarray') -> List[ObjectId]:
+        """
+        Converts packed bits to the ids of the items they are set for
+
+        Parameters
+        ----------
+            bits
+                The packed bits
+
+        Returns
+        -------
+            The ids of the items, in order of id
+        """
+        columns = np.unpackbits(bits.astype("<u8").view(np.uint8), bitorder="little")[:len(self.item_ids)].nonzero()[0]
+        return [ObjectId(self.item_ids[c].tobytes()) for c in columns]
+
+    def count_tags(self, bits: Optional['np.ndarray'] = None, instance: bool = False) -> Dict[ObjectId, int]:
+        """
+        Counts how many of some items have each tag, the matrix must be locked
+
+        Parameters
+        ----------
+            bits
+                The packed bits of the items to count, every item if None
+            instance
+                True to count the items with an instance with each tag, instead of the items themselves
+
+        Returns
+        -------
+            A dictionary from tag id to the number of the items with it, for every tag at least one of them has
+        """
+        rows = self.instance_bits if instance else self.item_bits
+        masked = rows if bits is None else rows & bits
+        if hasattr(np, "bitwise_count"):
+            counts = np.bitwise_count(masked).sum(axis=1)
+        else:
+            counts = np.unpackbits(masked.astype("<u8").view(np.uint8), axis=1).sum(axis=1)
+        return {self.tag_ids[o]: int(counts[o]) for o in counts.nonzero()[0] if o in self.tag_ids}
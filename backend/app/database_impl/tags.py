@@ -1,10 +1,15 @@
+from bisect import bisect_left
 from enum import IntEnum
-from typing import List, Dict, Optional, Union
+from threading import RLock
+from typing import List, Dict, Optional, Union, Iterable, Tuple
 
 import pymongo
 from bson import ObjectId
 from flask_pymongo import PyMongo
 
+from app.database_impl.generations import get_generation, bump_generation
+from app.database_impl.tag_graph import TagGraph
+
 
 class TagReference:
     tag_id: ObjectId = None
@@ -36,14 +41,40 @@ class Tag:
     List of tags this tag implies
     """
 
+    ordinal: Optional[int] = None
+    """
+    A small unique number given to the tag when it's first written, so tags can be used as array indices
+    """
+
+    ORDINAL_COUNTER = "tag_ordinals"
+
     @staticmethod
     def init_indices(mongo: PyMongo):
         mongo.db.tags.create_index([("name", pymongo.ASCENDING)], unique=True)
+        mongo.db.tags.create_index([("implies", pymongo.ASCENDING)], unique=False)
+        mongo.db.tags.create_index([("ordinal", pymongo.ASCENDING)], unique=True, sparse=True)
+
+    @staticmethod
+    def next_ordinal(mongo: PyMongo) -> int:
+        """
+        Hands out the next unused tag ordinal, ordinals start from 0 and are never reused
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The ordinal
+        """
+        return bump_generation(mongo, Tag.ORDINAL_COUNTER) - 1
 
     def __init__(self, name: str, implies: List[TagReference]):
         self.id = None
         self.name = name
         self.implies = implies
+        self.ordinal = None
 
     def to_dict(self) -> Dict:
         """
@@ -57,6 +88,8 @@ class Tag:
             "name": self.name.lower(),
             "implies": [i.tag_id for i in self.implies]
         }
+        if self.ordinal is not None:
+            result["ordinal"] = self.ordinal
         if self.id is not None:
             result["_id"] = self.id
         return result
@@ -107,6 +140,8 @@ class Tag:
         if "implies" in value_dict and value_dict["implies"] is not None:
             cls.implies = [TagReference(d) for d in value_dict["implies"]]
 
+        cls.ordinal = value_dict.get("ordinal")
+
         return cls
 
     def write_to_db(self, mongo: PyMongo):
@@ -119,11 +154,17 @@ class Tag:
             mongo
                 The mongo database
         """
+        if self.ordinal is None:
+            self.ordinal = Tag.next_ordinal(mongo)
+
         if self.id is None:
             self.id = mongo.db.tags.insert_one(self.to_dict()).inserted_id
         else:
             mongo.db.tags.find_one_and_replace({"_id": self.id}, self.to_dict())
 
+        TagGraph.for_mongo(mongo).set_implies(self.id, [i.tag_id for i in self.implies])
+        TagCache.for_mongo(mongo).written(self.to_dict(), bump_generation(mongo, TagCache.GENERATION_NAME))
+
     # Returns True if the update worked, else False, usually meaning it's no longer there
     def update_from_db(self, mongo: PyMongo) -> bool:
         """
@@ -151,6 +192,7 @@ class Tag:
 
         self.name = new_tag.name
         self.implies = new_tag.implies
+        self.ordinal = new_tag.ordinal
 
     def delete_from_db(self, mongo: PyMongo) -> bool:
         """
@@ -169,7 +211,11 @@ class Tag:
         if self.id is None:
             return False
 
-        return mongo.db.tags.delete_one({"_id": self.id}).deleted_count == 1
+        deleted = mongo.db.tags.delete_one({"_id": self.id}).deleted_count == 1
+        if deleted:
+            TagGraph.for_mongo(mongo).remove_tag(self.id)
+            TagCache.for_mongo(mongo).removed(self.id, bump_generation(mongo, TagCache.GENERATION_NAME))
+        return deleted
 
     @staticmethod
     def search_for_by_name(mongo: PyMongo, name: str) -> Optional['Tag']:
@@ -188,7 +234,334 @@ class Tag:
             None if a tag has not been found
             The tag if it exists in the database
         """
-        result = mongo.db.tags.find_one({"name": name.lower()})
+        return TagCache.for_mongo(mongo).get_by_name(name)
+
+    @staticmethod
+    def search_for_by_id(mongo: PyMongo, tag_id: ObjectId) -> Optional['Tag']:
+        """
+        Finds a tag in the database with the specified id
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            tag_id
+                The id to be searched by
+
+        Returns
+        -------
+            None if a tag has not been found
+            The tag if it exists in the database
+        """
+        return TagCache.for_mongo(mongo).get_by_id(tag_id)
+
+    @staticmethod
+    def search_for_by_prefix(mongo: PyMongo, prefix: str, limit: int = 10) -> List[Tuple[ObjectId, str]]:
+        """
+        Finds the tags whose names start with a prefix, for autocompleting tag names
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            prefix
+                The start of the name, in any case
+            limit
+                The most tags to find
+
+        Returns
+        -------
+            The id and name of the first `limit` matching tags, in order of name
+        """
+        return TagCache.for_mongo(mongo).prefix_matches(prefix, limit)
+
+    @staticmethod
+    def all_tags(mongo: PyMongo) -> List['Tag']:
+        """
+        Gets every tag in the database
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            A list of every tag, in the order they were created
+        """
+        return TagCache.for_mongo(mongo).all()
+
+    @staticmethod
+    def search_for_names_by_ids(mongo: PyMongo, tag_ids: Iterable[ObjectId]) -> Dict[ObjectId, str]:
+        """
+        Finds the names of many tags at once
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            tag_ids
+                The ids of the tags
+
+        Returns
+        -------
+            A dictionary from the id to the name of every tag that exists in the database
+        """
+        return TagCache.for_mongo(mongo).names(tag_ids)
+
+
+class TagCache:
+    """
+    A per process copy of every tag, so looking up tags doesn't need to go to the database.
+    Every write to the tags bumps a generation counter in the database, other processes notice the
+    counter has changed in `validate` and reload their copy
+    """
+
+    GENERATION_NAME = "tags"
+
+    _caches: Dict[int, 'TagCache'] = {}
+
+    mongo: PyMongo
+    """
+    The mongo database the tags are loaded from
+    """
+
+    generation: Optional[int] = None
+    """
+    The generation of the tags that have been loaded, None if they have not been loaded yet
+    """
+
+    by_id: Dict[ObjectId, Dict] = {}
+    """
+    The dictionary of every tag, by id
+    """
+
+    by_name: Dict[str, Dict] = {}
+    """
+    The dictionary of every tag, by name
+    """
+
+    sorted_names: Optional[List[str]] = None
+    """
+    The name of every tag in sorted order, for finding names by prefix, None if it has to be sorted again
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.generation = None
+        self.by_id = {}
+        self.by_name = {}
+        self.sorted_names = None
+        self.lock = RLock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'TagCache':
+        """
+        Gets the cache for a database, creating an (unloaded) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The cache for the database
+        """
+        cache = TagCache._caches.get(id(mongo))
+        if cache is None:
+            cache = TagCache._caches.setdefault(id(mongo), TagCache(mongo))
+        return cache
+
+    def validate(self, generation: Optional[int] = None):
+        """
+        Checks the generation counter in the database, reloading every tag if another process has changed them.
+        This costs a single read of the counter if nothing has changed
+
+        Parameters
+        ----------
+            generation
+                The current generation, if it has already been read from the database
+        """
+        if generation is None:
+            generation = get_generation(self.mongo, TagCache.GENERATION_NAME)
+        with self.lock:
+            if generation == self.generation:
+                return
+
+            was_loaded = self.generation is not None
+            self.by_id = {t["_id"]: t for t in self.mongo.db.tags.find()}
+            self.by_name = {t["name"]: t for t in self.by_id.values()}
+            self.sorted_names = None
+            self.generation = generation
+
+            # the implication graph was built from the same tags, so it is just as stale
+            if was_loaded:
+                TagGraph.for_mongo(self.mongo).invalidate()
+
+    def written(self, tag_dict: Dict, generation: int):
+        """
+        Patches the cache after this process has written a tag to the database
+
+        Parameters
+        ----------
+            tag_dict
+                The tag that was written, as stored in the database
+            generation
+                The generation the write bumped the counter to
+        """
+        with self.lock:
+            if self.generation is None or generation != self.generation + 1:
+                # someone else has written in the meantime, so there is more to catch up on than this tag
+                self.generation = None
+                return
+
+            old = self.by_id.get(tag_dict["_id"])
+            if old is not None:
+                self.by_name.pop(old["name"], None)
+            self.by_id[tag_dict["_id"]] = tag_dict
+            self.by_name[tag_dict["name"]] = tag_dict
+            self.sorted_names = None
+            self.generation = generation
+
+    def removed(self, tag_id: ObjectId, generation: int):
+        """
+        Patches the cache after this process has deleted a tag from the database
+
+        Parameters
+        ----------
+            tag_id
+                The tag that was deleted
+            generation
+                The generation the delete bumped the counter to
+        """
+        with self.lock:
+            if self.generation is None or generation != self.generation + 1:
+                self.generation = None
+                return
+
+            old = self.by_id.pop(tag_id, None)
+            if old is not None:
+                self.by_name.pop(old["name"], None)
+            self.sorted_names = None
+            self.generation = generation
+
+    def _ensure_loaded(self):
+        if self.generation is None:
+            self.validate()
+
+    def get_by_id(self, tag_id: ObjectId) -> Optional[Tag]:
+        """
+        Finds a tag by id
+
+        Parameters
+        ----------
+            tag_id
+                The id of the tag
+
+        Returns
+        -------
+            A copy of the tag, None if it doesn't exist
+        """
+        self._ensure_loaded()
+        result = self.by_id.get(tag_id)
         if result is None:
             return None
         return Tag.from_dict(result)
+
+    def id_for_name(self, name: str) -> Optional[ObjectId]:
+        """
+        Finds the id of a tag by name, without copying the tag
+
+        Parameters
+        ----------
+            name
+                The name of the tag, in lower case
+
+        Returns
+        -------
+            The id of the tag, None if it doesn't exist
+        """
+        self._ensure_loaded()
+        result = self.by_name.get(name)
+        if result is None:
+            return None
+        return result["_id"]
+
+    def get_by_name(self, name: str) -> Optional[Tag]:
+        """
+        Finds a tag by name
+
+        Parameters
+        ----------
+            name
+                The name of the tag, in any case
+
+        Returns
+        -------
+            A copy of the tag, None if it doesn't exist
+        """
+        self._ensure_loaded()
+        result = self.by_name.get(name.lower())
+        if result is None:
+            return None
+        return Tag.from_dict(result)
+
+    def prefix_matches(self, prefix: str, limit: int) -> List[Tuple[ObjectId, str]]:
+        """
+        Finds the tags whose names start with a prefix, with a binary search of the sorted names
+
+        Parameters
+        ----------
+            prefix
+                The start of the name, in any case
+            limit
+                The most tags to find
+
+        Returns
+        -------
+            The id and name of the first `limit` matching tags, in order of name
+        """
+        self._ensure_loaded()
+        with self.lock:
+            if self.sorted_names is None:
+                self.sorted_names = sorted(self.by_name)
+            names = self.sorted_names
+            by_name = self.by_name
+
+        prefix = prefix.lower()
+        start = bisect_left(names, prefix)
+        result = []
+        for name in names[start:start + limit]:
+            if not name.startswith(prefix):
+                break
+            result.append((by_name[name]["_id"], name))
+        return result
+
+    def all(self) -> List[Tag]:
+        """
+        Gets every tag
+
+        Returns
+        -------
+            A copy of every tag
+        """
+        self._ensure_loaded()
+        return [Tag.from_dict(t) for t in list(self.by_id.values())]
+
+    def names(self, tag_ids: Iterable[ObjectId]) -> Dict[ObjectId, str]:
+        """
+        Finds the names of many tags
+
+        Parameters
+        ----------
+            tag_ids
+                The ids of the tags
+
+        Returns
+        -------
+            A dictionary from the id to the name of every tag that exists
+        """
+        self._ensure_loaded()
+        by_id = self.by_id
+        return {i: by_id[i]["name"] for i in tag_ids if i in by_id}
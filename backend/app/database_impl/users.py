@@ -1,14 +1,18 @@
-from typing import List, Dict, Optional
+import time
+from threading import Lock
+from typing import List, Dict, Optional, Union, Tuple
 
 from flask import session
 from uuid import uuid4
 from werkzeug.security import check_password_hash
-from app import login_manager
+from app import app, login_manager
 
 import pymongo
+from pymongo.errors import OperationFailure
 from bson import ObjectId
 from flask_pymongo import PyMongo
-from app.database_impl.roles import Role
+from app.database_impl.generations import get_generation, bump_generation
+from app.database_impl.roles import Role, RoleCache, Permissions
 
 
 
@@ -59,9 +63,34 @@ class User:
     
     temp: bool
 
+    permission_mask: Optional[Tuple[int, int]] = None
+    """
+    The role generation and bitmask of the user's effective permissions, None if they haven't been resolved yet
+    """
+
     @staticmethod
     def init_indices(mongo: PyMongo):
-        mongo.db.users.create_index([("display_name", pymongo.ASCENDING)], unique=False, sparse=False)
+        indices = mongo.db.users.index_information()
+        for field in ["display_name", "email"]:
+            name = field + "_1"
+            duplicates = [d["_id"] for d in mongo.db.users.aggregate([
+                {"$group": {"_id": "$" + field, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}},
+            ])]
+            try:
+                if duplicates:
+                    # existing duplicates can't be fixed automatically, so keep the lookups indexed until they are cleaned up
+                    app.logger.warning("Users share the same %s, so it can't be made unique: %s", field, duplicates)
+                    mongo.db.users.create_index([(field, pymongo.ASCENDING)], unique=False, sparse=False)
+                    continue
+
+                # older databases have non-unique indices, which have to go before the unique ones can be made
+                if name in indices and not indices[name].get("unique", False):
+                    mongo.db.users.drop_index(name)
+                mongo.db.users.create_index([(field, pymongo.ASCENDING)], unique=True, sparse=False)
+            except OperationFailure as e:
+                # such as another process making the same index at the same time
+                app.logger.warning("Couldn't index users by %s: %s", field, e)
 
     def __init__(self, display_name: str, role_ids: List[ObjectId], email: str, password: str, first_name: str, last_name: str, temp = False):
         self.id = None
@@ -72,6 +101,7 @@ class User:
         self.first_name = first_name
         self.last_name = last_name
         self.temp = temp
+        self.permission_mask = None
         
     @staticmethod
     def is_authenticated():
@@ -87,13 +117,56 @@ class User:
 
     def get_id(self):
         return self.display_name
+
+    def has_permission(self, mongo: PyMongo, permission: Union[Permissions, str]) -> bool:
+        """
+        Checks if any of the user's roles grant a permission. The merged permissions are kept on the user
+        until the roles change, so this doesn't need the database
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            permission
+                The permission, or its string value
+
+        Returns
+        -------
+            True if the user has the permission
+        """
+        cache = RoleCache.for_mongo(mongo)
+        if self.permission_mask is None or self.permission_mask[0] != cache.generation:
+            mask = cache.permission_mask(self.role_ids)
+            self.permission_mask = (cache.generation, mask)
+        return bool(self.permission_mask[1] & Permissions(permission).bit)
         
     @staticmethod
     def login_valid(mongo: PyMongo, email, password):
-        verify_user = User.search_for_by_email(mongo, email)
-        if verify_user is not None:
-            return check_password_hash(verify_user.password, password)
-        return False
+        return User.login(mongo, email, password) is not None
+
+    @staticmethod
+    def login(mongo: PyMongo, email: str, password: str) -> Optional['User']:
+        """
+        Finds the user with an email and checks their password, with a single query
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+            email
+                The email of the user
+            password
+                The password to check
+
+        Returns
+        -------
+            None if there is no user with the email, or the password doesn't match
+            The user if the login is valid
+        """
+        user = User.search_for_by_email(mongo, email)
+        if user is None or not check_password_hash(user.password, password):
+            return None
+        return user
         
     @staticmethod
     def check_password(password_hash, password):
@@ -227,6 +300,7 @@ class User:
             self.id = mongo.db.users.insert_one(self.to_dict()).inserted_id
         else:
             mongo.db.users.find_one_and_replace({"_id": self.id}, self.to_dict())
+            User.users_changed(mongo)
 
     # Returns True if the update worked, else False, usually meaning it's no longer there
     def update_from_db(self, mongo: PyMongo) -> bool:
@@ -277,7 +351,24 @@ class User:
         if self.id is None:
             return False
 
-        return mongo.db.users.delete_one({"_id": self.id}).deleted_count == 1
+        deleted = mongo.db.users.delete_one({"_id": self.id}).deleted_count == 1
+        if deleted:
+            User.users_changed(mongo)
+        return deleted
+
+    @staticmethod
+    def users_changed(mongo: PyMongo):
+        """
+        Makes every process throw away its cached users, must be called after
+        changing the users collection without going through `write_to_db` or `delete_from_db`
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+        """
+        bump_generation(mongo, UserCache.GENERATION_NAME)
+        UserCache.for_mongo(mongo).invalidate()
 
     @staticmethod
     def search_for_by_display_name(mongo: PyMongo, display_name: str) -> Optional['User']:
@@ -348,3 +439,125 @@ class User:
 
         return User.from_dict(result)
 
+
+class UserCache:
+    """
+    A per process cache of the users loaded by the login manager, so authenticated page loads don't all need
+    to look up their user. Every change to the users bumps a generation counter in the database, other processes
+    notice the counter has changed in `validate` and throw away their cached users
+    """
+
+    GENERATION_NAME = "users"
+
+    _caches: Dict[int, 'UserCache'] = {}
+
+    mongo: PyMongo
+    """
+    The mongo database the users are loaded from
+    """
+
+    generation: Optional[int] = None
+    """
+    The generation of the users that are cached, None if it has not been read yet
+    """
+
+    entries: Dict[Tuple[str, int], Tuple[float, User]] = {}
+    """
+    The expiry time and user of every cached user, by display name and the generation it was loaded in
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.generation = None
+        self.entries = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'UserCache':
+        """
+        Gets the cache for a database, creating an (empty) one if it doesn't exist yet
+
+        Parameters
+        ----------
+            mongo
+                The mongo database
+
+        Returns
+        -------
+            The cache for the database
+        """
+        cache = UserCache._caches.get(id(mongo))
+        if cache is None:
+            cache = UserCache._caches.setdefault(id(mongo), UserCache(mongo))
+        return cache
+
+    def validate(self, generation: Optional[int] = None):
+        """
+        Checks the generation counter in the database, throwing away every cached user if they have been changed.
+        This costs a single read of the counter if nothing has changed
+
+        Parameters
+        ----------
+            generation
+                The current generation, if it has already been read from the database
+        """
+        if generation is None:
+            generation = get_generation(self.mongo, UserCache.GENERATION_NAME)
+        with self.lock:
+            if generation != self.generation:
+                self.entries = {}
+                self.generation = generation
+
+    def invalidate(self):
+        """
+        Throws away every cached user, the next `validate` will read the generation from the database again
+        """
+        with self.lock:
+            self.entries = {}
+            self.generation = None
+
+    def get(self, display_name: str) -> Tuple[Optional[User], Optional[int]]:
+        """
+        Gets a cached user
+
+        Parameters
+        ----------
+            display_name
+                The display name of the user, which is the id the login manager knows them by
+
+        Returns
+        -------
+            The cached user, None if the user is not cached or has expired, and the generation to pass to `put`
+            if the user has to be loaded
+        """
+        if self.generation is None:
+            self.validate()
+
+        generation = self.generation
+        entry = self.entries.get((display_name, generation))
+        if entry is None or entry[0] < time.monotonic():
+            return None, generation
+        return entry[1], generation
+
+    def put(self, display_name: str, generation: int, user: User, ttl: float):
+        """
+        Caches a user, unless the users have been changed since it was loaded
+
+        Parameters
+        ----------
+            display_name
+                The display name of the user
+            generation
+                The generation returned by `get` before the user was loaded
+            user
+                The user
+            ttl
+                The number of seconds the user stays cached for, so users that stop making requests are let go
+        """
+        now = time.monotonic()
+        with self.lock:
+            if generation != self.generation:
+                return
+            entries = {k: e for k, e in self.entries.items() if e[0] >= now}
+            entries[(display_name, generation)] = (now + ttl, user)
+            self.entries = entries
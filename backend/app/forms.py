@@ -2,8 +2,9 @@
 from app import db_manager
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, SelectField, TextField, validators, TextAreaField, SelectMultipleField, widgets
-from wtforms.validators import DataRequired, Length, EqualTo, Email
+from wtforms.validators import DataRequired, Length, EqualTo, Email, ValidationError
 from wtforms.fields.html5 import EmailField
+from bson import ObjectId
 # from app.routes import User
 
 import pdoc
@@ -15,6 +16,28 @@ all_roles = db_manager.mongo.db.roles.find()
 #get all attributes
 all_attirb = db_manager.mongo.db.attrib_options.find()
 
+#a tag picker whose options are fetched by the browser from the tag autocomplete endpoint, so the
+#choices are never listed on the server, the submitted value only has to be a tag id
+class TagSelectField(SelectField):
+    def __init__(self, label=None, validators=None, **kwargs):
+        kwargs.setdefault('choices', [])
+        super(TagSelectField, self).__init__(label, validators, **kwargs)
+
+    def pre_validate(self, form):
+        if not ObjectId.is_valid(self.data or ''):
+            raise ValidationError(self.gettext('Not a valid choice'))
+
+#the multiple choice version of TagSelectField
+class TagSelectMultipleField(SelectMultipleField):
+    def __init__(self, label=None, validators=None, **kwargs):
+        kwargs.setdefault('choices', [])
+        super(TagSelectMultipleField, self).__init__(label, validators, **kwargs)
+
+    def pre_validate(self, form):
+        for value in self.data or []:
+            if not ObjectId.is_valid(value):
+                raise ValidationError(self.gettext("'%(value)s' is not a valid choice for this field") % dict(value=value))
+
 #login form
 class LoginForm(FlaskForm):
     """
@@ -93,12 +116,12 @@ class UpdateRoleForm(FlaskForm):
 class newEntryForm(FlaskForm):
     title = StringField('Title',[validators.DataRequired()])
     description = TextAreaField('Description')
-    selection = SelectMultipleField('Attach multiple tags')
+    selection = TagSelectMultipleField('Attach multiple tags')
     submit = SubmitField('Save')
 
 #add a tag form
 class addTagForm(FlaskForm):
-    selection = SelectField('Add a tag')
+    selection = TagSelectField('Add a tag')
     submit = SubmitField('Save')
 
 #create a tag form
@@ -109,19 +132,23 @@ class createTagForm(FlaskForm):
 
 #add tag's implications form
 class addTagParentImplForm(FlaskForm):
-    select_parent = SelectField('Select its parent tag')
+    select_parent = TagSelectField('Select its parent tag')
     submit = SubmitField('Add implying tag')
 
 #add tag's implications form
 class addTagSiblingImplForm(FlaskForm):
-    select_sibling = SelectField('Select its sibling tag')
+    select_sibling = TagSelectField('Select its sibling tag')
     submit = SubmitField('Add implied tag')
 
 #add tag's implications form
 class addTagImplForm(FlaskForm):
-    select_child = SelectField('Select its child tag')
+    select_child = TagSelectField('Select its child tag')
     submit = SubmitField('Add implied tag')
 
+#rebuild every item's implied tags form
+class rebuildImpliedTagsForm(FlaskForm):
+    submit = SubmitField('Rebuild implied tags')
+
 #update attribute for an item form
 class updateAttribForm(FlaskForm):
     attrib_value = TextAreaField('New attribute value')
@@ -130,6 +157,6 @@ class updateAttribForm(FlaskForm):
 
 #add an implication rul
 class addRuleForm(FlaskForm):
-    parent = SelectField('Parent tag')
-    child = SelectField('Child tag')
+    parent = TagSelectField('Parent tag')
+    child = TagSelectField('Child tag')
     submit = SubmitField('Save implication')
@@ -0,0 +1,117 @@
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from flask import Flask
+from flask_pymongo import PyMongo
+
+from app.search_parser import Value
+
+
+def expected_query_shapes() -> List[Tuple[str, str, Dict]]:
+    """
+    Lists the queries the webapp relies on being indexed. The search queries are generated by the
+    search parser itself, so they keep matching whatever shape it emits
+
+    Returns
+    -------
+        A list of (description, collection name, filter) for every query
+    """
+    placeholder = ObjectId()
+    shapes = []
+
+    for description, string in [("item tag search", "a"),
+                                ("instance tag search", "::instance::a"),
+                                ("item tag under search", "::under::a"),
+                                ("instance tag under search", "::instance::under::a"),
+                                ("item has attribute search", "::has::a"),
+                                ("instance has attribute search", "::instance::has::a"),
+                                ("item attribute equals search", "::a::equals::b"),
+                                ("instance attribute equals search", "::instance::a::equals::b"),
+                                ("item attribute iequals search", "::a::iequals::b"),
+                                ("instance attribute iequals search", "::instance::a::iequals::b"),
+                                ("item attribute startswith search", "::a::startswith::b"),
+                                ("instance attribute startswith search", "::instance::a::startswith::b"),
+                                ("item attribute endswith search", "::a::endswith::b"),
+                                ("instance attribute endswith search", "::instance::a::endswith::b"),
+                                ("item attribute contains search", "::a::contains::bcd"),
+                                ("instance attribute contains search", "::instance::a::contains::bcd"),
+                                ("item attribute range search", "::a::between::1..2"),
+                                ("instance attribute range search", "::instance::a::between::1..2")]:
+        shapes.append((description, "items", Value.parse(string).to_search_query({"a": placeholder}, {"a": placeholder},
+                                                                                under_tags={placeholder: frozenset()})))
+
+    shapes.extend([
+        ("tag by name", "tags", {"name": "a"}),
+        ("tags implying a tag", "tags", {"implies": placeholder}),
+        ("attribute option by name", "attrib_options", {"attribute_name": "a"}),
+        ("role by name", "roles", {"name": "a"}),
+        ("user by email", "users", {"email": "a"}),
+        ("user by display name", "users", {"display_name": "a"}),
+        ("relations of an item", "relations", {"item_id": placeholder}),
+        ("relations of an instance", "relations", {"instance_id": placeholder}),
+    ])
+
+    return shapes
+
+
+def plan_stages(plan: Dict) -> List[str]:
+    """
+    Lists every stage of a query plan, from the root down
+
+    Parameters
+    ----------
+        plan
+            The plan, as found in the `queryPlanner.winningPlan` of an explain
+
+    Returns
+    -------
+        The names of every stage in the plan
+    """
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages.extend(plan_stages(plan["inputStage"]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def audit_indices(mongo: PyMongo) -> List[Tuple[str, str, Dict]]:
+    """
+    Explains every expected query and finds the ones that are not using an index
+
+    Parameters
+    ----------
+        mongo
+            The mongo database
+
+    Returns
+    -------
+        A list of (description, collection name, filter) for every query whose winning plan has a COLLSCAN
+    """
+    result = []
+    for description, collection, query in expected_query_shapes():
+        explain = mongo.db[collection].find(query).explain()
+        if "COLLSCAN" in plan_stages(explain["queryPlanner"]["winningPlan"]):
+            result.append((description, collection, query))
+    return result
+
+
+def log_index_audit(app: Flask, mongo: PyMongo) -> int:
+    """
+    Audits the indices, logging a warning for every query that is not using an index
+
+    Parameters
+    ----------
+        app
+            The flask app, used for logging
+        mongo
+            The mongo database
+
+    Returns
+    -------
+        The number of queries not using an index
+    """
+    scans = audit_indices(mongo)
+    for description, collection, query in scans:
+        app.logger.warning("Index audit: %s on %s is a COLLSCAN, query: %s", description, collection, query)
+    return len(scans)
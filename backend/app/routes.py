@@ -1,11 +1,13 @@
+from bisect import bisect_left, bisect_right
 from functools import wraps
 
 import json
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from flask import render_template, url_for, redirect, request, flash, Response
+from flask import render_template, url_for, redirect, request, flash, Response, g, jsonify
 from flask_login import current_user, login_user, logout_user
 from gridfs import NoFile
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout
 from werkzeug.security import generate_password_hash
 from werkzeug.utils import secure_filename
 
@@ -13,22 +15,27 @@ from app import app, db_manager, login_manager
 from app.database_impl.attrib_options import AttributeOption, PictureAttribute, SingleLineStringAttribute, \
     MultiLineStringAttribute
 from app.database_impl.items_instances import Item, Instance
-from app.database_impl.tags import Tag, TagReference
+from app.database_impl.tags import Tag, TagReference, TagCache
 
 from bson.objectid import ObjectId
 from app.forms import newEntryForm, addTagForm, createTagForm, addTagImplForm, \
     updateAttribForm, LoginForm, RegistrationForm, UpdateForm, addRuleForm, \
-    addTagParentImplForm, addTagSiblingImplForm, UpdateRoleForm, CreateUserForm, UpdatePasswordForm
+    addTagParentImplForm, addTagSiblingImplForm, UpdateRoleForm, CreateUserForm, UpdatePasswordForm, \
+    rebuildImpliedTagsForm
 
-from app.search_parser import search_string_to_mongodb_query, SearchStringParseError
+from app.search_parser import search_string_to_facets, SearchStringParseError, CompiledQueryCache, narrow_search, \
+    SearchLimits, SearchTimedOut
 from flask_pymongo import PyMongo
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 from werkzeug.security import generate_password_hash
 from functools import wraps
 
 # from app.tables import UserTable
-from app.database_impl.users import User
-from app.database_impl.roles import Role
+from app.database_impl.users import User, UserCache
+from app.database_impl.roles import Role, RoleCache
+from app.database_impl.generations import get_generations
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.tag_matrix import TagMatrix
 
 from flask_paginate import Pagination, get_page_parameter, get_page_args
 tags_collection = db_manager.mongo.db.tags
@@ -36,6 +43,67 @@ attrib_collection = db_manager.mongo.db.attrib_options
 mongo = db_manager.mongo
 
 
+@app.before_request
+def validate_caches():
+    """
+    Makes sure the cached tags, roles, users, searches and items are still up to date before handling a request, which costs
+    a single read unless another process has changed them
+    """
+    generations = get_generations(db_manager.mongo, [TagCache.GENERATION_NAME, RoleCache.GENERATION_NAME,
+                                                     UserCache.GENERATION_NAME, AttributeOption.GENERATION_NAME,
+                                                     ItemIndex.GENERATION_NAME])
+    TagCache.for_mongo(db_manager.mongo).validate(generations[TagCache.GENERATION_NAME])
+    RoleCache.for_mongo(db_manager.mongo).validate(generations[RoleCache.GENERATION_NAME])
+    UserCache.for_mongo(db_manager.mongo).validate(generations[UserCache.GENERATION_NAME])
+    CompiledQueryCache.for_mongo(db_manager.mongo).validate(generations[AttributeOption.GENERATION_NAME])
+    ItemIndex.for_mongo(db_manager.mongo).validate(generations[ItemIndex.GENERATION_NAME])
+    TagMatrix.for_mongo(db_manager.mongo).validate(generations[ItemIndex.GENERATION_NAME],
+                                                   generations[TagCache.GENERATION_NAME])
+
+
+def load_tag_names(tag_ids):
+    """
+    Function to resolve the names of the tags a page shows. Names are cached for the rest of the request,
+    so all the tags of a page can be resolved with a single query before rendering
+
+    Parameters
+    ----------
+        tag_ids
+            The ids of the tags to resolve
+
+    Returns
+    -------
+        A dictionary from tag id to name, for every tag resolved so far in this request
+    """
+    tag_names = g.setdefault('tag_names', {})
+    missing = set(tag_ids).difference(tag_names)
+    if missing:
+        tag_names.update(Tag.search_for_names_by_ids(db_manager.mongo, missing))
+    return tag_names
+
+
+def item_tag_ids(items):
+    """
+    Function to get the ids of the tags and implied tags of a list of items
+
+    Parameters
+    ----------
+        items
+            The items, either as Item objects or as documents from the database
+
+    Returns
+    -------
+        A list of tag ids
+    """
+    result = []
+    for item in items:
+        if isinstance(item, Item):
+            result.extend(t.tag_id for t in item.tags + item.implied_tags)
+        else:
+            result.extend(item.get('tags', []) + item.get('implied_tags', []))
+    return result
+
+
 
 
 # -------------------------------------------
@@ -50,12 +118,9 @@ def home():
     Returns:
         Renders the home.html user page template
     """
-    recent_items = []
-    for item in db_manager.mongo.db.items.find():
-        recent_items.append(item)
-    recent_items.reverse()
-    recent_items = recent_items[:6]
-    return render_template('user-pages/home.html', recent_items=recent_items, Item=Item, name_attrib_option=db_manager.name_attrib, tags_collection=tags_collection)
+    recent_items = list(db_manager.mongo.db.items.find().sort("_id", -1).limit(6))
+    tag_names = load_tag_names(item_tag_ids(recent_items))
+    return render_template('user-pages/home.html', recent_items=recent_items, Item=Item, name_attrib_option=db_manager.name_attrib, tag_names=tag_names)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -81,10 +146,8 @@ def login():
     if form.validate_on_submit():
         email = form.email.data
         password = form.password.data
-        find_user = mongo.db.users.find_one({"email": email})
-        print("find_user: ", find_user)
-        if User.login_valid(db_manager.mongo, email, password):
-            loguser = User.from_dict(find_user)
+        loguser = User.login(db_manager.mongo, email, password)
+        if loguser is not None:
             login_user(loguser, remember=form.remember_me.data)
             flash('You have been logged in!', 'success')
             if loguser.temp:
@@ -139,6 +202,7 @@ def changepw():
                                             'temp': False
                                       }
                                       })
+        User.users_changed(mongo)
         flash("Password updated successfully!")
         return redirect(url_for('home'))
     return render_template('user-pages/changepw.html', form=form)
@@ -180,6 +244,103 @@ def register():
                 flash(f'Account already exists for {form.display_name.data}!', 'success')
     return render_template('user-pages/register.html', title='Register', form=form)
 
+def facet_list(counts):
+    """
+    Function to order the tag counts of a search for display, most common first
+
+    Parameters
+    ----------
+        counts
+            The number of matching items with each tag, by tag id
+
+    Returns
+    -------
+        A list of (tag id, count) for every tag with a name
+    """
+    tag_names = load_tag_names(counts)
+    return sorted(((t, c) for t, c in counts.items() if t in tag_names), key=lambda f: (-f[1], tag_names[f[0]]))
+
+
+def get_page_args():
+    """
+    Function to read the `per_page`, `after` and `before` request arguments of a paged list of items
+
+    Returns
+    -------
+        The page size, and the ids the page starts after and ends before (None if not set)
+    """
+    per_page = request.args.get('per_page', type=int, default=app.config['LIBRARY_PAGE_SIZE'])
+    per_page = max(1, min(per_page, app.config['LIBRARY_MAX_PAGE_SIZE']))
+    after = request.args.get('after')
+    after = ObjectId(after) if after is not None and ObjectId.is_valid(after) else None
+    before = request.args.get('before')
+    before = ObjectId(before) if before is not None and ObjectId.is_valid(before) else None
+    return per_page, after, before
+
+
+def get_item_page(query):
+    """
+    Function to get a page of items for the library pages, using keyset pagination
+    with the `after`, `before` and `per_page` request arguments
+
+    Parameters
+    ----------
+        query
+            The query the items must match
+
+    Returns
+    -------
+        The items on the page, the ids to page backwards and forwards from (None if there is no such page),
+        and the page size
+    """
+    per_page, after, before = get_page_args()
+
+    items, more = Item.search_for_page(db_manager.mongo, query, [db_manager.name_attrib, db_manager.main_picture],
+                                       per_page, after, before)
+
+    if before is not None:
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+
+    prev_id = str(items[0].id) if has_prev and items else None
+    next_id = str(items[-1].id) if has_next and items else None
+
+    return items, prev_id, next_id, per_page
+
+
+def get_id_page(ids):
+    """
+    Function to get a page of the ids of some items, such as the results of a search, with the same
+    `after`, `before` and `per_page` request arguments as `get_item_page`
+
+    Parameters
+    ----------
+        ids
+            The ids of every item, in order
+
+    Returns
+    -------
+        The ids on the page, the ids to page backwards and forwards from (None if there is no such page),
+        and the page size
+    """
+    per_page, after, before = get_page_args()
+
+    if before is not None:
+        end = bisect_left(ids, before)
+        start = max(0, end - per_page)
+        has_prev, has_next = start > 0, True
+    else:
+        start = bisect_right(ids, after) if after is not None else 0
+        end = start + per_page
+        has_prev, has_next = after is not None, end < len(ids)
+
+    page = ids[start:end]
+    prev_id = str(page[0]) if has_prev and page else None
+    next_id = str(page[-1]) if has_next and page else None
+
+    return page, prev_id, next_id, per_page
+
 @app.route('/library')
 def library():
     """
@@ -189,11 +350,7 @@ def library():
     -------
         Renders the library page 
     """
-    items = db_manager.mongo.db.items.find()
-    items = [Item.from_dict(i) for i in items]
-
-    for item in items:
-        item.recalculate_implied_tags(db_manager.mongo)  # Again, thia is NOT be needed
+    items, prev_id, next_id, per_page = get_item_page({"hidden": {"$ne": True}})
 
     item_names = {item.id: item.get_attributes_by_option(db_manager.name_attrib)[0].value for item in items}
     item_images = {}
@@ -204,8 +361,39 @@ def library():
         else:
             item_images[item.id] = url_for('static', filename='img/logo.png')  # TODO supply 'no-image' image?
 
-    return render_template('user-pages/new-library.html', items=items, tags_collection=tags_collection,
-                           item_names=item_names, item_images=item_images)
+    tag_names = load_tag_names(item_tag_ids(items))
+
+    return render_template('user-pages/new-library.html', items=items, tag_names=tag_names,
+                           item_names=item_names, item_images=item_images, prev_id=prev_id, next_id=next_id,
+                           per_page=per_page)
+
+
+@app.route('/library/search')
+def library_search():
+    """
+    Library search route endpoint, for searching the visible items from scripts.
+
+    Parameters
+    ----------
+        GET:/library/search?q=<search string>
+
+    Returns
+    -------
+        JSON with the ids of the matching items as "items", the number of them as "total", and how many of them
+        have each tag, or an instance with each tag, as "tags" and "instance_tags". Or an "error" if the search
+        is invalid
+    """
+    result = search_string_to_facets(db_manager.mongo, request.args.get('q', ''))
+    if isinstance(result, list):
+        return jsonify(error=str(result[0])), 400
+
+    tag_names = load_tag_names(list(result["tags"]) + list(result["instance_tags"]))
+    return jsonify(
+        items=[str(i) for i in result["items"]],
+        total=result["total"],
+        tags=[{"id": str(t), "name": tag_names[t], "count": c} for t, c in facet_list(result["tags"])],
+        instance_tags=[{"id": str(t), "name": tag_names[t], "count": c} for t, c in facet_list(result["instance_tags"])],
+    )
 
 
 @app.route('/libarary/item_detail/<item_id>', methods=['GET', 'POST'])
@@ -233,7 +421,9 @@ def item_detail(item_id):
     else:
         image_url = url_for('static', filename='img/logo.png')  # TODO supply 'no-image' image?
 
-    return render_template('user-pages/item-detail.html', image_url=image_url, item=item, tags_collection=tags_collection, 
+    tag_names = load_tag_names(item_tag_ids([item]))
+
+    return render_template('user-pages/item-detail.html', image_url=image_url, item=item, tag_names=tag_names, 
                                 name_attribute=db_manager.name_attrib, description_attribute = db_manager.description_attrib)
 
 
@@ -391,13 +581,7 @@ def login_required(perm="ANY"):
             if not current_user.is_authenticated:
                 return login_manager.unauthorized()
             if (perm != "ANY"):
-                hasperm = False
-                for r in current_user.role_ids:
-                    roleperms = db_manager.mongo.db.roles.find_one({"_id": r})['permissions']
-                    print(roleperms)
-                    if roleperms[perm]:
-                        hasperm = True
-                if not hasperm:
+                if not current_user.has_permission(db_manager.mongo, perm):
                     return login_manager.unauthorized()
             return fn(*args, **kwargs)
 
@@ -543,7 +727,8 @@ def admin():
     recent_items = recent_items[:6]
     recent_tags.reverse()
     recent_tags = recent_tags[:6]
-    return render_template('admin-pages/new-home.html', tags_collection=tags_collection, user_count=user_count, recent_items=recent_items, recent_tags=recent_tags,item_count=item_count, tag_count=tag_count, tag_impl_count=tag_impl_count, name_attrib_option=db_manager.name_attrib, Item=Item)
+    tag_names = load_tag_names(item_tag_ids(recent_items) + [i for t in recent_tags for i in t['implies']])
+    return render_template('admin-pages/new-home.html', tag_names=tag_names, user_count=user_count, recent_items=recent_items, recent_tags=recent_tags,item_count=item_count, tag_count=tag_count, tag_impl_count=tag_impl_count, name_attrib_option=db_manager.name_attrib, Item=Item)
 
 #### Following pages for User Management ####
 
@@ -599,15 +784,30 @@ def edit(id):
             if form.delete.data:
                 return redirect(url_for('deleteuser', id=id))
             print(Role.search_for_by_name(db_manager.mongo, form.role.data).id)
-            mongo.db.users.update_one({'_id': ObjectId(id)},
-                                      {"$set": {
-                                          'display_name': form.display_name.data,
-                                          'first_name': form.first_name.data,
-                                          'last_name': form.last_name.data,
-                                          'email': form.email.data,
-                                          'role_ids': [Role.search_for_by_name(db_manager.mongo, form.role.data).id]
-                                      }
-                                      })
+            # display names and emails are unique, so they can't be changed to another user's
+            find_by_email = User.search_for_by_email(db_manager.mongo, form.email.data)
+            find_by_name = User.search_for_by_display_name(db_manager.mongo, form.display_name.data)
+            if find_by_name is not None and find_by_name.id != ObjectId(id):
+                flash(f'Account already exists for {form.display_name.data}!', 'success')
+                return render_template('admin-pages/user-man/edit.html', form=form)
+            if find_by_email is not None and find_by_email.id != ObjectId(id):
+                flash(f'Account already exists for {form.email.data}!', 'success')
+                return render_template('admin-pages/user-man/edit.html', form=form)
+            try:
+                mongo.db.users.update_one({'_id': ObjectId(id)},
+                                          {"$set": {
+                                              'display_name': form.display_name.data,
+                                              'first_name': form.first_name.data,
+                                              'last_name': form.last_name.data,
+                                              'email': form.email.data,
+                                              'role_ids': [Role.search_for_by_name(db_manager.mongo, form.role.data).id]
+                                          }
+                                          })
+            except DuplicateKeyError:
+                # another user took the name or email since it was checked
+                flash('Account already exists for that display name or email!', 'success')
+                return render_template('admin-pages/user-man/edit.html', form=form)
+            User.users_changed(mongo)
             flash('User updated successfully!')
             return redirect(url_for('adminusers'))
         return render_template('admin-pages/user-man/edit.html', form=form)
@@ -674,6 +874,7 @@ def deleteuser(id):
     searcheduser = mongo.db.users.find_one({'_id': ObjectId(id)})
     if searcheduser:
         mongo.db.users.delete_one({'_id': ObjectId(id)})
+        User.users_changed(mongo)
         flash('User deleted successfully!')
         return redirect(url_for('adminusers'))
     else:
@@ -737,6 +938,7 @@ def editrole(id):
                                           'permissions.can_view_hidden': form.can_view_hidden.data
                                       }
                                       })
+            Role.roles_changed(mongo)
             flash('Role updated successfully!')
             return redirect(url_for('roles'))
         return render_template('admin-pages/user-man/editrole.html', form=form)
@@ -766,6 +968,7 @@ def deleterole(id):
             flash('Error: Cannot delete default roles')
             return redirect(url_for('roles'))
         mongo.db.roles.delete_one({'_id': ObjectId(id)})
+        Role.roles_changed(mongo)
         flash('User deleted successfully!')
         return redirect(url_for('roles'))
     else:
@@ -860,7 +1063,10 @@ def all_impl():
     -------
         Renders the implications page
     """
-    return render_template('admin-pages/lib-man/tag-man/all-impl.html',  tags_collection=tags_collection)
+    tags = list(tags_collection.find())
+    tag_names = load_tag_names(i for t in tags for i in t['implies'])
+    return render_template('admin-pages/lib-man/tag-man/all-impl.html', tags=tags, tag_names=tag_names,
+                           rebuild_form=rebuildImpliedTagsForm())
 
 
 def get_tags(tags, offset=0, per_page=10):
@@ -927,26 +1133,63 @@ def search_item():
         Renders the item search page
     """
     item_names= None
-    searchString = request.form.get('tagSearchInput')
+    # the search comes from the form, or from the page links
+    searchString = request.values.get('tagSearchInput')
     is_input = False
     is_result = False
     result = []
     db_results =[]
+    facets = {"tags": {}, "instance_tags": {}}
+    prev_id = next_id = per_page = None
     print(searchString)
     if searchString is not None and searchString is not '':
-        result = search_string_to_mongodb_query(db_manager.mongo, searchString)
+        result = search_string_to_facets(db_manager.mongo, searchString)
         is_input = True
-        if isinstance(result,list) :
+        if isinstance(result,list):
             is_result=False
             result = str(result[0])[23:]
         else:
             flash('Search result retrieved from the database!')
             is_result = True
-            db_results = db_manager.mongo.db.items.find(result)
-            print(db_results)
+            facets = result
+            # only the documents on the page come from the database
+            page, prev_id, next_id, per_page = get_id_page(facets["items"])
+            try:
+                db_results = list(db_manager.mongo.db.items.find({"_id": {"$in": page}}).sort("_id", 1)
+                                  .max_time_ms(SearchLimits.max_time_ms))
+            except ExecutionTimeout:
+                is_result = False
+                result = str(SearchTimedOut(SearchLimits.max_time_ms))[23:]
             #item_names = {item.id: item.get_attributes_by_option(db_manager.name_attrib)[0].value for Item.from_dict(item) in db_results}
             #print(item_names)
-    return render_template('admin-pages/lib-man/search-item.html', is_input=is_input, is_result=is_result, item_names=item_names, result=result, searchString=searchString, db_results=db_results, tags_collection=tags_collection)
+    tag_names = load_tag_names(item_tag_ids(db_results) + list(facets["tags"]) + list(facets["instance_tags"]))
+    return render_template('admin-pages/lib-man/search-item.html', is_input=is_input, is_result=is_result, item_names=item_names, result=result, searchString=searchString, db_results=db_results, tag_names=tag_names,
+                           total=facets.get("total", 0), prev_id=prev_id, next_id=next_id, per_page=per_page,
+                           tag_facets=[(t, c, narrow_search(searchString, tag_names[t])) for t, c in facet_list(facets["tags"])],
+                           instance_tag_facets=[(t, c, narrow_search(searchString, '::instance::' + tag_names[t]))
+                                                for t, c in facet_list(facets["instance_tags"])])
+
+
+# Tag name autocomplete, for the tag pickers on the admin pages
+@app.route('/admin/lib-man/tag-man/tag-autocomplete')
+@login_required(perm="can_edit_items")
+def tag_autocomplete():
+    """
+    Tag autocomplete route endpoint.
+    This allows users with the `can_edit_items` permission to find tags by the start of their name,
+    without every tag being sent with the page
+
+    Parameters
+    ----------
+        GET:/admin/lib-man/tag-man/tag-autocomplete?q=<prefix>&limit=<number of tags>
+
+    Returns
+    -------
+        JSON with the id and name of the matching tags as "results", in the format select2 expects
+    """
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    matches = Tag.search_for_by_prefix(db_manager.mongo, request.args.get('q', ''), limit)
+    return jsonify(results=[{"id": str(tag_id), "text": name} for tag_id, name in matches])
 
 
 # Page for creating an implication
@@ -969,12 +1212,13 @@ def create_impl():
         Redirects to the all implications page if the implication was created successfully
     """
     form = addRuleForm()
-    form.parent.choices=[(tag['name'], tag['name']) for tag in db_manager.mongo.db.tags.find()]
-    form.child.choices=[(tag['name'], tag['name']) for tag in db_manager.mongo.db.tags.find()]
     if form.validate_on_submit():
-        parent_tag = Tag.search_for_by_name(db_manager.mongo, form.parent.data)
-        child_tag  = Tag.search_for_by_name(db_manager.mongo, form.child.data)
-        if form.parent.data == form.child.data:
+        parent_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(form.parent.data))
+        child_tag  = Tag.search_for_by_id(db_manager.mongo, ObjectId(form.child.data))
+        if parent_tag is None or child_tag is None:
+            flash('This tag does not exist')
+            return redirect(url_for('create_impl'))
+        if parent_tag.id == child_tag.id:
             flash('A tag cannot imply itself')
             return redirect(url_for('create_impl'))
         if parent_tag.implies:
@@ -982,13 +1226,37 @@ def create_impl():
             return redirect(url_for('create_impl'))
         parent_tag.implies.append(TagReference(child_tag))
         parent_tag.write_to_db(db_manager.mongo)
-        for item in db_manager.mongo.db.items.find():
-            this_item = Item.from_dict(item)
-            this_item.recalculate_implied_tags(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, parent_tag.id)
         flash('Implication added successfully, all items implication are updated')
         return redirect(url_for('all_impl'))
     return render_template('admin-pages/lib-man/tag-man/create-implication.html', form=form)
 
+# Function for rebuilding the implied tags of every item
+@app.route('/admin/lib-man/tag-man/rebuild-implied-tags', methods=['POST'])
+@login_required(perm="can_edit_items")
+def rebuild_implied_tags():
+    """
+    Implied tag rebuild route endpoint.
+    This allows users with the `can_edit_items` permission to recalculate the implied tags of every item,
+    such as after a bulk import. Only a POST with the form's CSRF token is accepted, as it rewrites every item
+
+    Parameters
+    ----------
+        POST:/admin/lib-man/tag-man/rebuild-implied-tags
+
+    Returns
+    -------
+        Redirects to the all implications page
+    """
+    form = rebuildImpliedTagsForm()
+    if not form.validate_on_submit():
+        flash('Implied tags were not rebuilt, the form has expired, please try again')
+        return redirect(url_for('all_impl'))
+
+    changed, elapsed = Item.rebuild_all_implied_tags(db_manager.mongo)
+    flash('Implied tags rebuilt in {:.2f}s, {} items and instances changed'.format(elapsed, changed))
+    return redirect(url_for('all_impl'))
+
 # Page for editing a tag and it's implications
 @app.route('/admin/lib-man/tag-man/edit-tag/<tag_name>')
 @login_required(perm="can_edit_items")
@@ -1007,16 +1275,17 @@ def edit_tag(tag_name):
         Renders the edit tag page
     """
     this_tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
-    sibling_list = [Tag.from_dict(t) for t in tags_collection.find({"$and": [{"implies": this_tag.id}, {"_id": {"$in": [t.tag_id for t in this_tag.implies]}}]})]
-    implied_by_list = [Tag.from_dict(t) for t in tags_collection.find({"$and": [{"implies": this_tag.id}, {"_id": {"$not": {"$in": [t.tag_id for t in this_tag.implies]}}}]})]
+    all_tags = Tag.all_tags(db_manager.mongo)
+    implies_ids = set(t.tag_id for t in this_tag.implies)
+    implied_by = [t for t in all_tags if this_tag.id in [i.tag_id for i in t.implies]]
+    sibling_list = [t for t in implied_by if t.id in implies_ids]
+    implied_by_list = [t for t in implied_by if t.id not in implies_ids]
     implied_list = [t for t in this_tag.implies if t.tag_id not in [it.id for it in sibling_list]]
     add_parent_implication_form = addTagParentImplForm()
-    add_parent_implication_form.select_parent.choices=[(tag['_id'], tag['name']) for tag in db_manager.mongo.db.tags.find({"$and": [{"_id": {"$ne": this_tag.id}}, {"_id": {"$not": {"$in": [t.id for t in implied_by_list]}}}]})]
     add_sibling_implication_form = addTagSiblingImplForm()
-    add_sibling_implication_form.select_sibling.choices=[(tag['_id'], tag['name']) for tag in db_manager.mongo.db.tags.find({"$and": [{"_id": {"$ne": this_tag.id}}, {"_id": {"$not": {"$in": [t.id for t in sibling_list]}}}]})]
     add_implication_form = addTagImplForm()
-    add_implication_form.select_child.choices=[(tag['_id'], tag['name']) for tag in db_manager.mongo.db.tags.find({"$and": [{"_id": {"$ne": this_tag.id}}, {"_id": {"$not": {"$in": [t.tag_id for t in this_tag.implies]}}}]})]
-    return render_template('admin-pages/lib-man/tag-man/edit-tag.html', add_implication_form=add_implication_form,add_parent_implication_form=add_parent_implication_form,add_sibling_implication_form=add_sibling_implication_form, tag=this_tag, tags_collection=tags_collection,sibling_list=sibling_list,implied_by_list=implied_by_list,implied_list=implied_list, Tag=Tag)
+    tag_names = load_tag_names(t.tag_id for t in implied_list)
+    return render_template('admin-pages/lib-man/tag-man/edit-tag.html', add_implication_form=add_implication_form,add_parent_implication_form=add_parent_implication_form,add_sibling_implication_form=add_sibling_implication_form, tag=this_tag, tag_names=tag_names,sibling_list=sibling_list,implied_by_list=implied_by_list,implied_list=implied_list, Tag=Tag)
 
 
 #### Following pages for Item Management ####
@@ -1038,10 +1307,7 @@ def all_items():
     -------
         Renders the all items page
     """
-    items = db_manager.mongo.db.items.find()
-    items = [Item.from_dict(i) for i in items]
-    for item in items:
-        item.recalculate_implied_tags(db_manager.mongo)  # Again, thia is NOT be needed
+    items, prev_id, next_id, per_page = get_item_page({})
     item_names = {item.id: item.get_attributes_by_option(db_manager.name_attrib)[0].value for item in items}
     item_images = {}
     for item in items:
@@ -1050,8 +1316,10 @@ def all_items():
             item_images[item.id] = url_for('image', oid=str(picture[0].value))
         else:
             item_images[item.id] = url_for('static', filename='img/logo.png')  # TODO supply 'no-image' image?
-    return render_template('admin-pages/lib-man/all-items.html', items=items, tags_collection=tags_collection,
-                           item_names=item_names, item_images=item_images)
+    tag_names = load_tag_names(item_tag_ids(items))
+    return render_template('admin-pages/lib-man/all-items.html', items=items, tag_names=tag_names,
+                           item_names=item_names, item_images=item_images, prev_id=prev_id, next_id=next_id,
+                           per_page=per_page)
 
 # Page for creating an item
 @app.route('/admin/lib-man/create-item', methods=['GET', 'POST'])
@@ -1072,8 +1340,6 @@ def create_item():
         Redirects to the all items page if the implication was created successfully
     """
     form = newEntryForm()
-    form.selection.choices=[(tag['name'], tag['name']) for tag in db_manager.mongo.db.tags.find()]
-    all_tags = db_manager.mongo.db.tags.find()
     if form.validate_on_submit():
         # search for an item with the same title
         # TODO: Ask client: Do we really care if things have the same name?
@@ -1081,9 +1347,10 @@ def create_item():
         if not item_exists:
             # find the matching tag
             tags = []
-            for tag in form.selection.data:
-                found_tag = Tag.search_for_by_name(db_manager.mongo, tag)
-                tags.append(TagReference(found_tag.id))
+            for tag_id in form.selection.data:
+                found_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(tag_id))
+                if found_tag is not None:
+                    tags.append(TagReference(found_tag.id))
             description = form.description.data.split('\r\n')
             new_item = Item([SingleLineStringAttribute(db_manager.name_attrib, form.title.data),
                              MultiLineStringAttribute(db_manager.description_attrib, description)],
@@ -1101,19 +1368,21 @@ def create_item():
 @login_required(perm="can_edit_items")
 def lib_edit(item_id):
     item = Item.from_dict(db_manager.mongo.db.items.find({"_id": ObjectId(item_id)})[0])
-    item.recalculate_implied_tags(db_manager.mongo)
     attributes = item.attributes
     form = addTagForm()
-    form.selection.choices=[(tag['name'], tag['name']) for tag in db_manager.mongo.db.tags.find()]
     if form.validate_on_submit():
-        tag_to_attach = Tag.search_for_by_name(db_manager.mongo, form.selection.data)
+        tag_to_attach = Tag.search_for_by_id(db_manager.mongo, ObjectId(form.selection.data))
+        if tag_to_attach is None:
+            return page_not_found(404)
         for tag_ref in item.tags:
             if str(tag_ref.tag_id) == str(tag_to_attach.id):
                 flash('This tag already attached to the item!')
         item.tags.append(TagReference(tag_to_attach))
         item.write_to_db(db_manager.mongo)
+        item.recalculate_implied_tags(db_manager.mongo)
+    tag_names = load_tag_names(item_tag_ids([item]))
     return render_template('admin-pages/lib-man/lib-edit.html', attributes=attributes, form=form, item=item, item_id=item_id,
-                           Tag=Tag, tags_collection=tags_collection)
+                           Tag=Tag, tag_names=tag_names)
 
 
 # Page for editing an item and it's tags
@@ -1137,7 +1406,6 @@ def edit_item(item_id):
     if item is None:
         return page_not_found(404)
     item = Item.from_dict(item)
-    item.recalculate_implied_tags(db_manager.mongo)
     attributes = [a for a in item.attributes if a.option_id != db_manager.main_picture.id]
     attribute_options = db_manager.mongo.db.attrib_options.find({"_id": {"$in": [a.option_id for a in attributes]}})
     attribute_options = {a.id: a for a in [AttributeOption.from_dict(a) for a in attribute_options]}
@@ -1146,9 +1414,11 @@ def edit_item(item_id):
     else:
         image_url = url_for('static', filename='img/logo.png')  # TODO supply 'no-image' image?
     form = addTagForm()
-    form.selection.choices=[(tag['name'], tag['name']) for tag in db_manager.mongo.db.tags.find()]
     if form.validate_on_submit():
-        tag_to_attach = Tag.search_for_by_name(db_manager.mongo, form.selection.data)
+        tag_to_attach = Tag.search_for_by_id(db_manager.mongo, ObjectId(form.selection.data))
+        if tag_to_attach is None:
+            flash('This tag does not exist')
+            return redirect(url_for('edit_item', item_id=item_id))
         for tag_ref in item.tags:
             if str(tag_ref.tag_id) == str(tag_to_attach.id):
                 flash('this tag already attached to the item!')
@@ -1158,8 +1428,9 @@ def edit_item(item_id):
         item.recalculate_implied_tags(db_manager.mongo)
         flash('Tag added successfully! Tag implications have been recalculated.')
         return redirect(url_for('edit_item', item_id=item_id))
+    tag_names = load_tag_names(item_tag_ids([item]))
     return render_template('admin-pages/lib-man/edit-item.html', attribute_options=attribute_options, form=form, item=item,
-                           item_id=item_id, tags_collection=tags_collection, image_url=image_url, name_attribute=db_manager.name_attrib)
+                           item_id=item_id, tag_names=tag_names, image_url=image_url, name_attribute=db_manager.name_attrib)
 
 # Page for updating Name or Description of an item
 @app.route('/admin/lib-man/item-update-attrib/<item_id>/<attrib_option_id>', methods=['GET', 'POST'])
@@ -1270,15 +1541,13 @@ def parent_implication_add(child_tag_id):
         Redirects to the tag edit page if the implication was created successfully
     """
     add_implication_form = addTagParentImplForm()
-    child_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(child_tag_id)})
+    child_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(child_tag_id))
     if child_tag is None:
         return page_not_found(404)
-    child_tag = Tag.from_dict(child_tag)
 
-    parent_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(add_implication_form.select_parent.data)})
+    parent_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(add_implication_form.select_parent.data))
     if parent_tag is None:
         return page_not_found(404)
-    parent_tag = Tag.from_dict(parent_tag)
 
     if parent_tag.id == child_tag.id:
         flash("A tag cannot imply itself!")
@@ -1290,6 +1559,7 @@ def parent_implication_add(child_tag_id):
         tag_ref = TagReference(child_tag.id)
         parent_tag.implies.append(tag_ref)
         parent_tag.write_to_db(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, parent_tag.id)
         return redirect(url_for('edit_tag', tag_name=child_tag.name))
 
 
@@ -1389,10 +1659,13 @@ def parent_rule_delete(tag_name):
     """
     child_tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
     tags = db_manager.mongo.db.tags.find({"implies": child_tag.id})
+    changed = []
     for tag in tags:
         tag = Tag.from_dict(tag)
         tag.implies = [tag for tag in tag.implies if tag.tag_id != child_tag.id]
         tag.write_to_db(db_manager.mongo)
+        changed.append(tag.id)
+    Item.propagate_implication_change(db_manager.mongo, changed)
     flash('The parent implications for tag '+ tag_name + ' has been cleared')
     return redirect(url_for('edit_tag',tag_name=tag_name))
 
@@ -1416,13 +1689,14 @@ def sibling_rule_delete(tag_name):
     tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
     to_remove = []
     for implied in tag.implies:
-        implied = Tag.from_dict(db_manager.mongo.db.tags.find_one({"_id": implied.tag_id}))
+        implied = Tag.search_for_by_id(db_manager.mongo, implied.tag_id)
         if tag.id in [t.tag_id for t in implied.implies]:
             to_remove.append(implied.id)
             implied.implies = [i for i in implied.implies if i.tag_id != tag.id]
             implied.write_to_db(db_manager.mongo)
     tag.implies = [i for i in tag.implies if i.tag_id not in to_remove]
     tag.write_to_db(db_manager.mongo)
+    Item.propagate_implication_change(db_manager.mongo, [tag.id] + to_remove)
     flash('The Bi-implications for tag '+ tag_name + ' has been cleared')
     return redirect(url_for('edit_tag',tag_name=tag_name))
 
@@ -1444,14 +1718,12 @@ def sibling_implication_add(parent_tag_id):
         Redirects to the tag edit page
     """
     add_sibling_implication_form = addTagSiblingImplForm()
-    parent_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(parent_tag_id)})
+    parent_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(parent_tag_id))
     if parent_tag is None:
         return page_not_found(404)
-    parent_tag = Tag.from_dict(parent_tag)
-    child_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(add_sibling_implication_form.select_sibling.data)})
+    child_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(add_sibling_implication_form.select_sibling.data))
     if child_tag is None:
         return page_not_found(404)
-    child_tag = Tag.from_dict(child_tag)
     if parent_tag.id == child_tag.id:
         flash("A tag cannot imply itself!")
         return redirect(url_for('edit_tag', tag_name=parent_tag.name))
@@ -1467,6 +1739,7 @@ def sibling_implication_add(parent_tag_id):
             parent_tag_ref = TagReference(parent_tag.id)
             child_tag.implies.append(parent_tag_ref)
             child_tag.write_to_db(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, [parent_tag.id, child_tag.id])
         return redirect(url_for('edit_tag', tag_name=parent_tag.name))
 
 # Function for  deleting a tag compeltely
@@ -1489,12 +1762,15 @@ def tag_delete(tag_name):
     tag_to_delete = Tag.search_for_by_name(db_manager.mongo, tag_name)
     tag_to_delete.delete_from_db(db_manager.mongo)
     implication_dropped = 0
+    changed = [tag_to_delete.id]
     for tag in tags_collection.find():
         for implication in tag['implies']:
             if str(implication) == str(tag_to_delete.id):
                 tag['implies'].remove(implication)
                 Tag.from_dict(tag).write_to_db(db_manager.mongo)
+                changed.append(tag['_id'])
                 implication_dropped += 1        # need to add user notification
+    Item.propagate_implication_change(db_manager.mongo, changed)
     flash('Tag: ' + str(tag_name) + ' dropped, ' + str(implication_dropped) + ' implications are affected.')
     return redirect(url_for('all_impl'))
 
@@ -1518,6 +1794,7 @@ def rule_delete(tag_name):
     tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
     tag.implies = []
     tag.write_to_db(db_manager.mongo)
+    Item.propagate_implication_change(db_manager.mongo, tag.id)
     flash('The implications for tag '+ tag_name + ' has been cleared')
     return redirect(url_for('edit_tag',tag_name=tag_name))
 
@@ -1541,8 +1818,12 @@ def impl_delete(tag_name):
     tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
     tag.implies = []
     tag.write_to_db(db_manager.mongo)
+    Item.propagate_implication_change(db_manager.mongo, tag.id)
     flash('The implications for tag '+ tag_name + ' has been deleted')
-    return render_template('admin-pages/lib-man/tag-man/all-impl.html',  tags_collection=tags_collection)
+    tags = list(tags_collection.find())
+    tag_names = load_tag_names(i for t in tags for i in t['implies'])
+    return render_template('admin-pages/lib-man/tag-man/all-impl.html', tags=tags, tag_names=tag_names,
+                           rebuild_form=rebuildImpliedTagsForm())
 
 #  Function for removing an implication from a parent tag
 @app.route('/admin/lib-man/implication-remove/<tag_name>/<implied_id>', methods=['GET', 'POST'])
@@ -1561,12 +1842,16 @@ def parent_implication_remove(tag_name, implied_id):
     -------
         Redirects to the tag edit page
     """
-    tag = Tag.from_dict(db_manager.mongo.db.tags.find({"name": tag_name})[0])
-    implied_tag = Tag.from_dict(db_manager.mongo.db.tags.find({"_id": ObjectId(implied_id)})[0])
-    for tag_ref in tag.implies:
+    tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
+    implied_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(implied_id))
+    changed = []
+    for tag_ref in list(tag.implies):
         if tag_ref.tag_id == implied_tag.id:
             tag.remove_implied_tag(tag_ref)
-            tag.write_to_db(db_manager.mongo)
+            changed.append(tag.id)
+    if changed:
+        tag.write_to_db(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, changed)
     return redirect(url_for('edit_tag', tag_name=implied_tag.name))
 
 @app.route('/admin/lib-man/sibling-implication-remove/<tag_name>/<sibling_id>', methods=['GET', 'POST'])
@@ -1585,12 +1870,13 @@ def sibling_implication_remove(tag_name, sibling_id):
     -------
         Redirects to the tag edit page
     """
-    tag = Tag.from_dict(db_manager.mongo.db.tags.find({"name": tag_name})[0])
-    sibling_tag = Tag.from_dict(db_manager.mongo.db.tags.find_one({"_id": ObjectId(sibling_id)}))
+    tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
+    sibling_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(sibling_id))
     tag.implies = [i for i in tag.implies if i.tag_id != sibling_tag.id]
     sibling_tag.implies = [i for i in sibling_tag.implies if i.tag_id != tag.id]
     tag.write_to_db(db_manager.mongo)
     sibling_tag.write_to_db(db_manager.mongo)
+    Item.propagate_implication_change(db_manager.mongo, [tag.id, sibling_tag.id])
     return redirect(url_for('edit_tag', tag_name=tag_name))
 
 # Function for adding an implicaiton to a tag
@@ -1611,15 +1897,13 @@ def implication_add(parent_tag_id):
         Redirects to the tag edit page
     """
     add_implication_form = addTagImplForm()
-    parent_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(parent_tag_id)})
+    parent_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(parent_tag_id))
     if parent_tag is None:
         return page_not_found(404)
-    parent_tag = Tag.from_dict(parent_tag)
 
-    child_tag = db_manager.mongo.db.tags.find_one({"_id": ObjectId(add_implication_form.select_child.data)})
+    child_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(add_implication_form.select_child.data))
     if child_tag is None:
         return page_not_found(404)
-    child_tag = Tag.from_dict(child_tag)
 
     if parent_tag.id == child_tag.id:
         flash("A tag cannot imply itself!")
@@ -1631,6 +1915,7 @@ def implication_add(parent_tag_id):
         tag_ref = TagReference(child_tag.id)
         parent_tag.implies.append(tag_ref)
         parent_tag.write_to_db(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, parent_tag.id)
         return redirect(url_for('edit_tag', tag_name=parent_tag.name))
 
 #Function for removing an implication from a tag
@@ -1650,12 +1935,16 @@ def implication_remove(tag_name, implied_id):
     -------
         Redirects to the tag edit page
     """
-    tag = Tag.from_dict(db_manager.mongo.db.tags.find({"name": tag_name})[0])
-    implied_tag = Tag.from_dict(db_manager.mongo.db.tags.find({"_id": ObjectId(implied_id)})[0])
-    for tag_ref in tag.implies:
+    tag = Tag.search_for_by_name(db_manager.mongo, tag_name)
+    implied_tag = Tag.search_for_by_id(db_manager.mongo, ObjectId(implied_id))
+    changed = []
+    for tag_ref in list(tag.implies):
         if tag_ref.tag_id == implied_tag.id:
             tag.remove_implied_tag(tag_ref)
-            tag.write_to_db(db_manager.mongo)
+            changed.append(tag.id)
+    if changed:
+        tag.write_to_db(db_manager.mongo)
+        Item.propagate_implication_change(db_manager.mongo, changed)
     return redirect(url_for('edit_tag', tag_name=tag_name))
 
 # Function for delete an item
@@ -1693,5 +1982,15 @@ def page_not_found(e):
 
 @login_manager.user_loader
 def load_user(did):
-    return User.search_for_by_display_name(db_manager.mongo, did)
+    """
+    Loads the logged in user of a session, reusing the user loaded by an earlier request if it was loaded
+    in the last `USER_CACHE_TTL` seconds and the users haven't been changed since
+    """
+    cache = UserCache.for_mongo(db_manager.mongo)
+    user, generation = cache.get(did)
+    if user is None:
+        user = User.search_for_by_display_name(db_manager.mongo, did)
+        if user is not None:
+            cache.put(did, generation, user, app.config["USER_CACHE_TTL"])
+    return user
     
@@ -1,12 +1,21 @@
-import abc
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
 from enum import Enum
-from typing import List, Union, Optional, Dict
+from typing import List, Union, Optional, Dict, FrozenSet, Tuple, Set, Callable, Any
 
-from bson import ObjectId
+from bson import ObjectId, BSON
 from flask_pymongo import PyMongo
+from pymongo.errors import ExecutionTimeout
 
-from app.database_impl.attrib_options import AttributeOption
-from app.database_impl.tags import Tag
+from app.database_impl.attrib_options import AttributeOption, fold_value, trigrams
+from app.database_impl.generations import get_generation
+from app.database_impl.item_index import ItemIndex
+from app.database_impl.tag_graph import TagGraph
+from app.database_impl.items_instances import Item
+from app.database_impl.tag_matrix import TagMatrix
+from app.database_impl.tags import TagCache
 
 
 class Brackets(Enum):
@@ -93,6 +102,16 @@ class UnexpectedTag(SearchStringParseError):
         return super().__str__() + "Unexpected tag: [" + self.string + "] at index: " + str(self.index)
 
 
+class EmptySearch(SearchStringParseError):
+    """
+    A subclass of SearchStringParseError, for the specific instance 
+    where there is nothing to search for, such as: '   '
+    """
+
+    def __str__(self) -> str:
+        return super().__str__() + "Nothing to search for"
+
+
 class NonexistentTag(SearchStringParseError):
     """
     A subclass of SearchStringParseError, for the specific instance 
@@ -121,14 +140,124 @@ class NonexistentAttribute(SearchStringParseError):
         return super().__str__() + "Nonexistent attribute: [" + self.string + "]"
 
 
-class Value:
+class InvalidNumber(SearchStringParseError):
+    """
+    A subclass of SearchStringParseError, for the specific instance 
+    where a numeric check isn't given a whole number, such as: 
+    '::players::gt::three', or a range like '3..5' for '::between::'
+    """
+
+    def __init__(self, string: str, check: str):
+        self.string = string
+        self.check = check
+
+    def __str__(self) -> str:
+        return super().__str__() + "Invalid number for " + self.check + ": [" + self.string + "]"
+
+
+class SearchTooComplex(SearchStringParseError):
+    """
+    A subclass of SearchStringParseError, for the specific instance 
+    where a search goes over one of the SearchLimits, such as 
+    thousands of tags, or hundreds of nested brackets
+    """
+
+    def __init__(self, limit: str, maximum: int):
+        self.limit = limit
+        self.maximum = maximum
+
+    def __str__(self) -> str:
+        return super().__str__() + "Search is too complex, the maximum " + self.limit + " is " + str(self.maximum)
+
+
+class SearchTimedOut(SearchStringParseError):
+    """
+    A subclass of SearchStringParseError, for the specific instance 
+    where MongoDB takes longer than SearchLimits.max_time_ms to run a search
+    """
+
+    def __init__(self, max_time_ms: int):
+        self.max_time_ms = max_time_ms
+
+    def __str__(self) -> str:
+        return super().__str__() + "Search took longer than " + str(self.max_time_ms) + "ms"
+
+
+class SearchLimits:
+    """
+    The limits on how complex a single search can be, so a pathological search can't tie up a worker
+    """
+
+    max_depth: int = 32
+    """
+    The deepest brackets, ::not's and operators can be nested
+    """
+
+    max_terms: int = 256
+    """
+    The most tags and attribute checks a search can have
+    """
+
+    max_filter_bytes: int = 64 * 1024
+    """
+    The largest MongoDB filter (as BSON) a search can compile to, '::under::' can add many tags to it
+    """
+
+    max_time_ms: int = 2000
+    """
+    How long MongoDB can spend running a search before it's abandoned
+    """
+
+
+class SearchNode:
+    """
+    The base class of every node of the abstract symbol tree. Nodes are immutable and compared by
+    structure, so equal searches have equal trees that can be hashed, e.g. to be used as a cache key
+    """
+
+    __slots__ = ("_hash",)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("search nodes are immutable")
+
+    def _set(self, **fields):
+        """
+        Sets the fields of the node, only to be used while constructing it
+        """
+        for key, value in fields.items():
+            object.__setattr__(self, key, value)
+        object.__setattr__(self, "_hash", hash((type(self), self._key())))
+
+    def _key(self) -> tuple:
+        """
+        The fields that make up the structure of this node
+        """
+        return ()
+
+    def tags_only(self) -> bool:
+        """
+        Whether this node and its children only search for tags, so they can be evaluated against a TagMatrix
+        """
+        return _evaluate_tree(self, False, lambda v, n: isinstance(v, (TagValue, VisibleItemValue)),
+                              lambda is_and, left, right: left and right)
+
+    def __eq__(self, other) -> bool:
+        return self is other or (type(self) is type(other) and self._hash == other._hash and self._key() == other._key())
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class Value(SearchNode):
     """
     An general 'atom' of an expression, such as 'a' or 
     '::instance::uuid::equals::10202901'
     """
 
-    string: str
-    not_value: bool = False
+    __slots__ = ()
 
     @staticmethod
     def parse(value: str) -> Union['Value', SearchStringParseError]:
@@ -140,147 +269,230 @@ class Value:
         if value.lstrip().startswith("::"):
 
             if value.lstrip().startswith("::has::"):
-                cls = HasItemAttributeValue()
-                cls.string = value
-                cls.attribute_name = value.lstrip()[len("::has::"):].rstrip().lower()
-
-                return cls
+                return HasItemAttributeValue(value.lstrip()[len("::has::"):].rstrip().lower())
             elif value.lstrip().startswith("::instance::has::"):
-                cls = HasInstanceAttributeValue()
-                cls.string = value
-                cls.attribute_name = value.lstrip()[len("::instance::has::"):].rstrip().lstrip()
-
-                return cls
+                return HasInstanceAttributeValue(value.lstrip()[len("::instance::has::"):].rstrip().lstrip())
+            elif value.lstrip().startswith("::under::"):
+                return UnderItemTagValue(value.lstrip()[len("::under::"):].strip().lower())
+            elif value.lstrip().startswith("::instance::under::"):
+                return UnderInstanceTagValue(value.lstrip()[len("::instance::under::"):].strip().lower())
             elif value.lstrip().startswith("::instance::"):
                 remain = value.lstrip()[len("::instance::"):].rstrip()
 
-                if "::equals::" in remain:
-                    s = remain.find("::equals::")
-
-                    cls = CheckInstanceAttributeValue()
-                    cls.string = value
-                    cls.attribute_name = remain[:s].lower()
-                    cls.value = remain[s + len("::equals::"):]
-                    cls.check_mode = CheckMode.Equals
-
-                    return cls
-                elif "::contains::" in remain:
-                    s = remain.find("::contains::")
-
-                    cls = CheckInstanceAttributeValue()
-                    cls.string = value
-                    cls.attribute_name = remain[:s].lower()
-                    cls.value = remain[s + len("::contains::"):]
-                    cls.check_mode = CheckMode.Contains
-
-                    return cls
+                check = CheckMode.find(remain)
+                if check is not None:
+                    return CheckInstanceAttributeValue.from_check(remain, *check)
                 else:
-                    cls = InstanceTagValue()
-                    cls.string = value
-                    cls.stripped_name = remain.strip().lower()
-
-                    return cls
+                    return InstanceTagValue(remain.strip().lower())
 
             else:
                 remain = value.lstrip()[len("::"):].rstrip()
 
-                if "::equals::" in remain:
-                    s = remain.find("::equals::")
-
-                    cls = CheckItemAttributeValue()
-                    cls.string = value
-                    cls.attribute_name = remain[:s].lower()
-                    cls.value = remain[s + len("::equals::"):]
-                    cls.check_mode = CheckMode.Equals
-
-                    return cls
-                elif "::contains::" in remain:
-                    s = remain.find("::contains::")
-
-                    cls = CheckItemAttributeValue()
-                    cls.string = value
-                    cls.attribute_name = remain[:s].lower()
-                    cls.value = remain[s + len("::contains::"):]
-                    cls.check_mode = CheckMode.Contains
-
-                    return cls
-
-        else:
-            cls = ItemTagValue()
-            cls.string = value
-            cls.stripped_name = value.strip().lower()
-
-            return cls
+                check = CheckMode.find(remain)
+                if check is not None:
+                    return CheckItemAttributeValue.from_check(remain, *check)
 
-    def __str__(self) -> str:
-        """
-        Convert the atom back into a string, for testing
-        """
-        if self.not_value:
-            return "!"
-        return ""
+        return ItemTagValue(value.strip().lower())
 
-    def to_search_query(self) -> Dict:
+    def to_search_query(self, tag_ids: Dict[str, ObjectId], attribute_ids: Dict[str, ObjectId], negated: bool = False,
+                        under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> Dict:
         """
         Take the value/atom and convert it into a MongoDB search 
         query for that specific information
+
+        Parameters
+        ----------
+            tag_ids
+                The ids of the tags, by name
+            attribute_ids
+                The ids of the attribute options, by name
+            negated
+                True to search for everything that doesn't match this value instead
+            under_tags
+                Every tag that transitively implies each tag searched for with '::under::', by tag id
         """
         if isinstance(self, ItemTagValue):
-            if self.not_value:
-                inner = {"$ne": self.tag_id}
-                op = "$and"
-            else:
-                inner = self.tag_id
-                op = "$or"
-
-            return {op: [{"tags": inner}, {"implied_tags": inner}]}
+            tag_id = tag_ids[self.stripped_name]
+            if negated:
+                return {"all_tags": {"$ne": tag_id}}
+            return {"all_tags": tag_id}
         elif isinstance(self, InstanceTagValue):
-            if self.not_value:
-                inner = {"$ne": self.tag_id}
-                op = "$and"
-            else:
-                inner = self.tag_id
-                op = "$or"
-
-            return {op: [{"instances.tags": inner}, {"instances.implied_tags": inner}]}
+            tag_id = tag_ids[self.stripped_name]
+            if negated:
+                return {"instances.all_tags": {"$ne": tag_id}}
+            return {"instances.all_tags": tag_id}
+        elif isinstance(self, UnderTagValue):
+            field = "all_tags" if isinstance(self, UnderItemTagValue) else "instances.all_tags"
+            tag_id = tag_ids[self.stripped_name]
+            # a single $in over the tag and everything under it, however deep the implications go
+            under_ids = sorted({tag_id} | under_tags[tag_id])
+            if negated:
+                return {field: {"$nin": under_ids}}
+            return {field: {"$in": under_ids}}
         elif isinstance(self, HasItemAttributeValue):
-            if self.not_value:
-                return {"attributes.option_id": {"$ne": self.attribute_option_id}}
-            else:
-                return {"attributes.option_id": self.attribute_option_id}
+            option_id = attribute_ids[self.attribute_name]
+            if negated:
+                return {"attributes.option_id": {"$ne": option_id}}
+            return {"attributes.option_id": option_id}
         elif isinstance(self, HasInstanceAttributeValue):
-            if self.not_value:
-                return {"instances.attributes.option_id": {"$ne": self.attribute_option_id}}
-            else:
-                return {"instances.attributes.option_id": self.attribute_option_id}
+            option_id = attribute_ids[self.attribute_name]
+            if negated:
+                return {"instances.attributes.option_id": {"$ne": option_id}}
+            return {"instances.attributes.option_id": option_id}
         elif isinstance(self, VisibleItemValue):
+            if negated:
+                return {"hidden": True}
             return {"hidden": {"$ne": True}}
-        elif isinstance(self, CheckItemAttributeValue):
+        elif isinstance(self, (CheckItemAttributeValue, CheckInstanceAttributeValue)):
+            field = "attributes" if isinstance(self, CheckItemAttributeValue) else "instances.attributes"
+            option_id = attribute_ids[self.attribute_name]
+
             if self.check_mode == CheckMode.Equals:
-                if self.not_value:
-                    return {"attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"$ne": self.value}}}}
-                else:
-                    return {"attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": self.value}}}
+                condition = {"value": self.value}
             elif self.check_mode == CheckMode.Contains:
-                if self.not_value:
-                    return {"attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"not": {"$regex": ".*" + self.value + ".*"}}}}}
-                else:
-                    return {"attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"$regex": ".*" + self.value + ".*"}}}}
+                condition = {"value": {"$regex": re.escape(self.value)}}
+            elif self.check_mode == CheckMode.IEquals:
+                condition = {"folded": self.value.lower()}
+            elif self.check_mode == CheckMode.StartsWith:
+                # an anchored regex with no options is bounded by the index on the folded values
+                condition = {"folded": {"$regex": "^" + re.escape(self.value.lower())}}
+            elif self.check_mode == CheckMode.EndsWith:
+                # the values are also stored reversed, so a suffix is an anchored regex on those
+                condition = {"folded_reversed": {"$regex": "^" + re.escape(self.value.lower()[::-1])}}
+            elif self.check_mode.is_numeric:
+                # comparisons with a number only match numbers, so this is a range scan of the integer values
+                condition = {"value": self.check_mode.range_query(self.value)}
             else:
                 return {"TODO": "Unexpected"}
-        elif isinstance(self, CheckInstanceAttributeValue):
+
+            (key, match), = condition.items()
+            if negated:
+                match = {"$not": match} if isinstance(match, dict) else {"$ne": match}
+            elif self.check_mode == CheckMode.Contains and trigrams(self.value):
+                # the index on the trigrams narrows the values down to the ones that could contain it,
+                # only those are checked against the regex
+                return {field: {"$elemMatch": {"option_id": option_id, "trigrams": {"$all": trigrams(self.value)}, key: match}}}
+            return {field: {"$elemMatch": {"option_id": option_id, key: match}}}
+
+    def to_item_ids(self, index: ItemIndex, tag_ids: Dict[str, ObjectId], attribute_ids: Dict[str, ObjectId],
+                    negated: bool = False, under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> Set[ObjectId]:
+        """
+        Evaluate the value/atom against an in-memory index, matching 
+        the same items as the query from to_search_query would.
+        The index must be locked, and the result must not be modified
+
+        Parameters
+        ----------
+            index
+                The index of every item
+            tag_ids
+                The ids of the tags, by name
+            attribute_ids
+                The ids of the attribute options, by name
+            negated
+                True to search for everything that doesn't match this value instead
+            under_tags
+                Every tag that transitively implies each tag searched for with '::under::', by tag id
+        """
+        if isinstance(self, (ItemTagValue, InstanceTagValue)):
+            postings = index.item_tags if isinstance(self, ItemTagValue) else index.instance_tags
+            result = postings.get(tag_ids[self.stripped_name], set())
+        elif isinstance(self, UnderTagValue):
+            postings = index.item_tags if isinstance(self, UnderItemTagValue) else index.instance_tags
+            tag_id = tag_ids[self.stripped_name]
+            result = set().union(*(postings.get(t, set()) for t in {tag_id} | under_tags[tag_id]))
+        elif isinstance(self, (HasItemAttributeValue, HasInstanceAttributeValue)):
+            postings = index.item_attributes if isinstance(self, HasItemAttributeValue) else index.instance_attributes
+            result = postings.get(attribute_ids[self.attribute_name], {}).keys()
+        elif isinstance(self, VisibleItemValue):
+            return index.hidden if negated else index.items - index.hidden
+        elif isinstance(self, (CheckItemAttributeValue, CheckInstanceAttributeValue)):
+            postings = index.item_attributes if isinstance(self, CheckItemAttributeValue) else index.instance_attributes
+            values_by_item = postings.get(attribute_ids[self.attribute_name], {})
+
             if self.check_mode == CheckMode.Equals:
-                if self.not_value:
-                    return {"instances.attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"$ne": self.value}}}}
-                else:
-                    return {"instances.attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": self.value}}}
+                def matches(v) -> bool:
+                    return v == self.value
             elif self.check_mode == CheckMode.Contains:
-                if self.not_value:
-                    return {"instances.attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"not": {"$regex": ".*" + self.value + ".*"}}}}}
-                else:
-                    return {"instances.attributes": {"$elemMatch": {"option_id": self.attribute_option_id, "value": {"$regex": ".*" + self.value + ".*"}}}}
+                def matches(v) -> bool:
+                    # like the query, a list of lines matches if any of them does
+                    return any(isinstance(line, str) and self.value in line for line in (v if isinstance(v, list) else [v]))
+            elif self.check_mode in (CheckMode.IEquals, CheckMode.StartsWith, CheckMode.EndsWith):
+                folded_value = self.value.lower()
+
+                def matches(v) -> bool:
+                    folded = fold_value(v)
+                    lines = folded if isinstance(folded, list) else [] if folded is None else [folded]
+                    if self.check_mode == CheckMode.IEquals:
+                        return folded_value in lines
+                    if self.check_mode == CheckMode.EndsWith:
+                        return any(line.endswith(folded_value) for line in lines)
+                    return any(line.startswith(folded_value) for line in lines)
+            elif self.check_mode.is_numeric:
+                comparisons = {"$gt": lambda v, n: v > n, "$gte": lambda v, n: v >= n,
+                               "$lt": lambda v, n: v < n, "$lte": lambda v, n: v <= n}
+                bounds = self.check_mode.range_query(self.value)
+
+                def matches(v) -> bool:
+                    return any(isinstance(n, (int, float)) and not isinstance(n, bool) and
+                               all(comparisons[op](n, bound) for op, bound in bounds.items())
+                               for n in (v if isinstance(v, list) else [v]))
             else:
-                return {"TODO": "Unexpected"}
+                return set()
+
+            candidates = None
+            if self.check_mode == CheckMode.Contains and not negated:
+                candidates = index.substring_candidates(attribute_ids[self.attribute_name], self.value,
+                                                        isinstance(self, CheckInstanceAttributeValue))
+            if candidates is not None:
+                return {i for i in candidates if any(matches(v) for v in values_by_item[i])}
+
+            # like $elemMatch, a negated check is for an item with any value that doesn't match
+            return {i for i, values in values_by_item.items() if any(matches(v) != negated for v in values)}
+        else:
+            return set()
+
+        if negated:
+            return index.items.difference(result)
+        return result
+
+    def to_tag_bits(self, matrix: TagMatrix, tag_ids: Dict[str, ObjectId], negated: bool = False,
+                    under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> 'np.ndarray':
+        """
+        Evaluate the value/atom against a bit matrix of the tags of every item, 
+        only if `tags_only` is true. The matrix must be locked
+
+        Parameters
+        ----------
+            matrix
+                The bit matrix of every item's tags
+            tag_ids
+                The ids of the tags, by name
+            negated
+                True to search for everything that doesn't match this value instead
+            under_tags
+                Every tag that transitively implies each tag searched for with '::under::', by tag id
+
+        Returns
+        -------
+            The packed bits of the matching items
+        """
+        if isinstance(self, (ItemTagValue, InstanceTagValue)):
+            result = matrix.tag_bits(tag_ids[self.stripped_name], isinstance(self, InstanceTagValue))
+        elif isinstance(self, UnderTagValue):
+            tag_id = tag_ids[self.stripped_name]
+            result = None
+            for t in {tag_id} | under_tags[tag_id]:
+                bits = matrix.tag_bits(t, isinstance(self, UnderInstanceTagValue))
+                result = bits if result is None else result | bits
+        elif isinstance(self, VisibleItemValue):
+            result = matrix.visible
+        else:
+            raise TypeError("only values where tags_only() is true can be searched for with a TagMatrix")
+
+        if negated:
+            return matrix.complement(result)
+        return result
 
 
 class TagValue(Value):
@@ -288,11 +500,15 @@ class TagValue(Value):
     A subclass of Value, for the specific case where the atom is 
     a tag, like 'a'
     """
+
+    __slots__ = ("stripped_name",)
     stripped_name: str
-    tag_id: Optional[ObjectId] = None
 
-    def __str__(self) -> str:
-        return super().__str__()
+    def __init__(self, stripped_name: str):
+        self._set(stripped_name=stripped_name)
+
+    def _key(self) -> tuple:
+        return (self.stripped_name,)
 
 
 class ItemTagValue(TagValue):
@@ -301,8 +517,10 @@ class ItemTagValue(TagValue):
     for a tag attached to an item, like 'a'  
     """
 
+    __slots__ = ()
+
     def __str__(self) -> str:
-        return super().__str__() + "Tag: '" + self.stripped_name + "'"
+        return "Tag: '" + self.stripped_name + "'"
 
 
 class InstanceTagValue(TagValue):
@@ -311,8 +529,44 @@ class InstanceTagValue(TagValue):
     for a tag attached to an instance, like 'instance::a'
     """
 
+    __slots__ = ()
+
     def __str__(self) -> str:
-        return super().__str__() + "InstanceTag: '" + self.stripped_name + "'"
+        return "InstanceTag: '" + self.stripped_name + "'"
+
+
+class UnderTagValue(TagValue):
+    """
+    A subclass of TagValue, for the specific case where the tag is 
+    searched for along with every tag that transitively implies it, like '::under::a' for
+    a category 'a' and everything in it
+    """
+
+    __slots__ = ()
+
+
+class UnderItemTagValue(UnderTagValue):
+    """
+    A subclass of UnderTagValue, for the specific case where the tags are 
+    attached to an item, like '::under::a'
+    """
+
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return "UnderTag: '" + self.stripped_name + "'"
+
+
+class UnderInstanceTagValue(UnderTagValue):
+    """
+    A subclass of UnderTagValue, for the specific case where the tags are 
+    attached to an instance, like '::instance::under::a'
+    """
+
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return "UnderInstanceTag: '" + self.stripped_name + "'"
 
 
 class AttributeValue(Value):
@@ -321,11 +575,14 @@ class AttributeValue(Value):
     for an attribute
     """
 
+    __slots__ = ("attribute_name",)
     attribute_name: str
-    attribute_option_id: Optional[ObjectId] = None
 
-    def __str__(self) -> str:
-        return super().__str__()
+    def __init__(self, attribute_name: str):
+        self._set(attribute_name=attribute_name)
+
+    def _key(self) -> tuple:
+        return (self.attribute_name,)
 
 
 class HasItemAttributeValue(AttributeValue):
@@ -334,8 +591,10 @@ class HasItemAttributeValue(AttributeValue):
     to have an attribute, like: 'has::name'
     """
 
+    __slots__ = ()
+
     def __str__(self) -> str:
-        return super().__str__() + "HasItemAttribute: '" + self.attribute_name + "'"
+        return "HasItemAttribute: '" + self.attribute_name + "'"
 
 
 class HasInstanceAttributeValue(AttributeValue):
@@ -344,43 +603,131 @@ class HasInstanceAttributeValue(AttributeValue):
     to have an attribute, like: 'instance::has::name'
     """
 
+    __slots__ = ()
+
     def __str__(self) -> str:
-        return super().__str__() + "HasInstanceAttribute: '" + self.attribute_name + "'"
+        return "HasInstanceAttribute: '" + self.attribute_name + "'"
 
 
 class CheckMode(Enum):
     """
-    For the value checks below, enumerates whether it is 'equals' or 'contains'
+    For the value checks below, enumerates whether it is 'equals', 'contains', 'iequals' (equals
+    ignoring case), 'startswith' or 'endswith' (also ignoring case), or a numeric 'gt', 'lt' or 'between'
+    (inclusive, like '3..5')
     """
 
     Equals = 0,
     Contains = 1
-    # TODO add more options? such as starts with/ends with, or case sensitive/case insensitive
+    IEquals = 2
+    StartsWith = 3
+    Gt = 4
+    Lt = 5
+    Between = 6
+    EndsWith = 7
+
+    @property
+    def is_numeric(self) -> bool:
+        """
+        Whether this check compares the value as a number
+        """
+        return self in (CheckMode.Gt, CheckMode.Lt, CheckMode.Between)
 
+    def range_query(self, value: str) -> Optional[Dict]:
+        """
+        Parses the value of a numeric check into the range of numbers it matches, like {"$gt": 3}
 
-class CheckItemAttributeValue(AttributeValue):
+        Returns
+        -------
+            The range as a MongoDB condition, or None if the value isn't a whole number, or two for 'between'
+        """
+        try:
+            if self == CheckMode.Gt:
+                return {"$gt": int(value)}
+            elif self == CheckMode.Lt:
+                return {"$lt": int(value)}
+            elif self == CheckMode.Between:
+                low, high = value.split("..")
+                return {"$gte": int(low), "$lte": int(high)}
+        except ValueError:
+            return None
+        return None
+
+    @property
+    def keyword(self) -> str:
+        """
+        The separator between the attribute name and the value for this check, like '::equals::'
+        """
+        return "::" + self.name.lower() + "::"
+
+    @staticmethod
+    def find(remain: str) -> Optional[Tuple[int, 'CheckMode']]:
+        """
+        Finds the first check keyword in the rest of a value, after its leading '::'
+
+        Returns
+        -------
+            The index of the keyword and the check it is for, or None if there isn't one
+        """
+        found = [(remain.find(mode.keyword), mode) for mode in CheckMode if mode.keyword in remain]
+        return min(found, key=lambda f: f[0]) if found else None
+
+
+class CheckAttributeValue(AttributeValue):
     """
-    A subclass of AttributeValue, for when checking for a specific 
-    value of an item's attribute, like 'name::equals::Bob' or 'name::contains::Bob'
+    A subclass of AttributeValue, for when checking for a specific value of an attribute
     """
 
+    __slots__ = ("check_mode", "value")
     check_mode: CheckMode
     value: str
 
+    def __init__(self, attribute_name: str, check_mode: CheckMode, value: str):
+        self._set(attribute_name=attribute_name, check_mode=check_mode, value=value)
+
+    def _key(self) -> tuple:
+        return self.attribute_name, self.check_mode, self.value
+
+    @classmethod
+    def from_check(cls, remain: str, index: int, check_mode: CheckMode) -> Union['CheckAttributeValue', SearchStringParseError]:
+        """
+        Makes the check from the rest of a value after its leading '::', like 'players::gt::3'
+
+        Parameters
+        ----------
+            remain
+                The rest of the value
+            index
+                The index of the check's keyword in `remain`
+            check_mode
+                The check the keyword is for
+        """
+        value = remain[index + len(check_mode.keyword):]
+        if check_mode.is_numeric and check_mode.range_query(value) is None:
+            return InvalidNumber(value, check_mode.keyword)
+        return cls(remain[:index].lower(), check_mode, value)
+
+
+class CheckItemAttributeValue(CheckAttributeValue):
+    """
+    A subclass of AttributeValue, for when checking for a specific 
+    value of an item's attribute, like 'name::equals::Bob' or 'name::contains::Bob'
+    """
+
+    __slots__ = ()
+
     def __str__(self) -> str:
         return "CheckItemAttribute: '" + self.attribute_name + "'" + " | " + str(
             self.check_mode) + " | '" + self.value + "'"
 
 
-class CheckInstanceAttributeValue(AttributeValue):
+class CheckInstanceAttributeValue(CheckAttributeValue):
     """
     A subclass of AttributeValue, for when checking for a specific 
     value of an instance's attribute, like 'name::equals::Bob' or 
     'name::contains::Bob'
     """
 
-    check_mode: CheckMode
-    value: str
+    __slots__ = ()
 
     def __str__(self) -> str:
         return "CheckInstanceAttribute: '" + self.attribute_name + "'" + " | " + str(
@@ -393,6 +740,11 @@ class VisibleItemValue(Value):
     provide visible visible items/instances from the DB
     """
 
+    __slots__ = ()
+
+    def __init__(self):
+        self._set()
+
     def __str__(self) -> str:
         return "VisibleItem"
 
@@ -408,95 +760,55 @@ class OperatorTypes(Enum):
     Or = "or"
 
 
-class Operator(metaclass=abc.ABCMeta):
+class Operator(SearchNode):
     """
     A general base class for the two types of operator (unitary, binary) 
     as a node in a abstact symbol tree of operators and values on the leafs
     """
 
-    op_type: OperatorTypes = None
-
-    def __init__(self, op_type: OperatorTypes):
-        self.op_type = op_type
-
-    @abc.abstractmethod
-    def get_left_most(self) -> Union['Operator', Value]:
-        """
-        Get the left most child of this node
-        """
-        pass
-
-    @abc.abstractmethod
-    def get_right_most(self) -> Union['Operator', Value]:
-        """
-        Get the right most child of this node
-        """
-        pass
+    __slots__ = ("op_type",)
+    op_type: OperatorTypes
 
-    @abc.abstractmethod
-    def set_left_most(self, value: Union['Operator', Value]):
+    def to_search_query(self, tag_ids: Dict[str, ObjectId], attribute_ids: Dict[str, ObjectId], negated: bool = False,
+                        under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> Dict:
         """
-        Set the left most child of this node
+    	Convert this node and it's children to a MongoDB query, pushing any not's down onto the
+        values with de-morgans law due to limitation in MongoDB search
         """
-        pass
+        return _evaluate_tree(self, negated, lambda v, n: v.to_search_query(tag_ids, attribute_ids, n, under_tags),
+                              _combine_queries)
 
-    @abc.abstractmethod
-    def set_right_most(self, value: Union['Operator', Value]):
+    def to_item_ids(self, index: ItemIndex, tag_ids: Dict[str, ObjectId], attribute_ids: Dict[str, ObjectId],
+                    negated: bool = False, under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> Set[ObjectId]:
         """
-        Set the right most child of this node
-        """
-        pass
-
-    @abc.abstractmethod
-    def __str__(self) -> str:
+    	Evaluate this node and it's children against an in-memory index, with set algebra
         """
-    	Convert back to string for debugging
-        """ 
-        pass
+        return _evaluate_tree(self, negated, lambda v, n: v.to_item_ids(index, tag_ids, attribute_ids, n, under_tags),
+                              lambda is_and, left, right: left & right if is_and else left | right)
 
-    @abc.abstractmethod
-    def to_search_query(self) -> Dict:
+    def to_tag_bits(self, matrix: TagMatrix, tag_ids: Dict[str, ObjectId], negated: bool = False,
+                    under_tags: Optional[Dict[ObjectId, FrozenSet[ObjectId]]] = None) -> 'np.ndarray':
         """
-    	Recursively convert this node and it's children to a MongoDB query
+    	Evaluate this node and it's children against a bit matrix, with bitwise operations
         """
-        pass
+        return _evaluate_tree(self, negated, lambda v, n: v.to_tag_bits(matrix, tag_ids, n, under_tags),
+                              lambda is_and, left, right: left & right if is_and else left | right)
 
 
 class UnitaryOperator(Operator):
     """
     A subclass of Operator for the specific instance of an operator 
-    that takes in one value, such as 'not' or the unity operator '()'
+    that takes in one value, such as 'not'
     """
+
+    __slots__ = ("value",)
     value: Union[Operator, Value]
 
     def __init__(self, op_type: OperatorTypes, value: Union[Operator, Value]):
-        super().__init__(op_type)
-
-        self.value = value
-
-    def get_left_most(self) -> Union[Operator, Value]:
-        """
-        Get the left most child of this node
-        """
-        return self.value
-
-    def get_right_most(self) -> Union[Operator, Value]:
-        """
-        Get the right most child of this node
-        """
-        return self.value
-
-    def set_left_most(self, value: Union[Operator, Value]):
-        """
-        Set the left most child of this node
-        """
-        self.value = value
+        self._set(op_type=op_type, value=value)
 
-    def set_right_most(self, value: Union[Operator, Value]):
-        """
-        Set the right most child of this node
-        """
-        self.value = value
+    def _key(self) -> tuple:
+        return self.op_type, self.value
 
     def __str__(self) -> str:
         """
@@ -507,15 +819,6 @@ class UnitaryOperator(Operator):
         else:
             return "::not " + str(self.value)
 
-    def to_search_query(self) -> Dict:
-        """
-    	Recursively convert this node and it's children to a MongoDB query
-        """
-        if self.op_type == OperatorTypes.Identity:
-            return self.value.to_search_query()
-        else:
-            return {"NOTE": "Should never be reached"}
-
 
 class BinaryOperator(Operator):
     """
@@ -523,38 +826,15 @@ class BinaryOperator(Operator):
     that takes in two values, such as 'and' or 'or'
     """
 
+    __slots__ = ("left_value", "right_value")
     left_value: Union[Operator, Value]
     right_value: Union[Operator, Value]
 
     def __init__(self, op_type: OperatorTypes, left_value: Union[Operator, Value], right_value: Union[Operator, Value]):
-        super().__init__(op_type)
+        self._set(op_type=op_type, left_value=left_value, right_value=right_value)
 
-        self.left_value = left_value
-        self.right_value = right_value
-
-    def get_left_most(self) -> Union[Operator, Value]:
-        """
-        Get the left most child of this node
-        """
-        return self.left_value
-
-    def get_right_most(self) -> Union[Operator, Value]:
-        """
-        Get the right most child of this node
-        """
-        return self.right_value
-
-    def set_left_most(self, value: Union[Operator, Value]):
-        """
-        Set the left most child of this node
-        """
-        self.left_value = value
-
-    def set_right_most(self, value: Union[Operator, Value]):
-        """
-        Set the right most child of this node
-        """
-        self.right_value = value
+    def _key(self) -> tuple:
+        return self.op_type, self.left_value, self.right_value
 
     def __str__(self) -> str:
         """
@@ -565,14 +845,60 @@ class BinaryOperator(Operator):
         else:
             return "(" + str(self.left_value) + " ::or " + str(self.right_value) + ")"
 
-    def to_search_query(self) -> Dict:
-        """
-    	Recursively convert this node and it's children to a MongoDB query
-        """
-        if self.op_type == OperatorTypes.And:
-            return {"$and": [self.left_value.to_search_query(), self.right_value.to_search_query()]}
+
+def _evaluate_tree(root: Union['Operator', Value], negated: bool, evaluate_value: Callable[[Value, bool], Any],
+                   combine: Callable[[bool, Any, Any], Any]) -> Any:
+    """
+    Evaluates a tree from the values up with an explicit stack instead of recursion, so a deep tree can't
+    exhaust the recursion limit. Any not's are pushed down onto the values along the way with de-morgans law
+
+    Parameters
+    ----------
+        root
+            The node to evaluate
+        negated
+            True to evaluate everything that doesn't match the node instead
+        evaluate_value
+            Evaluates a value, given whether it is negated
+        combine
+            Combines the results of the two sides of a binary operator, given whether they are and'ed together
+            (otherwise they are or'ed), and the left and right results
+    """
+    results = []
+    # (node, negated, whether its children have been evaluated)
+    stack = [(root, negated, False)]
+
+    while stack:
+        node, negated, evaluated = stack.pop()
+        if isinstance(node, UnitaryOperator):
+            # !!a -> a
+            stack.append((node.value, negated != (node.op_type == OperatorTypes.Not), False))
+        elif isinstance(node, BinaryOperator):
+            if evaluated:
+                right = results.pop()
+                left = results.pop()
+                # !(a && b) -> (!a || !b) and !(a || b) -> (!a && !b)
+                results.append(combine((node.op_type == OperatorTypes.And) != negated, left, right))
+            else:
+                stack.append((node, negated, True))
+                stack.append((node.right_value, negated, False))
+                stack.append((node.left_value, negated, False))
         else:
-            return {"$or": [self.left_value.to_search_query(), self.right_value.to_search_query()]}
+            results.append(evaluate_value(node, negated))
+
+    return results[0]
+
+
+def _combine_queries(is_and: bool, left: Dict, right: Dict) -> Dict:
+    """
+    Joins two compiled queries with $and or $or, adding to the list of either side if it is already the same
+    operator, so a long chain like 'a, b, c' becomes one flat list rather than nesting as deep as it is long
+    """
+    op = "$and" if is_and else "$or"
+    terms = left[op] if list(left) == [op] else [left]
+    terms.extend(right[op] if list(right) == [op] else [right])
+    return {op: terms}
+
 
 class LexerSymbolTypes(Enum):
     """
@@ -616,6 +942,8 @@ class LexerSymbol:
     A class used by the lexer to store the symbols it extracts
     """
 
+    __slots__ = ("symbol_type", "start_index", "end_index")
+
     symbol_type: LexerSymbolTypes
     start_index: int
     end_index: int
@@ -636,10 +964,32 @@ class LexerSymbol:
         return "[" + str(self.start_index) + ", " + str(self.end_index) + "]" + symbol_str
 
 
+# every symbol the lexer splits on, found in a single left to right scan of the string
+_LEXER_SYMBOL_REGEX = re.compile(r"[{}(),\-]|::and|::not|::or")
+_NON_SPACE_REGEX = re.compile(r"\S")
+
+
+def _append_tag_symbol(result: List[LexerSymbol], search_string: str, start: int, end: int):
+    """
+    Appends a tag symbol for `search_string[start:end]` with the surrounding whitespace trimmed off,
+    if there is anything left of it, without copying the text
+    """
+    first = _NON_SPACE_REGEX.search(search_string, start, end)
+    if first is None:
+        return
+
+    last = end - 1
+    while search_string[last].isspace():
+        last -= 1
+
+    result.append(LexerSymbol(LexerSymbolTypes.TAG, first.start(), last))
+
+
 #  a lexer to turn the string into an array of symbols
 def search_string_lexer(search_string: str) -> Union[List[LexerSymbol], SearchStringParseError]:
     """
-    Takes in a search string and converts it intl an array of lexer symbols
+    Takes in a search string and converts it intl an array of lexer symbols.
+    Only the symbols are visited, so this is linear in the length of the string
     """
 
     result = []
@@ -648,17 +998,23 @@ def search_string_lexer(search_string: str) -> Union[List[LexerSymbol], SearchSt
     paren_depth = 0
     symbol_start = 0
     skipped = False
+    # the first non whitespace character at or after symbol_start, so escapes can check what's before them cheaply
+    first_non_space = -1
 
-    for i, c in enumerate(search_string):
+    for match in _LEXER_SYMBOL_REGEX.finditer(search_string):
+        i = match.start()
+        c = search_string[i]
 
         if c == '{':
             escape_depth += 1
 
             if escape_depth == 1:
-                if search_string[symbol_start:i].isspace():
-                    # result.append(
-                    #     LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
+                if first_non_space < symbol_start:
+                    found = _NON_SPACE_REGEX.search(search_string, symbol_start)
+                    first_non_space = len(search_string) if found is None else found.start()
 
+                # an escape only opens if there is nothing but whitespace before it
+                if symbol_start < i <= first_non_space:
                     result.append(LexerSymbol(LexerSymbolTypes.ESCAPE_OPEN, i, i))
                     symbol_start = i + 1
 
@@ -670,66 +1026,39 @@ def search_string_lexer(search_string: str) -> Union[List[LexerSymbol], SearchSt
             escape_depth -= 1
 
             if escape_depth == 0 and not skipped:
-                result.append(LexerSymbol(LexerSymbolTypes.TAG, symbol_start, i - 1))
+                _append_tag_symbol(result, search_string, symbol_start, i)
                 result.append(LexerSymbol(LexerSymbolTypes.ESCAPE_CLOSE, i, i))
 
                 symbol_start = i + 1
             elif escape_depth < 0:
                 return UnexpectedCloseBracket(i, Brackets.Curly)
         elif escape_depth == 0:
-            if c == '(' or c == ')':
-                if c == '(':
-                    paren_depth += 1
-                else:
-                    paren_depth -= 1
-
-                    if paren_depth < 0:
-                        return UnexpectedCloseBracket(i, Brackets.Parentheses)
-
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.from_str(c), i, i))
-                symbol_start = i + 1
-
-            if c == ',':
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.AND, i, i))
-                symbol_start = i + 1
-
-            if search_string[i:].startswith("::and"):
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.AND, i, i + 4))
-                symbol_start = i + 5
-
-            if c == '-':
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.NOT, i, i))
-                symbol_start = i + 1
-
-            if search_string[i:].startswith("::not"):
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.NOT, i, i + 4))
-                symbol_start = i + 5
-
-            if search_string[i:].startswith("::or"):
-                result.append(
-                    LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:i]), symbol_start, i - 1))
-                result.append(LexerSymbol(LexerSymbolTypes.OR, i, i + 3))
-                symbol_start = i + 4
-
-    if not search_string[symbol_start:].isspace():
-        result.append(LexerSymbol(LexerSymbolTypes.from_str(search_string[symbol_start:]), symbol_start,
-                                  len(search_string) - 1))
+            if c == '(':
+                paren_depth += 1
+                symbol_type = LexerSymbolTypes.PAREN_OPEN
+            elif c == ')':
+                paren_depth -= 1
+
+                if paren_depth < 0:
+                    return UnexpectedCloseBracket(i, Brackets.Parentheses)
+
+                symbol_type = LexerSymbolTypes.PAREN_CLOSE
+            elif c == ',':
+                symbol_type = LexerSymbolTypes.AND
+            elif c == '-':
+                symbol_type = LexerSymbolTypes.NOT
+            elif search_string[i + 2] == 'a':
+                symbol_type = LexerSymbolTypes.AND
+            elif search_string[i + 2] == 'n':
+                symbol_type = LexerSymbolTypes.NOT
+            else:
+                symbol_type = LexerSymbolTypes.OR
 
-    for r in result:
-        r.start_index += (r.end_index - r.start_index + 1) - len(search_string[r.start_index:r.end_index + 1].lstrip())
-        r.end_index -= (r.end_index - r.start_index + 1) - len(search_string[r.start_index:r.end_index + 1].rstrip())
+            _append_tag_symbol(result, search_string, symbol_start, i)
+            result.append(LexerSymbol(symbol_type, i, match.end() - 1))
+            symbol_start = match.end()
 
-    result = [r for r in result if r.start_index <= r.end_index]
+    _append_tag_symbol(result, search_string, symbol_start, len(search_string))
 
     if escape_depth != 0:
         return MissingCloseBracket(Brackets.Curly)
@@ -741,146 +1070,554 @@ def search_string_lexer(search_string: str) -> Union[List[LexerSymbol], SearchSt
 
 class AST:
     """
-    Used to store the abstract symbol tree
+    Used to store the abstract symbol tree, along with the names it references so they can be looked up
+    before converting it into a query. Equal searches give equal trees, so it can be hashed
     """
 
-    base_operator: Operator
-    tag_values: List[TagValue] = []
-    attribute_values: List[AttributeValue] = []
+    __slots__ = ("base_operator", "tag_names", "attribute_names", "under_names")
+
+    base_operator: Union[Operator, Value]
+    tag_names: FrozenSet[str]
+    attribute_names: FrozenSet[str]
+    under_names: FrozenSet[str]
+    """
+    The names of the tags searched for with '::under::', which are also in tag_names
+    """
 
-    def __init__(self, base_operator: Operator):
+    def __init__(self, base_operator: Union[Operator, Value], tag_names: FrozenSet[str], attribute_names: FrozenSet[str],
+                 under_names: FrozenSet[str] = frozenset()):
         self.base_operator = base_operator
-        self.tag_values = []
-        self.attribute_values = []
+        self.tag_names = tag_names
+        self.attribute_names = attribute_names
+        self.under_names = under_names
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AST) and self.base_operator == other.base_operator
+
+    def __hash__(self) -> int:
+        return hash(self.base_operator)
 
     def __str__(self) -> str:
         return str(self.base_operator)
 
 
+# how tightly each operator binds, so 'a ::or b, -c' is 'a ::or (b ::and (::not c))'
+_BINDING_POWERS = {
+    LexerSymbolTypes.OR: 1,
+    LexerSymbolTypes.AND: 2,
+    LexerSymbolTypes.NOT: 3,
+}
+
+
+def _parser_symbols(search_string: str, lex_symbols: List[LexerSymbol]) -> List[Tuple[LexerSymbolTypes, int, int]]:
+    """
+    Joins the symbols that are a part of a tag back into the tag, so 'spider-man' and 'dune (1984) remastered'
+    are single tags, and drops the escapes which have done their job in the lexer
+    """
+
+    result = []
+    tag_start = tag_end = None
+    embedded_paren = 0
+
+    for s in lex_symbols:
+        symbol_type = s.symbol_type
+
+        if symbol_type == LexerSymbolTypes.TAG:
+            # 'a' 'b' -> 'a b'
+            if tag_start is None:
+                tag_start = s.start_index
+            tag_end = s.end_index
+        elif tag_start is not None and symbol_type == LexerSymbolTypes.PAREN_OPEN:
+            # 'a' '(' -> 'a ('
+            tag_end = s.end_index
+            embedded_paren += 1
+        elif tag_start is not None and symbol_type == LexerSymbolTypes.NOT and search_string[s.start_index] == '-':
+            # 'a' '-' -> 'a -'
+            tag_end = s.end_index
+        elif symbol_type == LexerSymbolTypes.PAREN_CLOSE and embedded_paren > 0:
+            # '( a' ')' -> '( a )'
+            embedded_paren -= 1
+            if tag_start is not None:
+                tag_end = s.end_index
+        else:
+            if tag_start is not None:
+                result.append((LexerSymbolTypes.TAG, tag_start, tag_end))
+                tag_start = None
+
+            if symbol_type != LexerSymbolTypes.ESCAPE_OPEN and symbol_type != LexerSymbolTypes.ESCAPE_CLOSE:
+                result.append((symbol_type, s.start_index, s.end_index))
+
+    if tag_start is not None:
+        result.append((LexerSymbolTypes.TAG, tag_start, tag_end))
+
+    return result
+
+
+class _Parser:
+    """
+    A Pratt parser over the symbols of a search string
+    """
+
+    def __init__(self, search_string: str, symbols: List[Tuple[LexerSymbolTypes, int, int]]):
+        self.search_string = search_string
+        self.symbols = symbols
+        self.position = 0
+        self.depth = 0
+        self.tag_names = set()
+        self.attribute_names = set()
+        self.under_names = set()
+
+    def operator_error(self, symbol: Tuple[LexerSymbolTypes, int, int]) -> UnexpectedOperator:
+        symbol_type, start, end = symbol
+        op_type = {LexerSymbolTypes.AND: OperatorTypes.And,
+                   LexerSymbolTypes.OR: OperatorTypes.Or,
+                   LexerSymbolTypes.NOT: OperatorTypes.Not}[symbol_type]
+        return UnexpectedOperator(start, op_type, self.search_string[start:end + 1])
+
+    def parse_expression(self, min_power: int, after: Optional[Tuple[LexerSymbolTypes, int, int]]) \
+            -> Union[Operator, Value, SearchStringParseError]:
+        """
+        Parses an expression, stopping at the first operator that doesn't bind tighter than `min_power`.
+        Each nested expression goes a level deeper, up to SearchLimits.max_depth
+
+        Parameters
+        ----------
+            min_power
+                The binding power of the operator this expression is an operand of
+            after
+                The operator this expression is an operand of, for reporting errors
+        """
+
+        if self.depth == SearchLimits.max_depth:
+            return SearchTooComplex("depth", SearchLimits.max_depth)
+        self.depth += 1
+        result = self._parse_expression(min_power, after)
+        self.depth -= 1
+        return result
+
+    def _parse_expression(self, min_power: int, after: Optional[Tuple[LexerSymbolTypes, int, int]]) \
+            -> Union[Operator, Value, SearchStringParseError]:
+        if self.position == len(self.symbols):
+            return self.operator_error(after) if after is not None else EmptySearch()
+
+        symbol = self.symbols[self.position]
+        symbol_type, start, end = symbol
+        self.position += 1
+
+        if symbol_type == LexerSymbolTypes.TAG:
+            left = Value.parse(self.search_string[start:end + 1])
+            if isinstance(left, SearchStringParseError):
+                return left
+            if isinstance(left, TagValue):
+                self.tag_names.add(left.stripped_name)
+                if isinstance(left, UnderTagValue):
+                    self.under_names.add(left.stripped_name)
+            elif isinstance(left, AttributeValue):
+                self.attribute_names.add(left.attribute_name)
+        elif symbol_type == LexerSymbolTypes.NOT:
+            value = self.parse_expression(_BINDING_POWERS[LexerSymbolTypes.NOT], symbol)
+            if isinstance(value, SearchStringParseError):
+                return value
+            left = UnitaryOperator(OperatorTypes.Not, value)
+        elif symbol_type == LexerSymbolTypes.PAREN_OPEN:
+            left = self.parse_expression(0, None)
+            if isinstance(left, SearchStringParseError):
+                return left
+            if self.position == len(self.symbols):
+                return MissingCloseBracket(Brackets.Parentheses)
+            self.position += 1
+        elif symbol_type == LexerSymbolTypes.PAREN_CLOSE:
+            return UnexpectedCloseBracket(start, Brackets.Parentheses)
+        else:
+            return self.operator_error(symbol)
+
+        while self.position < len(self.symbols):
+            symbol = self.symbols[self.position]
+            symbol_type, start, end = symbol
+
+            if symbol_type == LexerSymbolTypes.PAREN_CLOSE:
+                break
+            if symbol_type != LexerSymbolTypes.AND and symbol_type != LexerSymbolTypes.OR:
+                # two values with nothing joining them, like 'a ::not b'
+                return UnexpectedTag(start, self.search_string[start:end + 1])
+
+            power = _BINDING_POWERS[symbol_type]
+            if power <= min_power:
+                break
+            self.position += 1
+
+            right = self.parse_expression(power, symbol)
+            if isinstance(right, SearchStringParseError):
+                return right
+
+            op_type = OperatorTypes.And if symbol_type == LexerSymbolTypes.AND else OperatorTypes.Or
+            left = BinaryOperator(op_type, left, right)
+
+        return left
+
+
 #  a parser to turn the symbols from the lexer into an AST, or in this case a tree of operators
-def search_string_parser(search_string: Union[str, List[LexerSymbol]]) -> Union[AST, SearchStringParseError]:
+def search_string_parser(search_string: str) -> Union[AST, SearchStringParseError]:
     """
-    Takes in a search string, or array of lexer symbols, converts 
-    the string into an array of lexer symbols if needed, then converts 
-    that into the abstract symbol tree
+    Takes in a search string, converts it into an array of lexer symbols, 
+    then parses that into the abstract symbol tree in a single pass.
+    ::not binds tighter than ::and, which binds tighter than ::or.
+    Searches over the SearchLimits on depth or terms are rejected before they're parsed any further
     """
 
-    if isinstance(search_string, str):
-        lex_symbols = search_string_lexer(search_string)
-        if isinstance(lex_symbols, SearchStringParseError):
-            return lex_symbols
+    lex_symbols = search_string_lexer(search_string)
+    if isinstance(lex_symbols, SearchStringParseError):
+        return lex_symbols
+
+    symbols = _parser_symbols(search_string, lex_symbols)
+    if sum(1 for s in symbols if s[0] == LexerSymbolTypes.TAG) > SearchLimits.max_terms:
+        return SearchTooComplex("number of terms", SearchLimits.max_terms)
+
+    parser = _Parser(search_string, symbols)
+
+    base_operator = parser.parse_expression(0, None)
+    if isinstance(base_operator, SearchStringParseError):
+        return base_operator
+
+    if parser.position != len(parser.symbols):
+        return UnexpectedCloseBracket(parser.symbols[parser.position][1], Brackets.Parentheses)
+
+    return AST(base_operator, frozenset(parser.tag_names), frozenset(parser.attribute_names), frozenset(parser.under_names))
+
+
+def narrow_search(search_string: str, term: str) -> str:
+    """
+    Builds a search for the items matching both a search string and a single term, such as a tag name
+    or '::instance::' followed by one. The term is escaped, so names with ',', '-' or brackets are taken
+    as they are, and the search string is bracketed, so its '::or's don't swallow the term
+
+    Parameters
+    ----------
+        search_string
+            The search being narrowed
+        term
+            The term to add to it, not escaped
+
+    Returns
+    -------
+        The narrowed search string
+    """
+    # an escape only opens after whitespace, so the space after the ',' matters
+    return "(" + search_string + "), {" + term + "}"
+
+
+# the fields that hold tag ids, so terms on them can be estimated from the number of items with each tag
+_TAG_FIELDS = {"all_tags", "instances.all_tags"}
+
+
+def _is_field_term(term: Dict) -> bool:
+    """
+    Checks if a term is a condition on a single field, like {"tags": id} or {"tags": {"$ne": id}}
+    """
+    return len(term) == 1 and not next(iter(term)).startswith("$")
+
+
+def _is_plain_value(value) -> bool:
+    """
+    Checks if a value is matched by plain equality, rather than being an operator document or a whole array
+    """
+    return not isinstance(value, (dict, list))
+
+
+def _merge_terms(op: str, terms: List[Dict]) -> List[Dict]:
+    """
+    Merges the equality terms on the same field of an $and into $all and $nin, or of an $or into $in.
+    A merged term takes the place of the first term it was merged from
+    """
+    if op == "$and":
+        merges = {"$all": lambda v: [v] if _is_plain_value(v) else v.get("$all") if list(v) == ["$all"] else None,
+                  "$nin": lambda v: v.get("$nin") if isinstance(v, dict) and list(v) == ["$nin"] else
+                  [v["$ne"]] if isinstance(v, dict) and list(v) == ["$ne"] and _is_plain_value(v["$ne"]) else None}
     else:
-        lex_symbols = search_string
+        merges = {"$in": lambda v: [v] if _is_plain_value(v) else v.get("$in") if list(v) == ["$in"] else None}
 
-    # one pass to absorb (, ) or - that are a part of tags
+    # (field, merged operator) -> the values merged so far
+    merged: Dict[Tuple[str, str], List] = {}
+    result = []
 
-    paren_depth = 0
-    embedded_paren = 0
+    for term in terms:
+        if _is_field_term(term):
+            field, value = next(iter(term.items()))
+            for merge_op, values_of in merges.items():
+                values = values_of(value)
+                if values is None:
+                    continue
+
+                key = (field, merge_op)
+                if key in merged:
+                    merged[key].extend(v for v in values if v not in merged[key])
+                else:
+                    merged[key] = list(values)
+                    result.append(key)
+                break
+            else:
+                result.append(term)
+        else:
+            result.append(term)
+
+    # single values go back to their simplest form
+    for i, term in enumerate(result):
+        if isinstance(term, tuple):
+            field, merge_op = term
+            values = merged[term]
+            if len(values) == 1 and merge_op != "$nin":
+                result[i] = {field: values[0]}
+            elif len(values) == 1:
+                result[i] = {field: {"$ne": values[0]}}
+            else:
+                result[i] = {field: {merge_op: values}}
 
-    for i, s in enumerate(lex_symbols):
-        if s.symbol_type == LexerSymbolTypes.PAREN_OPEN:
-            paren_depth += 1
+    return result
 
-        if s.symbol_type == LexerSymbolTypes.PAREN_OPEN or search_string[s.start_index] == '-':
-            if i != 0 and lex_symbols[i - 1].symbol_type == LexerSymbolTypes.TAG:
-                # 'a' '(' -> 'a (' or 'a' '-' -> 'a -'
-                lex_symbols[i - 1].end_index = s.end_index
-                s.symbol_type = LexerSymbolTypes.IGNORE
-                embedded_paren += 1
 
-        if s.symbol_type == LexerSymbolTypes.PAREN_CLOSE:
-            if i != len(lex_symbols) - 1 and lex_symbols[i + 1].symbol_type == LexerSymbolTypes.TAG:
-                # ')' 'a' -> ') a'
-                s.end_index = lex_symbols[i + 1].end_index
-                s.symbol_type = LexerSymbolTypes.TAG
-                lex_symbols[i + 1].symbol_type = LexerSymbolTypes.IGNORE
-            elif embedded_paren > 0:
-                # '( a' ')' -> '( a )'
-                lex_symbols[i-1].end_index = s.end_index
-                s.symbol_type = LexerSymbolTypes.IGNORE
-                embedded_paren -= 1
+def _estimate_matches(term: Dict, tag_counts: Dict[ObjectId, int], total: int) -> int:
+    """
+    Estimates how many items a term matches from the number of items with each tag,
+    anything that isn't about tags is assumed to match everything
+    """
+    if "$and" in term and len(term) == 1:
+        return min(_estimate_matches(t, tag_counts, total) for t in term["$and"])
+    if "$or" in term and len(term) == 1:
+        return min(total, sum(_estimate_matches(t, tag_counts, total) for t in term["$or"]))
+
+    if not _is_field_term(term):
+        return total
+    field, value = next(iter(term.items()))
+    if field not in _TAG_FIELDS:
+        return total
+
+    if _is_plain_value(value):
+        return tag_counts.get(value, 0)
+    if isinstance(value, dict) and len(value) == 1:
+        op, values = next(iter(value.items()))
+        if op == "$all":
+            return min(tag_counts.get(v, 0) for v in values)
+        if op == "$in":
+            return min(total, sum(tag_counts.get(v, 0) for v in values))
+        if op == "$ne":
+            return max(0, total - tag_counts.get(values, 0))
+        if op == "$nin":
+            return max(0, total - max(tag_counts.get(v, 0) for v in values))
+    return total
+
+
+def optimize_query(query: Dict, tag_counts: Optional[Dict[ObjectId, int]] = None, total: int = 0) -> Dict:
+    """
+    Simplifies a compiled search so MongoDB gets a flat, index friendly filter. Nested $and's and $or's are
+    flattened into their parent, equality terms on the same field are merged into $all, $in and $nin, and
+    the terms of an $and are ordered so the ones expected to match the fewest items come first
+
+    Parameters
+    ----------
+        query
+            The MongoDB query produced by to_search_query
+        tag_counts
+            The number of items with each tag, if None the terms are left in their original order
+        total
+            The total number of items
+
+    Returns
+    -------
+        An equivalent MongoDB query
+    """
+    if len(query) != 1:
+        return query
 
-            paren_depth -= 1
-            if paren_depth < 0:
-                return UnexpectedCloseBracket(s.start_index, Brackets.Parentheses)
+    op, terms = next(iter(query.items()))
+    if op != "$and" and op != "$or":
+        return query
 
-    # one pass to remove ignore
+    flattened = []
+    for term in terms:
+        term = optimize_query(term, tag_counts, total)
+        for sub_term in term[op] if len(term) == 1 and op in term else [term]:
+            # (a && b) && c -> a && b && c, and a && a -> a
+            if sub_term not in flattened:
+                flattened.append(sub_term)
 
-    lex_symbols = [ls for ls in lex_symbols if ls.symbol_type != LexerSymbolTypes.IGNORE]
+    flattened = _merge_terms(op, flattened)
 
-    # one pass to combine adj tags
+    if op == "$and" and tag_counts is not None:
+        flattened.sort(key=lambda t: _estimate_matches(t, tag_counts, total))
 
-    for i, s in enumerate(lex_symbols):
-        if i == 0:
-            continue
+    if len(flattened) == 1:
+        return flattened[0]
+    return {op: flattened}
 
-        if s.symbol_type == LexerSymbolTypes.TAG and lex_symbols[i - 1].symbol_type == LexerSymbolTypes.TAG:
-            lex_symbols[i - 1].symbol_type = LexerSymbolTypes.IGNORE
-            s.start_index = lex_symbols[i - 1].start_index
 
-    # form ast
+class TagItemCounts:
+    """
+    A periodically refreshed copy of the number of items with each tag, used to order search terms
+    """
 
-    ast = AST(UnitaryOperator(OperatorTypes.Identity, None))
-    operator_stack: List[Union[Operator, Value]] = [ast.base_operator]
+    _counts: Dict[int, 'TagItemCounts'] = {}
 
-    escape_depth = 0
+    ttl: float = 10 * 60
+    """
+    The number of seconds the counts are kept for before being counted again
+    """
 
-    for symbol in lex_symbols:
-        if symbol.symbol_type == LexerSymbolTypes.ESCAPE_OPEN:
-            escape_depth += 1
-        elif symbol.symbol_type == LexerSymbolTypes.ESCAPE_CLOSE:
-            escape_depth -= 1
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.expires = 0
+        self.tag_counts = {}
+        self.total = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'TagItemCounts':
+        """
+        Gets the counts for a database, creating empty ones if they don't exist yet
+        """
+        counts = TagItemCounts._counts.get(id(mongo))
+        if counts is None:
+            counts = TagItemCounts._counts.setdefault(id(mongo), TagItemCounts(mongo))
+        return counts
+
+    def get(self) -> Tuple[Dict[ObjectId, int], int]:
+        """
+        Gets the number of items with each tag, counting them again if they have expired
+
+        Returns
+        -------
+            A dictionary from tag id to the number of items with it, and the total number of items
+        """
+        matrix = TagMatrix.for_mongo(self.mongo)
+        if matrix.enabled:
+            # counting the bits is cheap enough to always be up to date
+            with matrix.lock:
+                if matrix.ensure_loaded():
+                    return matrix.count_tags(), len(matrix.item_ids)
 
-            if escape_depth < 0:
-                return UnexpectedCloseBracket(symbol.start_index, Brackets.Curly)
-        elif symbol.symbol_type == LexerSymbolTypes.PAREN_OPEN and escape_depth == 0:
-            new_operator = UnitaryOperator(OperatorTypes.Identity, None)
-
-            operator_stack[-1].set_right_most(new_operator)
-            operator_stack.append(new_operator)
-        elif symbol.symbol_type == LexerSymbolTypes.PAREN_CLOSE and escape_depth == 0:
-            operator_stack.pop()
-            if not operator_stack:
-                return UnexpectedCloseBracket(symbol.start_index, Brackets.Parentheses)
-        elif symbol.symbol_type == LexerSymbolTypes.NOT:
-            new_operator = UnitaryOperator(OperatorTypes.Not, None)
-
-            operator_stack[-1].set_right_most(new_operator)
-            operator_stack.append(new_operator)
-        elif symbol.symbol_type == LexerSymbolTypes.AND or symbol.symbol_type == LexerSymbolTypes.OR:
-            left = operator_stack[-1].get_right_most()
-            op_type = OperatorTypes.And if symbol.symbol_type == LexerSymbolTypes.AND else OperatorTypes.Or
-            if left is None:
-                return UnexpectedOperator(symbol.start_index, op_type)
-
-            if isinstance(left, Operator) and left.op_type == OperatorTypes.Identity:
-                left = left.get_left_most()
-
-            new_operator = BinaryOperator(op_type, left, None)
-            operator_stack[-1].set_right_most(new_operator)
-            operator_stack.append(new_operator)
-        elif symbol.symbol_type != LexerSymbolTypes.IGNORE:
-            value = Value.parse(search_string[symbol.start_index:symbol.end_index + 1])
-
-            if isinstance(value, TagValue):
-                ast.tag_values.append(value)
-            elif isinstance(value, AttributeValue):
-                ast.attribute_values.append(value)
-
-            operator_stack[-1].set_right_most(value)
-            # if len(operator_stack) > 1:
-            #     operator_stack.pop()
-            #     if len(operator_stack) > 1:
-            #         operator_stack.pop()
-
-    return ast
+        with self.lock:
+            if self.expires < time.monotonic():
+                self.tag_counts, self.total = Item.count_per_tag(self.mongo)
+                self.expires = time.monotonic() + self.ttl
+            return self.tag_counts, self.total
+
+
+class CompiledQueryCache:
+    """
+    A least recently used cache of compiled searches. It is keyed by the parsed search, so differently
+    written versions of the same search share an entry. Entries expire after `ttl` seconds, and are dropped
+    once a tag they reference is renamed or deleted, or any attribute option is changed
+    """
+
+    _caches: Dict[int, 'CompiledQueryCache'] = {}
+
+    max_size: int = 256
+    """
+    The most searches kept at once
+    """
+
+    ttl: float = 5 * 60
+    """
+    The number of seconds a search is kept for
+    """
+
+    def __init__(self, mongo: PyMongo):
+        self.mongo = mongo
+        self.entries = OrderedDict()
+        self.attribute_generation = None
+        self.lock = Lock()
+
+    @staticmethod
+    def for_mongo(mongo: PyMongo) -> 'CompiledQueryCache':
+        """
+        Gets the cache for a database, creating an empty one if it doesn't exist yet
+        """
+        cache = CompiledQueryCache._caches.get(id(mongo))
+        if cache is None:
+            cache = CompiledQueryCache._caches.setdefault(id(mongo), CompiledQueryCache(mongo))
+        return cache
+
+    def validate(self, attribute_generation: Optional[int] = None):
+        """
+        Drops every search that references an attribute if the attribute options have changed since they were compiled
+
+        Parameters
+        ----------
+            attribute_generation
+                The current generation of the attribute options, if it has already been read from the database
+        """
+        if attribute_generation is None:
+            attribute_generation = get_generation(self.mongo, AttributeOption.GENERATION_NAME)
+
+        with self.lock:
+            if attribute_generation != self.attribute_generation:
+                self.entries = OrderedDict((k, e) for k, e in self.entries.items() if not e[3])
+                self.attribute_generation = attribute_generation
+
+    def get(self, ast: AST, include_hidden: bool) -> Optional[Dict]:
+        """
+        Finds a compiled search
+
+        Parameters
+        ----------
+            ast
+                The parsed search
+            include_hidden
+                Whether the search includes hidden items
+
+        Returns
+        -------
+            The MongoDB query, which must not be modified, or None if it isn't cached or is stale
+        """
+        key = (ast, include_hidden)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, query, tag_ids, uses_attributes, under_tags = entry
+            tag_cache = TagCache.for_mongo(self.mongo)
+            graph = TagGraph.for_mongo(self.mongo)
+            if expires < time.monotonic() or any(tag_cache.id_for_name(n) != i for n, i in tag_ids.items()) or \
+                    any(graph.ancestors(i) != u for i, u in under_tags.items()):
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return query
+
+    def put(self, ast: AST, include_hidden: bool, query: Dict, tag_ids: Dict[str, ObjectId],
+            under_tags: Dict[ObjectId, FrozenSet[ObjectId]]):
+        """
+        Caches a compiled search
+
+        Parameters
+        ----------
+            ast
+                The parsed search
+            include_hidden
+                Whether the search includes hidden items
+            query
+                The MongoDB query
+            tag_ids
+                The ids of the tags the search referenced when it was compiled, by name
+            under_tags
+                Every tag that implied each tag the search referenced with '::under::' when it was compiled, by tag id
+        """
+        with self.lock:
+            self.entries[(ast, include_hidden)] = (time.monotonic() + self.ttl, query, tag_ids, bool(ast.attribute_names),
+                                                   under_tags)
+            self.entries.move_to_end((ast, include_hidden))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
 
 
 def search_string_to_mongodb_query(mongo: PyMongo, search_string: Union[str, AST], include_hidden: bool = False) -> Union[Dict, List[SearchStringParseError]]:
     """
     Takes in a search string, or AST and converts the search string 
     into an AST if neededed, then does all the processing needed to 
-    convert that AST into a query that MongoDB understands
+    convert that AST into a query that MongoDB understands.
+    Compiled searches are cached, so the result must not be modified.
+    Searches that compile to a filter bigger than SearchLimits.max_filter_bytes are rejected
     """
 
     if isinstance(search_string, str):
@@ -890,89 +1627,156 @@ def search_string_to_mongodb_query(mongo: PyMongo, search_string: Union[str, AST
     else:
         ast: AST = search_string
 
+    cache = CompiledQueryCache.for_mongo(mongo)
+    query = cache.get(ast, include_hidden)
+    if query is not None:
+        return query
+
+    names = _resolve_names(mongo, ast)
+    if isinstance(names, list):
+        return names
+    tag_ids, attribute_ids, under_tags = names
+
     # if not include_hidden then add that condition
 
+    base_operator = ast.base_operator
     if not include_hidden:
-        ast.base_operator = BinaryOperator(OperatorTypes.And, ast.base_operator, VisibleItemValue())
+        base_operator = BinaryOperator(OperatorTypes.And, base_operator, VisibleItemValue())
 
-    # verify existence of tags/attribs and get their ids
+    # now form into a search, the not's are moved onto the atomic values along the way
 
-    tag_names: Dict[str, TagValue] = {t.stripped_name: t for t in ast.tag_values}
-    attribute_names: Dict[str, AttributeValue] = {a.attribute_name: a for a in ast.attribute_values}
+    query = base_operator.to_search_query(tag_ids, attribute_ids, under_tags=under_tags)
+    query = optimize_query(query, *TagItemCounts.for_mongo(mongo).get())
+    if len(BSON.encode(query)) > SearchLimits.max_filter_bytes:
+        return [SearchTooComplex("filter size (in bytes)", SearchLimits.max_filter_bytes)]
+    cache.put(ast, include_hidden, query, tag_ids, under_tags)
+    return query
 
-    tags = mongo.db.tags.find({"name": {"$in": list(tag_names.keys())}})
-    tags = [Tag.from_dict(t) for t in tags]
 
-    for tag in tags:
-        tag_names.pop(tag.name).tag_id = tag.id
+def _resolve_names(mongo: PyMongo, ast: AST) \
+        -> Union[Tuple[Dict[str, ObjectId], Dict[str, ObjectId], Dict[ObjectId, FrozenSet[ObjectId]]], List[SearchStringParseError]]:
+    """
+    Verifies the existence of the tags and attributes a search uses and gets their ids
 
-    if tag_names:
-        return [NonexistentTag(t) for t in tag_names.keys()]
+    Returns
+    -------
+        The ids of the tags by name, the ids of the attribute options by name, and every tag that transitively
+        implies each tag searched for with '::under::' by tag id, from the ancestors the TagGraph keeps,
+        or a list of errors for every tag and attribute that doesn't exist
+    """
+    tag_cache = TagCache.for_mongo(mongo)
+    tag_ids: Dict[str, ObjectId] = {}
+    missing_tags = []
+    for name in ast.tag_names:
+        tag_id = tag_cache.id_for_name(name)
+        if tag_id is None:
+            missing_tags.append(name)
+        else:
+            tag_ids[name] = tag_id
 
-    attrib_options = mongo.db.attrib_options.find({"attribute_name": {"$in": list(attribute_names.keys())}})
-    attrib_options = [AttributeOption.from_dict(t) for t in attrib_options]
+    if missing_tags:
+        return [NonexistentTag(t) for t in missing_tags]
 
-    for attrib_option in attrib_options:
-        attribute_names.pop(attrib_option.attribute_name).attribute_option_id = attrib_option.id
+    attribute_ids: Dict[str, ObjectId] = {}
+    if ast.attribute_names:
+        attrib_options = mongo.db.attrib_options.find({"attribute_name": {"$in": list(ast.attribute_names)}})
+        attribute_ids = {a["attribute_name"]: a["_id"] for a in attrib_options}
 
-    if attribute_names:
-        return [NonexistentAttribute(t) for t in attribute_names.keys()]
+    missing_attributes = [a for a in ast.attribute_names if a not in attribute_ids]
+    if missing_attributes:
+        return [NonexistentAttribute(a) for a in missing_attributes]
 
-    # now: selectively apply de-morgans law to move all not's onto atomic values due to limitation in MongoDB search
+    graph = TagGraph.for_mongo(mongo)
+    under_tags = {tag_ids[name]: graph.ancestors(tag_ids[name]) for name in ast.under_names}
 
-    to_visit_queue: List[Operator] = [ast.base_operator]
+    return tag_ids, attribute_ids, under_tags
 
-    while to_visit_queue:
-        node = to_visit_queue.pop()
 
-        if isinstance(node, UnitaryOperator):
-            if node.op_type == OperatorTypes.Identity:
-                if isinstance(node.value, Operator):
-                    to_visit_queue.append(node.value)
-            elif node.op_type == OperatorTypes.Not:
-                if isinstance(node.value, UnitaryOperator):
-                    if node.value.op_type == OperatorTypes.Identity:
-                        # !(a) -> (!a)
-                        node.op_type = OperatorTypes.Identity
-                        node.value.op_type = OperatorTypes.Not
-                    elif node.value.op_type == OperatorTypes.Not:
-                        # !!a -> a
-                        node.op_type = OperatorTypes.Identity
-                        node.value.op_type = OperatorTypes.Identity
-
-                    to_visit_queue.append(node.value)
-                elif isinstance(node.value, BinaryOperator):
-                    if node.value.op_type == OperatorTypes.And:
-                        # !(a && b) -> (!a || !b)
-                        node.op_type = OperatorTypes.Identity
-                        node.value.op_type = OperatorTypes.Or
-
-                        node.value.left_value = UnitaryOperator(OperatorTypes.Not, node.value.left_value)
-                        node.value.right_value = UnitaryOperator(OperatorTypes.Not, node.value.right_value)
-                    elif node.value.op_type == OperatorTypes.Or:
-                        # !(a || b) -> (!a && !b)
-                        node.op_type = OperatorTypes.Identity
-                        node.value.op_type = OperatorTypes.And
-
-                        node.value.left_value = UnitaryOperator(OperatorTypes.Not, node.value.left_value)
-                        node.value.right_value = UnitaryOperator(OperatorTypes.Not, node.value.right_value)
-
-                    to_visit_queue.append(node.value)
-                elif isinstance(node.value, Value):
-                    # embed the not so it can be processed correctly
-                    # !a -> a(not = true)
-                    node.op_type = OperatorTypes.Identity
-                    node.value.not_value = not node.value.not_value
+def search_string_to_item_ids(mongo: PyMongo, search_string: Union[str, AST], include_hidden: bool = False) -> Union[List[ObjectId], List[SearchStringParseError]]:
+    """
+    Takes in a search string, or AST and evaluates it against the 
+    in-memory ItemIndex instead of MongoDB, which must be enabled.
+    Searches for only tags use the TagMatrix instead, if it's enabled and up to date.
+    The ids are in the order of the items' _id, like a MongoDB search sorted by _id
+    """
 
-        elif isinstance(node, BinaryOperator):
-            if isinstance(node.left_value, Operator):
-                to_visit_queue.append(node.left_value)
-            if isinstance(node.right_value, Operator):
-                to_visit_queue.append(node.right_value)
+    result = search_string_to_facets(mongo, search_string, include_hidden, counts=False)
+    if isinstance(result, list):
+        return result
+    return result["items"]
+
+
+def search_string_to_facets(mongo: PyMongo, search_string: Union[str, AST], include_hidden: bool = False,
+                            counts: bool = True) -> Union[Dict, List[SearchStringParseError]]:
+    """
+    Takes in a search string, or AST and finds the matching items along with how many of them have each tag,
+    so the results can be narrowed down further without a query per tag. The in-memory indices are used if
+    they're enabled and up to date, otherwise a single MongoDB aggregation
+
+    Returns
+    -------
+        A dictionary with the ids of the matching items in order of id as "items", the number of them as "total",
+        the number with each tag by tag id as "tags", and the number with an instance with each tag (such as
+        "Borrowed Out" or "Damaged") by tag id as "instance_tags", or a list of errors if the search is invalid
+        or MongoDB took longer than SearchLimits.max_time_ms to run it
+    """
 
-    # now form into a search
+    if isinstance(search_string, str):
+        ast: AST = search_string_parser(search_string)
+        if isinstance(ast, SearchStringParseError):
+            return [ast]
+    else:
+        ast: AST = search_string
+
+    index = ItemIndex.for_mongo(mongo)
+    matrix = TagMatrix.for_mongo(mongo)
+    use_matrix = matrix.enabled and ast.base_operator.tags_only()
+    if not index.enabled and not use_matrix:
+        return _search_facets_with_mongodb(mongo, ast, include_hidden, counts)
+
+    names = _resolve_names(mongo, ast)
+    if isinstance(names, list):
+        return names
+    tag_ids, attribute_ids, under_tags = names
+
+    base_operator = ast.base_operator
+    if not include_hidden:
+        base_operator = BinaryOperator(OperatorTypes.And, base_operator, VisibleItemValue())
+
+    if use_matrix:
+        with matrix.lock:
+            if matrix.ensure_loaded():
+                bits = base_operator.to_tag_bits(matrix, tag_ids, under_tags=under_tags)
+                items = matrix.ids(bits)
+                return {"items": items, "total": len(items),
+                        "tags": matrix.count_tags(bits) if counts else {},
+                        "instance_tags": matrix.count_tags(bits, instance=True) if counts else {}}
+
+    if not index.enabled:
+        # a shared file that is waiting to be rebuilt, MongoDB is used rather than loading every item in each process
+        return _search_facets_with_mongodb(mongo, ast, include_hidden, counts)
+
+    index.ensure_loaded()
+    with index.lock:
+        matches = base_operator.to_item_ids(index, tag_ids, attribute_ids, under_tags=under_tags)
+        return {"items": sorted(matches), "total": len(matches),
+                "tags": index.count_tags(matches) if counts else {},
+                "instance_tags": index.count_tags(matches, instance=True) if counts else {}}
+
+
+def _search_facets_with_mongodb(mongo: PyMongo, ast: AST, include_hidden: bool, counts: bool) \
+        -> Union[Dict, List[SearchStringParseError]]:
+    """
+    Finds the matching items and the counts of their tags for `search_string_to_facets` with a single MongoDB aggregation
+    """
+    query = search_string_to_mongodb_query(mongo, ast, include_hidden)
+    if isinstance(query, list):
+        return query
+    try:
+        return Item.search_facets(mongo, query, counts, SearchLimits.max_time_ms)
+    except ExecutionTimeout:
+        return [SearchTimedOut(SearchLimits.max_time_ms)]
 
-    return ast.base_operator.to_search_query()
 
 # TODO Basic tests that require by inspection testing, to be replaced by unit tests most likely at some point
 
@@ -0,0 +1,23 @@
+/*Turns every .tag-select into a select2 typeahead, the tags are fetched from the url in its data-autocomplete-url
+as they are typed, so only the ids of the chosen tags are sent with the form*/
+$(document).ready(function() {
+    $('.tag-select').each(function() {
+        var select = $(this);
+        select.select2({
+            placeholder: select.attr('multiple') ? 'select tags' : 'select a tag',
+            width: '100%',
+            minimumInputLength: 1,
+            ajax: {
+                url: select.data('autocomplete-url'),
+                dataType: 'json',
+                delay: 150,
+                data: function(params) {
+                    return {q: params.term, limit: 20};
+                },
+                processResults: function(data) {
+                    return data;
+                }
+            }
+        });
+    });
+});